@@ -63,10 +63,13 @@ module mini_mac #(
   logic [7:0] rx_shift_reg [4:0];
   logic [4:0] rx_cnt, next_rx_cnt;
 
+  // only shift in valid bytes, the PCS output can stall mid frame when rx_clk is slower than clk
   always_ff @(posedge clk) begin
-    rx_shift_reg[4] <= pcs_data_out;
-    for (int i = 0; i < 4; i++)
-      rx_shift_reg[i] <= rx_shift_reg[i+1];
+    if (pcs_valid_out) begin
+      rx_shift_reg[4] <= pcs_data_out;
+      for (int i = 0; i < 4; i++)
+        rx_shift_reg[i] <= rx_shift_reg[i+1];
+    end
   end
     
   enum {
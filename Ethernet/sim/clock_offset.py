@@ -0,0 +1,50 @@
+# Clock compensation by the link partner, for running the receive path at a realistic clock offset
+#
+#   offset = ClockOffset(ppm=-100)
+#   cocotb.start_soon(player.play(chain.from_iterable(offset.apply(frame_chunks(frames)))))
+#
+# ppm is how much faster the frame source runs than the clock the code groups go out on, like the far
+# end's data against a PHY's own SGMII clock. The source gets ppm code groups per million ahead of (or
+# behind) the line, and each time that adds up to a whole /I2/ the PHY's elastic buffer deletes one from
+# (or repeats one in) an inter packet gap. /I2/ leaves the running disparity where it was, so nothing
+# else in the stream changes. The first idle after a frame is never deleted.
+# backlog is how many code groups the partner is holding because there was no idle to delete yet,
+# the elastic buffer depth it needs.
+
+import convert_8b10b
+
+I2 = convert_8b10b.ordered_set("I2", 0)[0] # the idle at RD- that follows every other idle
+IDLES = (I2, convert_8b10b.ordered_set("I1", 1)[0])
+
+
+class ClockOffset:
+    def __init__(self, ppm: float):
+        self.ppm = ppm
+        self.owed = 0.0 # code groups the line is behind the source (ahead if negative)
+        self.symbols = 0 # code groups out
+        self.inserted = 0
+        self.deleted = 0
+        self.backlog = 0.0 # most code groups owed at once
+
+
+    def apply(self, chunks):
+        """Yields the arrays of code groups in chunks (frame_chunks output) with /I2/ added or removed"""
+        drift = self.ppm * 1e-6
+        after_idle = False
+        for chunk in chunks:
+            self.owed += drift * len(chunk)
+            self.backlog = max(self.backlog, abs(self.owed))
+            idle = len(chunk) == 2 and chunk in IDLES
+            if idle and after_idle and self.owed >= len(I2) and chunk == I2:
+                self.owed -= len(I2)
+                self.deleted += 1
+            elif idle and self.owed <= -len(I2) and chunk == I2:
+                self.owed += len(I2)
+                self.inserted += 1
+                self.symbols += 2 * len(chunk)
+                yield chunk
+                yield chunk
+            else:
+                self.symbols += len(chunk)
+                yield chunk
+            after_idle = idle
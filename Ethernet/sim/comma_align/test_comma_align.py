@@ -8,6 +8,11 @@ import cocotb
 from cocotb.triggers import Timer, ReadOnly, ReadWrite, ClockCycles, RisingEdge, FallingEdge
 from cocotb.clock import Clock
 
+lib_path = "../"
+sys.path.insert(0, lib_path)
+import convert_8b10b
+from serdes_model import SerdesModel
+
 
 @cocotb.coroutine
 async def reset(dut):
@@ -37,3 +42,23 @@ async def test(dut):
         dut.input_data.value = int(word,2)
         await RisingEdge(dut.clk)
 
+
+@cocotb.test()
+async def offset_test(dut):
+    """Reports the bit offset of the comma in an idle stream at every misalignment"""
+    cocotb.start_soon(Clock(dut.clk, 20, units="ns").start())
+    await reset(dut)
+
+    idles = convert_8b10b.idle(0)[0]
+    for bit_offset in range(10):
+        # 16 code groups, enough for 15 words at any offset
+        serdes = SerdesModel(idles * 8, offset=bit_offset)
+        cocotb.start_soon(serdes.drive(dut.clk, dut.input_data))
+        commas = 0
+        for _ in range(15):
+            await FallingEdge(dut.clk)
+            if dut.comma.value:
+                commas += 1
+                assert dut.offset.value == bit_offset, f"offset {dut.offset.value.integer} for a {bit_offset} bit misalignment"
+            await RisingEdge(dut.clk)
+        assert commas >= 7
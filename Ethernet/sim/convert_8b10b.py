@@ -1,3 +1,8 @@
+import sys
+from array import array
+from functools import lru_cache
+
+
 def encode(data_chars, ctrl_chars):
     rd = 0
     code_groups = []
@@ -9,8 +14,163 @@ def encode(data_chars, ctrl_chars):
     return code_groups
 
 
-def decode(code_group, control_byte, data_byte):
-    pass
+def encode_array(data, ctrl=0, rd=0):
+    """Encodes bytes starting at running disparity rd, bit i of the ctrl mask makes data[i] a K character
+
+    Returns (array('H') of code groups, rd after the last one).
+    Whether a character flips the running disparity doesn't depend on the disparity it is sent at,
+    so the disparity in front of every character is a prefix XOR of those flips. That and the table
+    lookups are done a whole buffer at a time on big ints and bytes.translate, not per character.
+    """
+    data = bytes(data)
+    n = len(data)
+    if not n:
+        return array("H"), rd
+    ones = int.from_bytes(b"\x01" * n, "little")
+    if ctrl:
+        # 0xFF in every byte that is a K character
+        k_mask = int.from_bytes(bin(ctrl)[:1:-1].ljust(n, "0")[:n].encode().translate(_ASCII_BIT), "little") * 0xFF
+    lookup = lambda table: int.from_bytes(data.translate(table), "little")
+    select = lambda a, b, mask: a ^ ((a ^ b) & mask)
+
+    flips = lookup(_FLIP[0])
+    if ctrl:
+        flips = select(flips, lookup(_FLIP[1]), k_mask)
+    # disparity in front of each character, one bit per byte
+    rds = flips << 8
+    shift = 8
+    while shift < 8 * n:
+        rds ^= rds << shift
+        shift <<= 1
+    rds &= ones
+    if rd:
+        rds ^= ones
+    rd = ((rds ^ flips) >> (8 * (n - 1))) & 1
+    rd_mask = rds * 0xFF
+
+    codes = bytearray(2 * n)
+    for half, tables in ((0, _LOW), (1, _HIGH)):
+        part = select(lookup(tables[0][0]), lookup(tables[0][1]), rd_mask)
+        if ctrl:
+            part = select(part, select(lookup(tables[1][0]), lookup(tables[1][1]), rd_mask), k_mask)
+        codes[half::2] = part.to_bytes(n, "little")
+    codes = array("H", codes)
+    if sys.byteorder == "big":
+        codes.byteswap()
+    return codes, rd
+
+
+def encode_into(buf, offset, data, ctrl=0, rd=0):
+    """encode_array, written into buf (array('H'), numpy uint16, ...) at offset
+
+    Returns (offset just past the code groups written, rd).
+    """
+    codes, rd = encode_array(data, ctrl, rd)
+    end = offset + len(codes)
+    if end > len(buf):
+        raise ValueError(f"{len(codes)} code groups don't fit at offset {offset} of a {len(buf)} entry buffer")
+    buf[offset:end] = codes
+    return end, rd
+
+
+# common ordered sets, (data, ctrl mask)
+ORDERED_SETS = {
+    "I1": (bytes([0xBC, 0xC5]), 0b01), # idle that flips RD+ back to RD-
+    "I2": (bytes([0xBC, 0x50]), 0b01), # idle that keeps RD-
+    "S": (bytes([0xFB] + [0x55] * 7 + [0xD5]), 0b1), # /S/ plus the rest of the preamble and SFD
+    "TR": (bytes([0xFD, 0xF7]), 0b11), # /T/R/
+    "TRR": (bytes([0xFD, 0xF7, 0xF7]), 0b111), # /T/R/R/, ends an odd length frame on an even code group
+}
+
+
+def ordered_set(name, rd=0):
+    """Code groups of one of ORDERED_SETS, encoded once per starting disparity
+
+    Returns (array('H'), rd after it), the array is a fresh copy.
+    """
+    codes, rd = _ordered_set(name, rd)
+    return array("H", codes), rd
+
+
+def idle(rd=0):
+    """The /I/ for this disparity, /I1/ at RD+ and /I2/ at RD-, both leave RD-"""
+    return ordered_set("I1" if rd else "I2", rd)
+
+
+@lru_cache(maxsize=None)
+def _ordered_set(name, rd):
+    data, ctrl = ORDERED_SETS[name]
+    return encode_array(data, ctrl, rd)
+
+
+def decode(code_group, rd=0):
+    """Decodes one 10b code group (bit 9 = a) received at running disparity rd (0 = RD-, 1 = RD+)
+
+    Returns (byte, ctrl, rd after it, disparity error, code violation).
+    """
+    entry = decode_table[(rd << 10) + code_group]
+    return entry & 0xFF, (entry >> 8) & 1, (entry >> 10) & 1, bool(entry & DECODE_DISPARITY_ERR), bool(entry & DECODE_VIOLATION)
+
+
+def decode_array(code_groups, rd=0):
+    """Decodes a sequence of code groups, carrying running disparity from one to the next
+
+    Returns (data bytes, ctrl bytes (0/1 per code group), final rd, indices of code groups
+    with a disparity error or code violation).
+    """
+    table = decode_table
+    entries = []
+    append = entries.append
+    rd <<= 10
+    # the rd bit of an entry is already the offset of the next lookup's half of the table
+    for code in code_groups:
+        entry = table[rd + code]
+        rd = entry & DECODE_RD
+        append(entry)
+    entries = array("H", entries)
+    if sys.byteorder == "big":
+        entries.byteswap()
+    raw = entries.tobytes()
+    high = raw[1::2]
+    errors = []
+    flagged = high.translate(_ERROR_BITS)
+    i = flagged.find(1)
+    while i >= 0:
+        errors.append(i)
+        i = flagged.find(1, i + 1)
+    return raw[0::2], high.translate(_CTRL_BITS), rd >> 10, errors
+
+
+# K characters with an encoding, the ctrl half of encode_table is only meaningful for these
+K_CHARS = (0x1C, 0x3C, 0x5C, 0x7C, 0x9C, 0xBC, 0xDC, 0xFC, 0xF7, 0xFB, 0xFD, 0xFE)
+
+# decode_table entries: byte (bits 7:0) and these flags
+DECODE_CTRL = 0x100
+DECODE_DISPARITY_ERR = 0x200 # valid code group, but not at this running disparity
+DECODE_RD = 0x400            # rd after the code group
+DECODE_VIOLATION = 0x800     # not a code group at all
+
+
+def _decode_table():
+    """Inverts encode_table, indexed (rd << 10) + code group like encode_table's (ctrl << 9) + (rd << 8) + byte"""
+    valid = {}
+    for key, code in enumerate(encode_table):
+        ctrl, rd, byte = key >> 9, (key >> 8) & 1, key & 0xFF
+        if not ctrl or byte in K_CHARS:
+            valid[(rd, code & 0x3FF)] = byte | (ctrl << 8) | ((code >> 10) << 10)
+
+    table = []
+    for rd in (0, 1):
+        for code in range(1024):
+            entry = valid.get((rd, code))
+            if entry is None and (rd ^ 1, code) in valid:
+                entry = valid[(rd ^ 1, code)] | DECODE_DISPARITY_ERR
+            elif entry is None:
+                # carry on with whatever disparity the bad code group leaves
+                ones = bin(code).count("1")
+                entry = ((rd if ones == 5 else int(ones > 5)) << 10) | DECODE_VIOLATION
+            table.append(entry)
+    return table
 
 
 encode_table = [
@@ -1038,4 +1198,15 @@ encode_table = [
     0b10100010111,
     0b11000010111,
     0b10101000111,
-]
\ No newline at end of file
+]
+
+decode_table = _decode_table()
+# high byte of a decode_table entry -> ctrl flag, error flag
+_CTRL_BITS = bytes(h & 1 for h in range(256))
+_ERROR_BITS = bytes(int(bool(h & 0xA)) for h in range(256))
+# per (ctrl, rd) byte translations of encode_table: low 8 bits of the code group, top 2 bits,
+# and whether it flips the running disparity (the same at either disparity)
+_LOW = [[bytes(encode_table[(c << 9) + (r << 8) + b] & 0xFF for b in range(256)) for r in (0, 1)] for c in (0, 1)]
+_HIGH = [[bytes((encode_table[(c << 9) + (r << 8) + b] >> 8) & 0x3 for b in range(256)) for r in (0, 1)] for c in (0, 1)]
+_FLIP = [bytes(encode_table[(c << 9) + b] >> 10 for b in range(256)) for c in (0, 1)]
+_ASCII_BIT = bytes(int(h == ord("1")) for h in range(256))
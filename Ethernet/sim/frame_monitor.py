@@ -0,0 +1,286 @@
+# Frame monitors and a scoreboard for the PCS and MAC testbenches
+#
+#   scoreboard = Scoreboard("rx", fcs=False)    # mini_mac hands out payloads, its FCS already checked
+#   cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out, dut.ready_out,
+#                                    callback=scoreboard.check).run())
+#   cocotb.start_soon(CodeGroupMonitor(dut.clk, dut.tx_data, callback=tx_scoreboard.check).run())
+#   scoreboard.expect(payload)
+#   ...
+#   scoreboard.report(dut._log)
+#   assert scoreboard.passed()
+#
+# PayloadMonitor reassembles frames from a valid/data/eof (and optional ready) byte interface, and
+# sleeps on valid while it is low, so an idle interface costs nothing. CodeGroupMonitor decodes a 10b code group bus with
+# convert_8b10b.decode_table and returns what is between /S/ + preamble + SFD and /T/.
+# Scoreboard checks the FCS with zlib and compares against expected frames in order, counting frames
+# that never showed up as lost.
+
+import time
+import zlib
+from collections import deque
+
+from cocotb.triggers import RisingEdge, FallingEdge
+from cocotb.utils import get_sim_time
+
+import convert_8b10b
+from frame_stream import IPG
+
+FCS_RESIDUE = 0x2144DF1C # crc32 of a frame including a good FCS
+K28_5 = 0xBC # comma, starts every idle
+K27_7 = 0xFB # start of frame
+K29_7 = 0xFD # end of frame
+SFD   = 0xD5
+PREAMBLE_LEN = 8 # /S/, six preamble bytes and SFD (802.3 clause 36, /S/ replaces the first preamble byte)
+
+
+class PayloadMonitor:
+    def __init__(self, clk, valid, data, eof, ready=None, callback=None, eof_byte: bool = True):
+        """eof_byte: False if the eof beat carries no data (sgmii_pcs RX flags eof on the /T/)"""
+        self.clk = clk
+        self.valid = valid
+        self.data = data
+        self.eof = eof
+        self.ready = ready
+        self.callback = callback
+        self.eof_byte = eof_byte
+        self.frames = 0
+
+
+    async def run(self):
+        # sampled mid cycle, where the interface is stable ahead of the rising edge that transfers it
+        frame = bytearray()
+        while True:
+            await FallingEdge(self.clk)
+            if not self.valid.value:
+                # nothing to sample until valid rises
+                await RisingEdge(self.valid)
+                continue
+            if self.ready is not None and not self.ready.value:
+                continue
+            eof = self.eof.value
+            if self.eof_byte or not eof:
+                frame.append(self.data.value.integer)
+            if eof:
+                self.frames += 1
+                if self.callback is not None:
+                    self.callback(bytes(frame))
+                frame = bytearray()
+
+
+class CodeGroupMonitor:
+    def __init__(self, clk, code_groups, callback=None, log=None):
+        self.clk = clk
+        self.code_groups = code_groups
+        self.callback = callback
+        self.log = log
+        self.rd = 0
+        self.frame = None
+        self.preamble = False
+        self.frames = 0
+        self.violations = 0 # code violations and disparity errors inside frames
+
+
+    async def run(self):
+        while True:
+            await FallingEdge(self.clk)
+            self.sample()
+
+
+    def sample(self):
+        """Decodes the bus' current code group"""
+        value = self.code_groups.value
+        if not value.is_resolvable:
+            return
+        entry = convert_8b10b.decode_table[(self.rd << 10) + value.integer]
+        self.rd = int(bool(entry & convert_8b10b.DECODE_RD))
+        self.step(entry)
+
+
+    def step(self, entry: int):
+        """Frame reassembly, one convert_8b10b.decode_table entry at a time"""
+        byte = entry & 0xFF
+        ctrl = entry & convert_8b10b.DECODE_CTRL
+
+        if ctrl and byte == K27_7:
+            self.frame = bytearray()
+            self.preamble = True
+        elif self.frame is None:
+            return
+        elif ctrl and byte == K29_7:
+            self.frames += 1
+            if self.callback is not None:
+                self.callback(bytes(self.frame))
+            self.frame = None
+        elif ctrl or entry & (convert_8b10b.DECODE_VIOLATION | convert_8b10b.DECODE_DISPARITY_ERR):
+            self.violations += 1
+            if self.log is not None:
+                self.log.warning("code violation inside a frame, dropping it")
+            self.frame = None
+        elif self.preamble:
+            self.preamble = byte != SFD
+        else:
+            self.frame.append(byte)
+
+
+class IpgMonitor(CodeGroupMonitor):
+    """CodeGroupMonitor that also measures the line
+
+    The gap in front of every frame is counted in code groups from the one after its last data byte
+    to its /S/, so /T/ and /R/ count towards it like they replace IPG bytes. Gaps shorter than min_ipg
+    and preambles shorter than PREAMBLE_LEN are flagged.
+    """
+    def __init__(self, clk, code_groups, callback=None, log=None, min_ipg: int = IPG):
+        super().__init__(clk, code_groups, callback, log)
+        self.min_ipg = min_ipg
+        self.ipgs = [] # gap in front of every frame but the first
+        self.idles = [] # idle ordered sets in each of those gaps
+        self.preambles = [] # code groups from /S/ through SFD
+        self.lengths = [] # data code groups of every frame, FCS included
+        self.line = 0 # code groups from the first /S/ to the end of the last frame
+        self.flagged = [] # (frame number, what was wrong)
+        self.gap = None # code groups since the end of the last frame
+        self.gap_idles = 0
+        self.length = 0
+
+
+    def step(self, entry: int):
+        byte = entry & 0xFF
+        ctrl = entry & convert_8b10b.DECODE_CTRL
+        in_frame = self.frame is not None
+        if ctrl and byte == K27_7:
+            if self.gap is not None:
+                self.ipgs.append(self.gap)
+                self.idles.append(self.gap_idles)
+                self.line += self.gap
+                if self.gap < self.min_ipg:
+                    self._flag(f"{self.gap} code group IPG, {self.min_ipg} minimum")
+            self.gap = None
+            self.length = 0
+            self.line += 1
+        elif in_frame and not (ctrl and byte == K29_7):
+            self.line += 1
+            if self.preamble:
+                self.length += 1 # counts the preamble until the SFD
+                if not ctrl and byte == SFD:
+                    self.preambles.append(self.length + 1)
+                    if self.length + 1 < PREAMBLE_LEN:
+                        self._flag(f"{self.length + 1} code group preamble")
+                    self.length = 0
+            else:
+                self.length += 1
+        elif self.gap is not None:
+            self.gap += 1
+            if ctrl and byte == K28_5:
+                self.gap_idles += 1
+
+        super().step(entry)
+
+        if in_frame and self.frame is None:
+            # ended by /T/ (the first code group of the gap) or dropped
+            self.lengths.append(self.length)
+            self.gap = int(bool(ctrl and byte == K29_7))
+            self.gap_idles = 0
+
+
+    def _flag(self, what: str):
+        self.flagged.append((len(self.preambles), what))
+        if self.log is not None:
+            self.log.warning(f"frame {len(self.preambles)}: {what}")
+
+
+    def utilization(self) -> float:
+        """Fraction of the line from the first /S/ to the last /T/ that carried frame bytes"""
+        return sum(self.lengths) / self.line if self.line else 0.0
+
+
+    def line_rate(self) -> float:
+        """utilization as a fraction of the most these frames could get, at the minimum preamble and IPG"""
+        best = sum(self.lengths) + PREAMBLE_LEN * len(self.lengths) + self.min_ipg * (len(self.lengths) - 1)
+        return best / self.line if self.line else 0.0
+
+
+    def report(self, log=None):
+        lines = [f"{len(self.lengths)} frames, utilization {self.utilization():.1%} "
+                 f"({self.line_rate():.1%} of the most for these frames), {len(self.flagged)} flagged"]
+        if self.ipgs:
+            lines.append(f"IPG min {min(self.ipgs)} mean {sum(self.ipgs) / len(self.ipgs):.1f} max {max(self.ipgs)} "
+                         f"code groups, idles per gap min {min(self.idles)} max {max(self.idles)}")
+        if self.preambles:
+            lines.append(f"preamble {min(self.preambles)}-{max(self.preambles)} code groups")
+        for line in lines:
+            if log is not None:
+                log.info(line)
+            else:
+                print(line)
+
+
+class Scoreboard:
+    def __init__(self, name: str = "scoreboard", fcs: bool = True, byte_time_ns: float = 8.0):
+        """fcs: frames end in an FCS to check and strip, byte_time_ns: line time of one byte"""
+        self.name = name
+        self.fcs = fcs
+        self.byte_time_ns = byte_time_ns
+        self.expected = deque()
+        self.matched = 0
+        self.mismatched = 0
+        self.unexpected = 0
+        self.lost = 0
+        self.fcs_errors = 0
+        self.bytes = 0
+        self.first_time = None # sim time (ns) the first frame finished
+        self.last_time = None
+        self.steady_bytes = 0 # bytes of every frame after the first
+        self.wall_start = time.time()
+
+
+    def expect(self, frame: bytes):
+        self.expected.append(bytes(frame))
+
+
+    def check(self, frame: bytes):
+        now = get_sim_time("ns")
+        if self.first_time is None:
+            self.first_time = now
+        else:
+            self.steady_bytes += len(frame)
+        self.last_time = now
+        self.bytes += len(frame)
+
+        if self.fcs:
+            if zlib.crc32(frame) != FCS_RESIDUE:
+                self.fcs_errors += 1
+                return
+            frame = frame[:-4]
+        if frame in self.expected:
+            # anything expected ahead of it never arrived
+            while self.expected.popleft() != frame:
+                self.lost += 1
+            self.matched += 1
+        elif self.expected:
+            self.expected.popleft()
+            self.mismatched += 1
+        else:
+            self.unexpected += 1
+
+
+    def passed(self, lost_ok: bool = False, fcs_errors: int = 0) -> bool:
+        """Every frame arrived intact and in order (or was lost, if lost_ok), nothing left outstanding
+        fcs_errors: frames sent with a bad FCS (that weren't expected)"""
+        lost = self.lost + len(self.expected)
+        return not (self.mismatched or self.unexpected or self.fcs_errors != fcs_errors or (lost and not lost_ok))
+
+
+    def report(self, log=None):
+        lines = [f"{self.name}: {self.matched} frames matched, {self.mismatched} mismatched, {self.unexpected} unexpected, "
+                 f"{self.lost} lost, {len(self.expected)} outstanding, {self.fcs_errors} FCS errors"]
+        if self.last_time is not None and self.last_time > self.first_time:
+            elapsed = self.last_time - self.first_time
+            n = self.matched + self.mismatched + self.unexpected + self.fcs_errors - 1
+            wall = time.time() - self.wall_start
+            lines.append(f"{self.name}: {n / elapsed * 1e9:.0f} frames/s simulated ({(n + 1) / wall:.1f} frames/s wall), "
+                         f"{self.steady_bytes * self.byte_time_ns / elapsed:.1%} of line bytes")
+        for line in lines:
+            if log is not None:
+                log.info(line)
+            else:
+                print(line)
@@ -0,0 +1,65 @@
+# 1000BASE-X code group streams for the PCS and MAC testbenches
+#
+#   frames = [random.randbytes(60) for _ in range(1000)]
+#   code_groups = frame_stream(frames, bad_fcs={3})
+#   SerdesModel(code_groups, fill=idle_stream())
+#
+# Frames are given from the destination MAC through the payload. Each gets its FCS appended and is
+# framed as /S/, preamble, SFD, data, then /T/R/ or /T/R/R/ so the idles after it start on an even
+# code group. Idles fill the inter packet gap. Running disparity is carried across the whole stream.
+# Nothing is encoded ahead of what is consumed, frames can come from a generator.
+
+import zlib
+from itertools import chain
+
+import convert_8b10b
+
+IPG = 12 # code groups from the end of the FCS to the next /S/, 802.3 minimum (96 bit times)
+LEAD_IDLES = 5 # idle ordered sets in front of the first frame
+
+
+def fcs(frame: bytes) -> bytes:
+    return zlib.crc32(frame).to_bytes(4, "little")
+
+
+def frame_chunks(frames, ipg: int = IPG, lead: int = LEAD_IDLES, add_fcs: bool = True, bad_fcs=(), rd: int = 0):
+    """frame_stream, as an array('H') of code groups per ordered set or frame
+
+    ipg: code groups from the end of a frame to the next /S/, rounded up to whole idles (at least one)
+    add_fcs: False if the frames already end in their FCS
+    bad_fcs: indices of frames to send with an inverted FCS
+    """
+    for _ in range(lead):
+        codes, rd = convert_8b10b.idle(rd)
+        yield codes
+    for i, frame in enumerate(frames):
+        frame = bytes(frame)
+        if add_fcs:
+            frame += fcs(frame)
+        if i in bad_fcs:
+            frame = frame[:-4] + bytes(b ^ 0xFF for b in frame[-4:])
+        codes, rd = convert_8b10b.ordered_set("S", rd)
+        yield codes
+        codes, rd = convert_8b10b.encode_array(frame, 0, rd)
+        yield codes
+        # /S/ and the preamble are 9 code groups, odd length frames end on an even code group
+        end = "TR" if len(frame) % 2 else "TRR"
+        codes, rd = convert_8b10b.ordered_set(end, rd)
+        yield codes
+        for _ in range(max(1, (ipg - len(codes) + 1) // 2)):
+            codes, rd = convert_8b10b.idle(rd)
+            yield codes
+
+
+def frame_stream(frames, ipg: int = IPG, lead: int = LEAD_IDLES, add_fcs: bool = True, bad_fcs=(), rd: int = 0):
+    """Lazily encodes frames into a stream of 10b code groups, starting and ending with idles"""
+    return chain.from_iterable(frame_chunks(frames, ipg, lead, add_fcs, bad_fcs, rd))
+
+
+def idle_stream(count: int = None, rd: int = 0):
+    """count idle ordered sets (forever if None) as code groups"""
+    n = 0
+    while count is None or n < count:
+        codes, rd = convert_8b10b.idle(rd)
+        yield from codes
+        n += 1
@@ -0,0 +1,109 @@
+# Line errors for the receive path stress tests
+#
+#   errors = LineErrors(ber=1e-5, flip=1, disparity=1, misalign=1, seed=1)
+#   cocotb.start_soon(player.play(chain.from_iterable(errors.inject(frame_chunks(frames)))))
+#   ...
+#   errors.events # [(code group index, kind)]
+#
+# The gap to the next error is drawn from the exponential distribution (in bits), so the cost is per
+# error rather than per bit and the arrays between errors pass through untouched. Each error is one of:
+#   flip       one bit inverted
+#   disparity  a code group swapped for its encoding at the other running disparity: a valid code group
+#              that breaks the running disparity rule
+#   misalign   1-9 bits dropped, the word boundary moves for the rest of the stream until the receiver
+#              bitslips back onto it
+
+import random
+from array import array
+
+import convert_8b10b
+
+KINDS = ("flip", "disparity", "misalign")
+
+
+def _other_disparity_table():
+    # code group -> the same character encoded at the other running disparity (0 where both are the same)
+    table = array("H", bytes(2 * 1024))
+    for rd in (0, 1):
+        for code in range(1024):
+            entry = convert_8b10b.decode_table[(rd << 10) + code]
+            if entry & (convert_8b10b.DECODE_VIOLATION | convert_8b10b.DECODE_DISPARITY_ERR):
+                continue
+            ctrl = int(bool(entry & convert_8b10b.DECODE_CTRL))
+            other = convert_8b10b.encode_array(bytes([entry & 0xFF]), ctrl, rd ^ 1)[0][0]
+            if other != code:
+                table[code] = other
+    return table
+
+OTHER_DISPARITY = _other_disparity_table()
+
+
+class LineErrors:
+    def __init__(self, ber: float, flip: float = 1, disparity: float = 0, misalign: float = 0, seed=None):
+        """ber: errors per bit, flip/disparity/misalign: relative weights of each kind of error"""
+        self.ber = ber
+        self.weights = (flip, disparity, misalign)
+        self.rng = random.Random(seed)
+        self.symbols = 0 # code groups passed through so far
+        self.events = []
+        self.dropped = 0 # bits dropped by misalignments
+
+
+    def count(self, kind: str) -> int:
+        return sum(1 for _, k in self.events if k == kind)
+
+
+    def _gap(self) -> int:
+        """Code groups to the next error"""
+        return int(self.rng.expovariate(self.ber)) // 10
+
+
+    def inject(self, chunks):
+        """Yields the arrays of code groups in chunks (frame_chunks output) with errors injected"""
+        next_error = self.symbols + self._gap()
+        carry = 0 # bits left over from the last array once misaligned
+        carry_bits = 0
+        for chunk in chunks:
+            start = self.symbols
+            self.symbols += len(chunk)
+            if next_error >= self.symbols and not carry_bits:
+                yield chunk
+                continue
+
+            chunk = array("H", chunk)
+            drops = {} # code group: bits dropped off its front
+            while next_error < self.symbols:
+                i = next_error - start
+                kind = self.rng.choices(KINDS, self.weights)[0]
+                if kind == "flip":
+                    chunk[i] ^= 1 << self.rng.randrange(10)
+                elif kind == "disparity":
+                    # the next code group that has another encoding, within this array
+                    while i < len(chunk) and not OTHER_DISPARITY[chunk[i]]:
+                        i += 1
+                    if i == len(chunk):
+                        next_error += self._gap()
+                        continue
+                    chunk[i] = OTHER_DISPARITY[chunk[i]]
+                else:
+                    drops[i] = self.rng.randrange(1, 10)
+                self.events.append((start + i, kind))
+                next_error += self._gap()
+
+            if not drops and not carry_bits:
+                yield chunk
+                continue
+
+            # repack as a bit string, first bit in the MSB, with the misaligned bits cut out
+            bits = carry
+            nbits = carry_bits
+            for i, code in enumerate(chunk):
+                n = drops.get(i, 0)
+                bits = (bits << (10 - n)) | (code & ((1 << (10 - n)) - 1))
+                nbits += 10 - n
+                self.dropped += n
+            words = nbits // 10
+            carry_bits = nbits % 10
+            carry = bits & ((1 << carry_bits) - 1)
+            bits >>= carry_bits
+            yield array("H", ((bits >> (10 * (words - 1 - j))) & 0x3FF for j in range(words)))
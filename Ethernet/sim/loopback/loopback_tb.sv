@@ -0,0 +1,184 @@
+// cocotb toplevel: two sgmii_pcs (pcs_a, pcs_b) and two mini_mac (mac_a, mac_b) wired back to back,
+// each tx_data into the other side's rx_data through a serdes_line
+// Python only touches the byte interfaces. Side A runs on clk_a and B on clk_b, which runs clk_b_ppm
+// faster. Each side's rx_clk is the other side's clk, as if recovered from the line.
+// The line bit offsets are latched at reset, from line_ab_offset (A to B) and line_ba_offset.
+
+module loopback_tb #(
+  parameter CLK_PERIOD_PS = 8000,
+  parameter CLK_B_PHASE_PS = 2500,
+  parameter LINE_DELAY = 4
+) (
+  output logic       clk_a,
+  output logic       clk_b,
+  input  logic signed [31:0] clk_b_ppm,
+  input  logic       reset,
+  input  logic [3:0] line_ab_offset,
+  input  logic [3:0] line_ba_offset,
+
+  // sgmii_pcs pair
+  output logic       pcs_a_locked,
+  input  logic       pcs_a_valid_in,
+  input  logic [7:0] pcs_a_data_in,
+  input  logic       pcs_a_eof_in,
+  output logic       pcs_a_valid_out,
+  output logic [7:0] pcs_a_data_out,
+  output logic       pcs_a_eof_out,
+
+  output logic       pcs_b_locked,
+  input  logic       pcs_b_valid_in,
+  input  logic [7:0] pcs_b_data_in,
+  input  logic       pcs_b_eof_in,
+  output logic       pcs_b_valid_out,
+  output logic [7:0] pcs_b_data_out,
+  output logic       pcs_b_eof_out,
+
+  // mini_mac pair
+  output logic       mac_a_locked,
+  output logic       mac_a_ready_in,
+  input  logic       mac_a_valid_in,
+  input  logic [7:0] mac_a_data_in,
+  input  logic       mac_a_eof_in,
+  input  logic       mac_a_ready_out,
+  output logic       mac_a_valid_out,
+  output logic [7:0] mac_a_data_out,
+  output logic       mac_a_eof_out,
+
+  output logic       mac_b_locked,
+  output logic       mac_b_ready_in,
+  input  logic       mac_b_valid_in,
+  input  logic [7:0] mac_b_data_in,
+  input  logic       mac_b_eof_in,
+  input  logic       mac_b_ready_out,
+  output logic       mac_b_valid_out,
+  output logic [7:0] mac_b_data_out,
+  output logic       mac_b_eof_out
+);
+
+  logic [9:0] pcs_a_tx, pcs_a_rx, pcs_b_tx, pcs_b_rx;
+  logic       pcs_a_bitslip, pcs_b_bitslip;
+  logic [9:0] mac_a_tx, mac_a_rx, mac_b_tx, mac_b_rx;
+  logic       mac_a_bitslip, mac_b_bitslip;
+
+  initial begin
+    clk_a = 0;
+    forever #(CLK_PERIOD_PS / 2000.0) clk_a = ~clk_a;
+  end
+
+  initial begin
+    clk_b = 0;
+    #(CLK_B_PHASE_PS / 1000.0);
+    /* verilator lint_off ZERODLY */
+    forever #(CLK_PERIOD_PS / 2000.0 / (1.0 + $itor(clk_b_ppm) * 1e-6)) clk_b = ~clk_b;
+    /* verilator lint_on ZERODLY */
+  end
+
+
+  //// sgmii_pcs pair
+  sgmii_pcs pcs_a (
+    .clk(clk_a),
+    .reset,
+    .pcs_locked(pcs_a_locked),
+    .valid_in(pcs_a_valid_in),
+    .data_in(pcs_a_data_in),
+    .eof_in(pcs_a_eof_in),
+    .valid_out(pcs_a_valid_out),
+    .data_out(pcs_a_data_out),
+    .eof_out(pcs_a_eof_out),
+    .rx_clk(clk_b),
+    .rx_data(pcs_a_rx),
+    .rx_bitslip(pcs_a_bitslip),
+    .tx_data(pcs_a_tx)
+  );
+
+  sgmii_pcs pcs_b (
+    .clk(clk_b),
+    .reset,
+    .pcs_locked(pcs_b_locked),
+    .valid_in(pcs_b_valid_in),
+    .data_in(pcs_b_data_in),
+    .eof_in(pcs_b_eof_in),
+    .valid_out(pcs_b_valid_out),
+    .data_out(pcs_b_data_out),
+    .eof_out(pcs_b_eof_out),
+    .rx_clk(clk_a),
+    .rx_data(pcs_b_rx),
+    .rx_bitslip(pcs_b_bitslip),
+    .tx_data(pcs_b_tx)
+  );
+
+  serdes_line #(.DELAY(LINE_DELAY)) pcs_line_ab (
+    .clk(clk_a),
+    .reset,
+    .offset(line_ab_offset),
+    .tx_data(pcs_a_tx),
+    .bitslip(pcs_b_bitslip),
+    .rx_data(pcs_b_rx)
+  );
+
+  serdes_line #(.DELAY(LINE_DELAY)) pcs_line_ba (
+    .clk(clk_b),
+    .reset,
+    .offset(line_ba_offset),
+    .tx_data(pcs_b_tx),
+    .bitslip(pcs_a_bitslip),
+    .rx_data(pcs_a_rx)
+  );
+
+
+  //// mini_mac pair
+  mini_mac mac_a (
+    .clk(clk_a),
+    .reset,
+    .pcs_locked(mac_a_locked),
+    .ready_out(mac_a_ready_out),
+    .valid_out(mac_a_valid_out),
+    .data_out(mac_a_data_out),
+    .eof_out(mac_a_eof_out),
+    .ready_in(mac_a_ready_in),
+    .valid_in(mac_a_valid_in),
+    .data_in(mac_a_data_in),
+    .eof_in(mac_a_eof_in),
+    .rx_clk(clk_b),
+    .rx_data(mac_a_rx),
+    .rx_bitslip(mac_a_bitslip),
+    .tx_data(mac_a_tx)
+  );
+
+  mini_mac mac_b (
+    .clk(clk_b),
+    .reset,
+    .pcs_locked(mac_b_locked),
+    .ready_out(mac_b_ready_out),
+    .valid_out(mac_b_valid_out),
+    .data_out(mac_b_data_out),
+    .eof_out(mac_b_eof_out),
+    .ready_in(mac_b_ready_in),
+    .valid_in(mac_b_valid_in),
+    .data_in(mac_b_data_in),
+    .eof_in(mac_b_eof_in),
+    .rx_clk(clk_a),
+    .rx_data(mac_b_rx),
+    .rx_bitslip(mac_b_bitslip),
+    .tx_data(mac_b_tx)
+  );
+
+  serdes_line #(.DELAY(LINE_DELAY)) mac_line_ab (
+    .clk(clk_a),
+    .reset,
+    .offset(line_ab_offset),
+    .tx_data(mac_a_tx),
+    .bitslip(mac_b_bitslip),
+    .rx_data(mac_b_rx)
+  );
+
+  serdes_line #(.DELAY(LINE_DELAY)) mac_line_ba (
+    .clk(clk_b),
+    .reset,
+    .offset(line_ba_offset),
+    .tx_data(mac_b_tx),
+    .bitslip(mac_a_bitslip),
+    .rx_data(mac_a_rx)
+  );
+
+endmodule : loopback_tb
@@ -0,0 +1,157 @@
+import itertools
+import os
+import random
+import sys
+import time
+
+import cocotb
+from cocotb.triggers import ClockCycles, RisingEdge, FallingEdge, Combine
+
+lib_path = "../"
+sys.path.insert(0, lib_path)
+from frame_monitor import PayloadMonitor, Scoreboard
+from frame_stream import fcs
+
+# clk_a (8 ns) and clk_b (clk_b_ppm faster) are generated by loopback_tb
+CLK_B_PPM = 100 # 802.3 allows each end's clock +-100 ppm
+LOCK_CYCLES = 200
+MIN_PAYLOAD = 46
+PCS_GAP = 16 # cycles between frames into sgmii_pcs, it has no backpressure
+
+
+def port(dut, prefix, name):
+    return getattr(dut, f"{prefix}_{name}")
+
+
+@cocotb.coroutine
+async def reset(dut, ab_offset=0, ba_offset=0, clk_b_ppm=CLK_B_PPM):
+    await RisingEdge(dut.clk_a)
+    dut.clk_b_ppm.value = clk_b_ppm
+    dut.line_ab_offset.value = ab_offset
+    dut.line_ba_offset.value = ba_offset
+    for prefix in ("pcs_a", "pcs_b", "mac_a", "mac_b"):
+        port(dut, prefix, "valid_in").value = 0
+        port(dut, prefix, "eof_in").value = 0
+    dut.mac_a_ready_out.value = 1
+    dut.mac_b_ready_out.value = 1
+    dut.reset.value = 1
+    await ClockCycles(dut.clk_a, 5)
+    dut.reset.value = 0
+    print("DUT reset")
+
+@cocotb.coroutine
+async def wait_locked(dut, cycles=LOCK_CYCLES):
+    # cycles of clk_a until every receiver has locked, None if one didn't
+    locks = [dut.pcs_a_locked, dut.pcs_b_locked, dut.mac_a_locked, dut.mac_b_locked]
+    for cycle in range(cycles):
+        await RisingEdge(dut.clk_a)
+        if all(lock.value for lock in locks):
+            return cycle
+    return None
+
+@cocotb.coroutine
+async def send_frames(dut, prefix, clk, frames, gap=0):
+    valid = port(dut, prefix, "valid_in")
+    data = port(dut, prefix, "data_in")
+    eof = port(dut, prefix, "eof_in")
+    ready = getattr(dut, f"{prefix}_ready_in", None)
+    for frame in frames:
+        for i, b in enumerate(frame):
+            valid.value = 1
+            data.value = b
+            eof.value = i == len(frame) - 1
+            await RisingEdge(clk)
+            while ready is not None and not ready.value:
+                await RisingEdge(clk)
+        valid.value = 0
+        eof.value = 0
+        if gap:
+            await ClockCycles(clk, gap)
+
+def receive(dut, prefix, clk, scoreboard, eof_byte=True):
+    ready = getattr(dut, f"{prefix}_ready_out", None)
+    monitor = PayloadMonitor(clk, port(dut, prefix, "valid_out"), port(dut, prefix, "data_out"),
+                             port(dut, prefix, "eof_out"), ready, callback=scoreboard.check, eof_byte=eof_byte)
+    return cocotb.start_soon(monitor.run())
+
+
+@cocotb.test()
+async def link_test(dut):
+    """Both ends of both pairs bring the link up through the lines at every bit offset"""
+    for offset in range(10):
+        await reset(dut, ab_offset=offset, ba_offset=9 - offset)
+        cycles = await wait_locked(dut)
+        assert cycles is not None, f"no lock within {LOCK_CYCLES} cycles at bit offsets {offset}/{9 - offset}"
+        print(f"bit offsets {offset}/{9 - offset}: locked after {cycles} cycles")
+        # and stays up
+        for _ in range(100):
+            await RisingEdge(dut.clk_a)
+            assert dut.pcs_a_locked.value and dut.pcs_b_locked.value
+            assert dut.mac_a_locked.value and dut.mac_b_locked.value
+
+
+@cocotb.test()
+async def pcs_duplex_test(dut):
+    """Frames both ways through the sgmii_pcs pair at once"""
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    await reset(dut, ab_offset=3, ba_offset=7)
+    assert await wait_locked(dut) is not None
+
+    frames = {side: [random.randbytes(random.randrange(60, 1500)) for _ in range(50)] for side in "ab"}
+    scoreboards = {}
+    for src, dst in (("a", "b"), ("b", "a")):
+        # the PCS passes the FCS through from the MAC, flags eof on the /T/ and has no ready
+        scoreboards[dst] = Scoreboard(f"pcs {src} to {dst}")
+        for frame in frames[src]:
+            scoreboards[dst].expect(frame)
+        receive(dut, f"pcs_{dst}", getattr(dut, f"clk_{dst}"), scoreboards[dst], eof_byte=False)
+
+    senders = [cocotb.start_soon(send_frames(dut, f"pcs_{side}", getattr(dut, f"clk_{side}"),
+                                             (frame + fcs(frame) for frame in frames[side]), gap=PCS_GAP))
+               for side in "ab"]
+    await Combine(*senders)
+    await ClockCycles(dut.clk_a, 200)
+
+    for scoreboard in scoreboards.values():
+        scoreboard.report(dut._log)
+        assert scoreboard.passed()
+
+
+@cocotb.test()
+async def mac_duplex_test(dut):
+    """Payloads both ways through the mini_mac pair at once, as fast as the MACs take them"""
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    await reset(dut, ab_offset=5, ba_offset=1)
+    assert await wait_locked(dut) is not None
+
+    payloads = {side: [random.randbytes(random.randrange(1, 1500)) for _ in range(50)] for side in "ab"}
+    scoreboards = {}
+    for src, dst in (("a", "b"), ("b", "a")):
+        # short payloads come out with the MAC's padding
+        scoreboards[dst] = Scoreboard(f"mac {src} to {dst}", fcs=False)
+        for payload in payloads[src]:
+            scoreboards[dst].expect(payload.ljust(MIN_PAYLOAD, b"\0"))
+        receive(dut, f"mac_{dst}", getattr(dut, f"clk_{dst}"), scoreboards[dst])
+
+    start = time.time()
+    senders = [cocotb.start_soon(send_frames(dut, f"mac_{side}", getattr(dut, f"clk_{side}"), payloads[side]))
+               for side in "ab"]
+    await Combine(*senders)
+    # the MACs still have up to a TX buffer of frames to send, and hand each one out after its FCS
+    for _ in range(100):
+        if not any(scoreboard.expected for scoreboard in scoreboards.values()):
+            break
+        await ClockCycles(dut.clk_a, 100)
+    elapsed = time.time() - start
+    sent = sum(len(p) for p in itertools.chain(*payloads.values()))
+    print(f"{sent} payload bytes both ways in {elapsed:.2f} s")
+
+    for scoreboard in scoreboards.values():
+        scoreboard.report(dut._log)
+        assert scoreboard.passed()
@@ -0,0 +1,123 @@
+// cocotb toplevel: mini_mac with a symbol_player that can drive rx_data in place of the rx_data port
+// (player_enable), see symbol_player.py
+// Both clocks are generated here rather than by cocotb, whose Clock wakes Python on every edge.
+// rx_clk runs rx_clk_ppm faster than clk (the PHY's clock against ours), it can be changed at any time.
+
+module mini_mac_tb #(
+  parameter CLK_PERIOD_PS = 8000,
+  parameter RX_CLK_PHASE_PS = 2500,
+  parameter PLAYER_CHUNK = 32
+) (
+  output logic       clk,  // 125MHz clock
+  input  logic       reset,
+  output logic       pcs_locked,
+
+  // RX payload interface
+  input  logic       ready_out,
+  output logic       valid_out,
+  output logic [7:0] data_out,
+  output logic       eof_out,
+
+  // TX payload interface
+  output logic       ready_in,
+  input  logic       valid_in,
+  input  logic [7:0] data_in,
+  input  logic       eof_in,
+
+  // SERDES interface
+  output logic       rx_clk,
+  input  logic signed [31:0] rx_clk_ppm,
+  input  logic [9:0] rx_data,
+  output logic       rx_bitslip,
+  output logic [9:0] tx_data,
+
+  // symbol player
+  input  logic                       player_enable,
+  input  logic [10*PLAYER_CHUNK-1:0] player_load_data,
+  input  logic                       player_load_valid,
+  output logic                       player_load_ready,
+  input  logic                       player_preload,
+  input  logic [31:0]                player_preload_cnt,
+  output logic [31:0]                player_level,
+  output logic [31:0]                player_underflows,
+
+  output logic [31:0]                rx_frame_cnt, // frames handed out on the RX payload interface
+  output logic [31:0]                rx_cdc_max_level, // most bytes waiting in the PCS' rx_clk to clk crossing
+  output logic [31:0]                rx_cdc_stalls // cycles a frame out of the PCS waited on the crossing
+);
+
+  logic [9:0] player_data;
+  logic [7:0] rx_cdc_level;
+  logic       rx_cdc_in_frame;
+
+  initial begin
+    clk = 0;
+    forever #(CLK_PERIOD_PS / 2000.0) clk = ~clk;
+  end
+
+  initial begin
+    rx_clk = 0;
+    #(RX_CLK_PHASE_PS / 1000.0);
+    /* verilator lint_off ZERODLY */
+    forever #(CLK_PERIOD_PS / 2000.0 / (1.0 + $itor(rx_clk_ppm) * 1e-6)) rx_clk = ~rx_clk;
+    /* verilator lint_on ZERODLY */
+  end
+
+  symbol_player #(
+    .CHUNK(PLAYER_CHUNK)
+  ) player (
+    .clk(rx_clk),
+    .reset,
+    .load_data(player_load_data),
+    .load_valid(player_load_valid),
+    .load_ready(player_load_ready),
+    .preload(player_preload),
+    .preload_cnt(player_preload_cnt),
+    .level(player_level),
+    .underflows(player_underflows),
+    .bitslip(rx_bitslip && player_enable),
+    .data_out(player_data)
+  );
+
+  always_ff @(posedge clk) begin
+    if (reset)                                 rx_frame_cnt <= 0;
+    else if (valid_out && ready_out && eof_out) rx_frame_cnt <= rx_frame_cnt + 1;
+  end
+
+  // the crossing's write pointer is on rx_clk, close enough for a testbench
+  assign rx_cdc_level = dut.sgmii_pcs_i.cdc_fifo.w_ptr_b - dut.sgmii_pcs_i.cdc_fifo.r_ptr_b;
+
+  always_ff @(posedge clk) begin
+    if (reset) begin
+      rx_cdc_max_level <= 0;
+      rx_cdc_stalls <= 0;
+      rx_cdc_in_frame <= 0;
+    end else begin
+      if (rx_cdc_level > rx_cdc_max_level)
+        rx_cdc_max_level <= rx_cdc_level;
+      if (dut.pcs_valid_out)
+        rx_cdc_in_frame <= ~dut.pcs_eof_out;
+      else if (rx_cdc_in_frame)
+        rx_cdc_stalls <= rx_cdc_stalls + 1;
+    end
+  end
+
+  mini_mac dut (
+    .clk,
+    .reset,
+    .pcs_locked,
+    .ready_out,
+    .valid_out,
+    .data_out,
+    .eof_out,
+    .ready_in,
+    .valid_in,
+    .data_in,
+    .eof_in,
+    .rx_clk,
+    .rx_data(player_enable ? player_data : rx_data),
+    .rx_bitslip,
+    .tx_data
+  );
+
+endmodule : mini_mac_tb
@@ -1,3 +1,4 @@
+import itertools
 import os
 import random
 import sys
@@ -6,41 +7,78 @@ import time
 import cocotb
 from cocotb.triggers import Timer, ReadOnly, ReadWrite, ClockCycles, RisingEdge, FallingEdge
 from cocotb.clock import Clock
+from cocotb.utils import get_sim_time
 
 lib_path = "../"
 sys.path.insert(0, lib_path)
 import convert_8b10b
+from frame_monitor import PayloadMonitor, CodeGroupMonitor, IpgMonitor, Scoreboard
+from frame_stream import frame_stream, frame_chunks, idle_stream
+from line_errors import LineErrors
+from clock_offset import ClockOffset
+from serdes_model import SerdesModel
+from symbol_player import SymbolPlayer
+
+# clk (8 ns) and rx_clk (rx_clk_ppm faster) are generated by mini_mac_tb
+RX_CLK_PPM = 100 # 802.3 allows each end's clock +-100 ppm
+
+HEADER_LEN = 14 # mini_mac strips the ethernet header (and the FCS) off received frames
+MIN_PAYLOAD = 46
+# header mini_mac puts on transmitted payloads, from its default parameters
+TX_HEADER = bytes.fromhex("ffffffffffff" "0007ed123456" "88b5")
+
+# ber_stress_test runs at an accelerated error rate where every error is still an isolated event, and
+# scales the per error results to TARGET_BER. Set STRESS_BER=1e-7 STRESS_SYMBOLS=100000000 to measure
+# it directly (about 20 minutes).
+STRESS_BER = float(os.environ.get("STRESS_BER", 1e-5))
+STRESS_SYMBOLS = int(float(os.environ.get("STRESS_SYMBOLS", 1e6)))
+TARGET_BER = 1e-7
+PPM_SYMBOLS = int(float(os.environ.get("PPM_SYMBOLS", 4e5))) # per clock offset in ppm_test
+
+# broadcast test frame, FCS not included
+FRAME = bytes([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34,
+               0x56, 0x8, 0x0, 0x9f, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32,
+               0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29,
+               0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13,
+               0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45,
+               0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d,
+               0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d,
+               0xcd])
 
 
 @cocotb.coroutine
-async def reset(dut):
+async def reset(dut, rx_clk_ppm=RX_CLK_PPM):
     await RisingEdge(dut.clk)
+    dut.rx_clk_ppm.value = rx_clk_ppm
     dut.reset.value = 1
+    dut.player_enable.value = 0 # back to the rx_data port, in case an earlier test left the player on
     await ClockCycles(dut.clk, 5)
     dut.reset.value = 0
     print("DUT reset")
 
 @cocotb.coroutine
-async def serdes_driver(dut, symbols):
-    for sym in symbols:
-        dut.rx_data.value = sym
-        await RisingEdge(dut.rx_clk)
+async def lock_monitor(dut, resyncs):
+    # time (ns) from every loss of lock to relocking
+    while True:
+        await FallingEdge(dut.pcs_locked)
+        start = get_sim_time("ns")
+        await RisingEdge(dut.pcs_locked)
+        resyncs.append(get_sim_time("ns") - start)
+
+@cocotb.coroutine
+async def serdes_driver(dut, symbols, offset=0):
+    serdes = SerdesModel(symbols, offset=offset)
+    await serdes.drive(dut.rx_clk, dut.rx_data, dut.rx_bitslip)
 
 @cocotb.coroutine
 async def send_frame(dut, frame):
-    for b in frame[:-1]:
+    for i, b in enumerate(frame):
         dut.valid_in.value = 1
-        while dut.pause_in.value:
-            await RisingEdge(dut.clk)
         dut.data_in.value = b
+        dut.eof_in.value = i == len(frame) - 1
         await RisingEdge(dut.clk)
-
-    dut.valid_in.value = 1
-    while dut.pause_in.value:
-        await RisingEdge(dut.clk)
-    dut.eof_in.value = 1
-    dut.data_in.value = frame[-1]
-    await RisingEdge(dut.clk)
+        while not dut.ready_in.value:
+            await RisingEdge(dut.clk)
     dut.valid_in.value = 0
     dut.eof_in.value = 0
 
@@ -51,31 +89,10 @@ async def rx_test(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8000, units="ps").start())
-    await Timer(2.5, units="ns")
-    cocotb.start_soon(Clock(dut.rx_clk, 7950, units="ps").start())
     await reset(dut)
 
-    data = [0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb]
-    ctrl = [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1]
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34, 
-                 0x56, 0x8, 0x0, 0x9f, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32, 
-                 0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29, 
-                 0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13, 
-                 0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45, 
-                 0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d, 
-                 0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d, 
-                 0xcd, 0xcd, 0xaa, 0xa9, 0x81])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-
-    data *= 2
-    ctrl *= 2
-
-    code_groups = convert_8b10b.encode(data, ctrl)
+    # the frame twice, with a long gap
+    code_groups = frame_stream([FRAME, FRAME], ipg=19)
     
     cocotb.start_soon(serdes_driver(dut,code_groups))
 
@@ -96,63 +113,18 @@ async def test_crc(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8000, units="ps").start())
-    await Timer(2.5, units="ns")
-    cocotb.start_soon(Clock(dut.rx_clk, 7950, units="ps").start())
     await reset(dut)
 
-    # fails crc
-    data = [0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb]
-    ctrl = [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1]
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34, 
-                 0x56, 0x8, 0x0, 0xab, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32, 
-                 0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29, 
-                 0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13, 
-                 0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45, 
-                 0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d, 
-                 0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d, 
-                 0xcd, 0xcd, 0xaa, 0xa9, 0x81])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-    # passes crc
-    data.extend([0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb])
-    ctrl.extend([1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1])
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34, 
-                 0x56, 0x8, 0x0, 0x9f, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32, 
-                 0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29, 
-                 0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13, 
-                 0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45, 
-                 0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d, 
-                 0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d, 
-                 0xcd, 0xcd, 0xaa, 0xa9, 0x81])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-    # passes crc
-    data.extend([0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb])
-    ctrl.extend([1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1])
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34, 
-                 0x56, 0x8, 0x0, 0x9f, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32, 
-                 0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29, 
-                 0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13, 
-                 0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45, 
-                 0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d, 
-                 0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d, 
-                 0xcd, 0xcd, 0xaa, 0xa9, 0x81])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-
-    code_groups = convert_8b10b.encode(data, ctrl)
-    
-    cocotb.start_soon(serdes_driver(dut,code_groups))
+    # the first frame fails crc
+    code_groups = frame_stream([FRAME] * 3, ipg=19, bad_fcs={0})
+    scoreboard = Scoreboard("rx", fcs=False)
+    for _ in range(2):
+        scoreboard.expect(FRAME[HEADER_LEN:])
+    cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out, dut.ready_out,
+                                     callback=scoreboard.check).run())
+
+    player = SymbolPlayer(dut, dut.rx_clk)
+    await player.preload(code_groups)
 
     for _ in range(400):
         await FallingEdge(dut.clk)
@@ -163,6 +135,144 @@ async def test_crc(dut):
         await RisingEdge(dut.clk)
 
     await ClockCycles(dut.clk, 100)
+    scoreboard.report(dut._log)
+    assert dut.rx_frame_cnt.value == 2
+    assert scoreboard.passed()
+
+
+@cocotb.test()
+async def player_test(dut):
+    """Long RX run with the symbols clocked out by symbol_player, Python only wakes to refill it"""
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    player = SymbolPlayer(dut, dut.rx_clk)
+    await reset(dut)
+    dut.ready_out.value = 1
+    dut.valid_in.value = 0
+
+    n_frames = 2000
+    scoreboard = Scoreboard("rx", fcs=False)
+    cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out, dut.ready_out,
+                                     callback=scoreboard.check).run())
+
+    def frames():
+        for i in range(n_frames):
+            frame = random.randbytes(random.randrange(60, 300))
+            if i != 0: # sent with a bad FCS
+                scoreboard.expect(frame[HEADER_LEN:])
+            yield frame
+
+    cocotb.start_soon(player.play(frame_stream(frames(), bad_fcs={0})))
+
+    start = time.time()
+    await ClockCycles(dut.rx_clk, 8)
+    await player.done()
+    # the last frame is only handed out once its FCS has been checked
+    await ClockCycles(dut.clk, 400)
+    elapsed = time.time() - start
+    print(f"{player.loaded} symbols in {elapsed:.2f} s ({player.loaded / elapsed:.0f} symbols/s)")
+    scoreboard.report(dut._log)
+    assert player.starved == 0, f"player ran dry {player.starved} times"
+    received = dut.rx_frame_cnt.value.integer
+    assert received == n_frames - 1, f"{received} frames out of {n_frames - 1} with a good FCS"
+    assert scoreboard.passed()
+
+
+@cocotb.test()
+async def ber_stress_test(dut):
+    """Random frames through bit flips, disparity errors and bit misalignment at STRESS_BER"""
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    player = SymbolPlayer(dut, dut.rx_clk)
+    await reset(dut)
+    dut.ready_out.value = 1
+    dut.valid_in.value = 0
+
+    scoreboard = Scoreboard("stress", fcs=False)
+    cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out, dut.ready_out,
+                                     callback=scoreboard.check).run())
+    resyncs = []
+    cocotb.start_soon(lock_monitor(dut, resyncs))
+    errors = LineErrors(STRESS_BER, flip=1, disparity=1, misalign=1, seed=seed)
+    sent = 0
+
+    def frames():
+        nonlocal sent
+        while errors.symbols < STRESS_SYMBOLS:
+            frame = random.randbytes(random.randrange(60, 600))
+            scoreboard.expect(frame[HEADER_LEN:])
+            sent += 1
+            yield frame
+
+    start = time.time()
+    await player.play(itertools.chain.from_iterable(errors.inject(frame_chunks(frames()))))
+    await player.done()
+    await ClockCycles(dut.clk, 400)
+    elapsed = time.time() - start
+
+    n_errors = len(errors.events)
+    lost = scoreboard.lost + len(scoreboard.expected)
+    false_accepts = scoreboard.mismatched + scoreboard.unexpected
+    errors_per_frame = TARGET_BER * 10 * errors.symbols / sent
+    log = dut._log
+    log.info(f"{errors.symbols} symbols in {elapsed:.1f} s, {sent} frames, BER {STRESS_BER:g}: {errors.count('flip')} bit flips, "
+             f"{errors.count('disparity')} disparity errors, {errors.count('misalign')} misalignments")
+    log.info(f"{lost} frames lost ({lost / max(n_errors, 1):.2f} per error), {false_accepts} false accepts")
+    if resyncs:
+        log.info(f"{len(resyncs)} losses of lock, resync mean {sum(resyncs) / len(resyncs):.0f} ns, max {max(resyncs):.0f} ns")
+    log.info(f"at BER {TARGET_BER:g}: frame loss ratio {lost / max(n_errors, 1) * errors_per_frame:.2e}, "
+             f"false accepts per frame < {max(false_accepts, 1) / max(n_errors, 1) * errors_per_frame:.2e}")
+
+    assert player.starved == 0, f"player ran dry {player.starved} times"
+    assert false_accepts == 0, f"{false_accepts} corrupted frames accepted"
+    assert dut.pcs_locked.value, "no lock after the last error"
+    assert lost <= 2 * n_errors, f"{lost} frames lost to {n_errors} errors"
+
+
+@cocotb.test()
+async def ppm_test(dut):
+    """Back to back frames with the far end, the PHY and clk all +-100 ppm apart
+    ClockOffset adds or removes idles for the far end against the PHY, rx_clk_ppm is the PHY against clk.
+    """
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    log = dut._log
+    for ppm in (RX_CLK_PPM, -RX_CLK_PPM):
+        player = SymbolPlayer(dut, dut.rx_clk)
+        await reset(dut, rx_clk_ppm=ppm)
+        dut.ready_out.value = 1
+        dut.valid_in.value = 0
+
+        scoreboard = Scoreboard(f"{ppm:+} ppm", fcs=False)
+        monitor = cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out, dut.ready_out,
+                                                   callback=scoreboard.check).run())
+        offset = ClockOffset(ppm)
+
+        def frames():
+            while offset.symbols < PPM_SYMBOLS:
+                frame = random.randbytes(random.randrange(60, 1500))
+                scoreboard.expect(frame[HEADER_LEN:])
+                yield frame
+
+        await player.play(itertools.chain.from_iterable(offset.apply(frame_chunks(frames()))))
+        await player.done()
+        # the last frame only starts coming out once its FCS has been checked
+        await ClockCycles(dut.clk, 2000)
+        monitor.kill()
+
+        scoreboard.report(log)
+        log.info(f"{ppm:+} ppm: {offset.symbols} symbols, {offset.deleted} /I2/ deleted, {offset.inserted} inserted, "
+                 f"partner backlog up to {offset.backlog:.1f} code groups")
+        log.info(f"{ppm:+} ppm: PCS clock crossing up to {dut.rx_cdc_max_level.value.integer} bytes, "
+                 f"{dut.rx_cdc_stalls.value.integer} stalled cycles mid frame")
+        assert player.starved == 0, f"player ran dry {player.starved} times"
+        assert scoreboard.passed(), f"frames lost or corrupted at {ppm:+} ppm"
 
 
 #@cocotb.test()
@@ -171,34 +281,14 @@ async def rx_test_lose_sync(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
-    await Timer(2.5, units="ns")
-    cocotb.start_soon(Clock(dut.rx_clk, 7950, units="ps").start())
     await reset(dut)
 
-    data = [0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb]
-    ctrl = [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1]
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0xff, 0xff, 0xff, 0xff, 0xff, 0xff, 0x0, 0x7, 0xed, 0x12, 0x34, 
-                 0x56, 0x8, 0x0, 0x9f, 0x42, 0xc6, 0xa6, 0xc9, 0xc4, 0x77, 0x32, 
-                 0x16, 0x42, 0x76, 0x74, 0x67, 0x93, 0xe5, 0x6, 0xd0, 0x3, 0x29, 
-                 0xde, 0x3a, 0xb9, 0xc2, 0x23, 0x32, 0xcd, 0xad, 0xf2, 0x4b, 0x13, 
-                 0x74, 0xcc, 0xb2, 0xde, 0x40, 0x20, 0xbb, 0x2a, 0xa7, 0xb4, 0x45, 
-                 0x78, 0xb8, 0xd0, 0x41, 0xba, 0x9, 0x50, 0x40, 0x13, 0x6e, 0x8d, 
-                 0x69, 0xcd, 0xe0, 0x29, 0x7f, 0x31, 0x70, 0xf8, 0x90, 0x0, 0x6d, 
-                 0xcd, 0xcd, 0xaa, 0xa9, 0x81])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-
-
-    data = data[:40]
-    ctrl = ctrl[:40]
-    data.extend([0x0, 0x0, 0x0, 0x0, 0x0, 0x0, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1, 0])
-
-    code_groups = convert_8b10b.encode(data, ctrl)
+    # the link drops out partway through the frame, then comes back with idles
+    code_groups = list(itertools.islice(frame_stream([FRAME]), 40))
+    rd = convert_8b10b.decode_array(code_groups)[2]
+    codes, rd = convert_8b10b.encode_array(bytes(6), 0, rd)
+    code_groups += codes
+    code_groups += idle_stream(5, rd)
     
     cocotb.start_soon(serdes_driver(dut,code_groups))
 
@@ -213,21 +303,76 @@ async def rx_test_lose_sync(dut):
     await ClockCycles(dut.clk, 10000)
 
 
-#@cocotb.test()
+@cocotb.test()
 async def tx_test(dut):
+    """Payloads in, checks the frames decoded off tx_data for header, padding and FCS"""
     seed = 12345 #int(time.time())
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
     await reset(dut)
+    dut.valid_in.value = 0
+    dut.eof_in.value = 0
+    scoreboard = Scoreboard("tx")
+    cocotb.start_soon(CodeGroupMonitor(dut.clk, dut.tx_data, callback=scoreboard.check, log=dut._log).run())
 
     await ClockCycles(dut.clk, 7)
 
-    await send_frame(dut, random.randbytes(64))
-    await send_frame(dut, random.randbytes(64))
+    # short payloads get padded out to the minimum frame
+    for length in (64, 64, 1, 20, 45, 46, 47, 300):
+        payload = random.randbytes(length)
+        scoreboard.expect(TX_HEADER + payload.ljust(MIN_PAYLOAD, b"\0"))
+        await send_frame(dut, payload)
+
+    await ClockCycles(dut.clk, 1000)
+    scoreboard.report(dut._log)
+    assert scoreboard.passed()
+
+
+@cocotb.coroutine
+async def send_back_to_back(dut):
+    """Sends payloads as fast as the MAC takes them, returns the tx scoreboard and an IpgMonitor of tx_data"""
+    seed = 12345 #int(time.time())
+    random.seed(seed)
+    print(f"using seed: {seed}")
+
+    await reset(dut)
+    dut.valid_in.value = 0
+    dut.eof_in.value = 0
+    scoreboard = Scoreboard("tx")
+    monitor = IpgMonitor(dut.clk, dut.tx_data, callback=scoreboard.check, log=dut._log)
+    cocotb.start_soon(monitor.run())
+
+    # minimum size frames are where the gap matters most. The MAC only starts a frame once all of it is
+    # buffered, so longer payloads written a byte per cycle open up gaps of their own.
+    for length in [MIN_PAYLOAD] * 20 + [random.randrange(1, 1500) for _ in range(20)]:
+        payload = random.randbytes(length)
+        scoreboard.expect(TX_HEADER + payload.ljust(MIN_PAYLOAD, b"\0"))
+        await send_frame(dut, payload)
+
+    while scoreboard.expected:
+        await ClockCycles(dut.clk, 100)
+    monitor.report(dut._log)
+    scoreboard.report(dut._log)
+    return scoreboard, monitor
+
+
+@cocotb.test()
+async def tx_ipg_test(dut):
+    """Back to back payloads, measures IPG, preamble and utilization on tx_data"""
+    scoreboard, monitor = await send_back_to_back(dut)
+    assert scoreboard.passed()
+    assert not [what for _, what in monitor.flagged if "preamble" in what], "short preamble"
+
 
-    await ClockCycles(dut.clk, 20)
+# README erratum: the MAC's IPG doesn't count the preamble the PCS adds, so back to back frames go out
+# closer together than 802.3 allows. Once that is fixed cocotb reports this passing unexpectedly as a
+# failure, take expect_fail off then.
+@cocotb.test(expect_fail=True)
+async def tx_ipg_erratum_test(dut):
+    """Back to back frames are at least the minimum IPG apart"""
+    _, monitor = await send_back_to_back(dut)
+    assert not monitor.flagged, f"{len(monitor.flagged)} frames closer than {monitor.min_ipg} code groups"
 
 
 #@cocotb.test()
@@ -236,7 +381,6 @@ async def autoneg_test(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
     await reset(dut)
 
     symbols = [0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274, 0x0fa, 0x125, 0x274, 0x274, 0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274]
@@ -0,0 +1,49 @@
+// testbench only: one direction of a SERDES link, from a transmitter's tx_data to a receiver's rx_data
+// on the transmitter's clock (the receiver's recovered rx_clk)
+//
+// The line is DELAY words long. rx_data starts offset bits into a word (latched at reset), and every
+// cycle bitslip is high moves it one bit later in the stream, like SerdesModel. Ten bitslips drop a
+// whole word; once DELAY - 1 words have been dropped the line jumps back to its full length, which
+// repeats those words (the receiver sees a glitch on the line).
+
+module serdes_line #(
+  parameter DELAY = 4
+) (
+  input  logic       clk,
+  input  logic       reset,
+  input  logic [3:0] offset, // 0-9
+
+  input  logic [9:0] tx_data,
+  input  logic       bitslip,
+  output logic [9:0] rx_data
+);
+
+  localparam DELAY_SIZE = $clog2(DELAY + 1);
+
+  logic [9:0]            words [DELAY:0]; // words[0] is the newest
+  logic [DELAY_SIZE-1:0] delay;
+  logic [3:0]            slip;
+  logic [19:0]           window;
+
+  assign window = {words[delay], words[delay - 1]};
+  assign rx_data = window[19-slip-:10];
+
+  always_ff @(posedge clk) begin
+    words[0] <= tx_data;
+    for (int i = 1; i <= DELAY; i++)
+      words[i] <= words[i-1];
+
+    if (reset) begin
+      slip <= offset;
+      delay <= DELAY;
+    end else if (bitslip) begin
+      if (slip == 9) begin
+        slip <= 0;
+        delay <= (delay == 1) ? DELAY : delay - 1;
+      end else begin
+        slip <= slip + 1;
+      end
+    end
+  end
+
+endmodule : serdes_line
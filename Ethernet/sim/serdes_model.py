@@ -0,0 +1,87 @@
+# Receive side of a SERDES with bitslip, for the comma_align, sgmii_pcs and mini_mac testbenches
+#
+#   serdes = SerdesModel(code_groups, offset=3)
+#   cocotb.start_soon(serdes.drive(dut.rx_clk, dut.rx_data, dut.rx_bitslip))
+#
+# The serial stream is a packed int, first bit in the MSB like the SERDES shifts it in, refilled a
+# batch of code groups at a time from any iterable of 10b code groups (a list, a generator,
+# convert_8b10b.encode_array output). Nothing is generated ahead of what the DUT consumes.
+# Every rx clock hands out the next 10 bits; a bitslip drops one bit, so the word boundary moves one
+# bit later in the stream, like the bitslip port of a hard SERDES.
+
+from itertools import chain, islice
+
+from cocotb.triggers import RisingEdge, FallingEdge
+
+REFILL = 64 # code groups pulled from the source at a time
+
+
+class SerdesModel:
+    def __init__(self, symbols, offset: int = 0, fill=None):
+        """symbols: iterable of 10 bit code groups, offset: bits dropped off the front of the stream,
+        fill: iterable of code groups sent once symbols runs out (the stream ends if None)"""
+        self.source = iter(symbols)
+        self.fill = fill
+        self.bits = 0
+        self.nbits = 0 # unread bits, the low nbits of self.bits
+        self.words = 0
+        self.slips = 0
+        self.skip(offset)
+
+
+    def extend(self, symbols):
+        """Queues more code groups behind what is already in the stream"""
+        self.source = chain(self.source, symbols)
+
+
+    def skip(self, nbits: int) -> bool:
+        """Drops nbits from the stream, returns False if it ran out first"""
+        while self.nbits < nbits:
+            nbits -= self.nbits
+            self.nbits = 0
+            if not self._refill():
+                return False
+        self.nbits -= nbits
+        return True
+
+
+    def next_word(self, bitslip: bool = False):
+        """Next 10 bit parallel word, one bit later than otherwise if bitslip; None at the end of the stream"""
+        if bitslip:
+            self.slips += 1
+            if not self.skip(1):
+                return None
+        if self.nbits < 10 and not self._refill():
+            return None
+        self.nbits -= 10
+        self.words += 1
+        return (self.bits >> self.nbits) & 0x3FF
+
+
+    async def drive(self, clk, data, bitslip=None):
+        """Drives data with the next word every rising edge of clk until the stream ends, slipping a bit
+        after every cycle bitslip was high"""
+        slip = False
+        while (word := self.next_word(slip)) is not None:
+            data.value = word
+            if bitslip is not None:
+                await FallingEdge(clk)
+                slip = bool(bitslip.value)
+            await RisingEdge(clk)
+
+
+    def _refill(self) -> bool:
+        chunk = list(islice(self.source, REFILL))
+        if not chunk and self.fill is not None:
+            self.source = iter(self.fill)
+            self.fill = None
+            chunk = list(islice(self.source, REFILL))
+        if not chunk:
+            return False
+        packed = 0
+        for code in chunk:
+            packed = (packed << 10) | code
+        # keep only the unread bits so the int stays a few hundred bits long
+        self.bits = ((self.bits & ((1 << self.nbits) - 1)) << (10 * len(chunk))) | packed
+        self.nbits += 10 * len(chunk)
+        return True
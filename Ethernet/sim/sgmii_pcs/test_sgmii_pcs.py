@@ -1,3 +1,4 @@
+import itertools
 import os
 import random
 import sys
@@ -8,6 +9,13 @@ import cocotb
 from cocotb.triggers import Timer, ReadOnly, ReadWrite, ClockCycles, RisingEdge, FallingEdge
 from cocotb.clock import Clock
 
+lib_path = "../"
+sys.path.insert(0, lib_path)
+import convert_8b10b
+from frame_monitor import PayloadMonitor, CodeGroupMonitor, Scoreboard
+from frame_stream import frame_stream, fcs
+from serdes_model import SerdesModel
+
 
 @cocotb.coroutine
 async def reset(dut):
@@ -17,49 +25,15 @@ async def reset(dut):
     dut.reset.value = 0
     print("DUT reset")
 
-@cocotb.coroutine
-async def serdes_emulator(dut, symbols):
-    raw_bits = "".join([format(n, '010b') for n in symbols])
-
-    i = 0
-    while True:
-        if i+10 <= len(raw_bits):
-            symbol = raw_bits[i:i+10]
-        else:
-            print(raw_bits)
-            d = len(raw_bits) - i
-            print(f"len rawbits: {len(raw_bits)}")
-            print(f"i: {i}")
-            print(f"d: {d}")
-            print(f"i+d: {i+d}")
-            print(f"first: {raw_bits[i:i+d]}")
-            print(f"second: {raw_bits[0:10-d]}")
-            symbol = raw_bits[i:i+d] + raw_bits[0:10-d]
-        print(f"Driving symbol {symbol}")
-        dut.rx_data.value = int(symbol, 2)
-
-        # BOZO bit slip is currently broken
-        await FallingEdge(dut.clk)
-        if dut.rx_bitslip.value:
-            i += 11
-        else:
-            i += 10
-        if i >= len(raw_bits):
-            i = i - len(raw_bits)
-        await RisingEdge(dut.clk)
-
 @cocotb.coroutine
 async def send_frame(dut, frame):
+    # sgmii_pcs has no backpressure, its tx fifo drains at line rate
     for b in frame[:-1]:
         dut.valid_in.value = 1
-        while dut.pause_in.value:
-            await RisingEdge(dut.clk)
         dut.data_in.value = b
         await RisingEdge(dut.clk)
 
     dut.valid_in.value = 1
-    while dut.pause_in.value:
-        await RisingEdge(dut.clk)
     dut.eof_in.value = 1
     dut.data_in.value = frame[-1]
     await RisingEdge(dut.clk)
@@ -67,36 +41,88 @@ async def send_frame(dut, frame):
     dut.eof_in.value = 0
 
 
-#@cocotb.test()
+@cocotb.test()
 async def rx_test(dut):
+    """Locks onto an idle stream starting at every bit offset, bitslipping onto the word boundary"""
+    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
+    cocotb.start_soon(Clock(dut.rx_clk, 8, units="ns").start())
+    dut.valid_in.value = 0
+    dut.eof_in.value = 0
+    dut.data_in.value = 0
+
+    idles = convert_8b10b.idle(0)[0]
+    for offset in range(10):
+        serdes = SerdesModel(itertools.cycle(idles), offset=offset)
+        driver = cocotb.start_soon(serdes.drive(dut.rx_clk, dut.rx_data, dut.rx_bitslip))
+        await reset(dut)
+        for cycle in range(100):
+            await RisingEdge(dut.clk)
+            if dut.pcs_locked.value:
+                break
+        assert dut.pcs_locked.value, f"no lock at bit offset {offset}, {serdes.slips} bitslips"
+        print(f"bit offset {offset}: locked after {cycle} cycles, {serdes.slips} bitslips")
+        # stays locked once aligned
+        slips = serdes.slips
+        for _ in range(100):
+            await RisingEdge(dut.clk)
+            assert dut.pcs_locked.value, f"lost lock at bit offset {offset}"
+        assert serdes.slips == slips
+        driver.kill()
+
+
+@cocotb.test()
+async def tx_test(dut):
     seed = 12345 #int(time.time())
     random.seed(seed)
     print(f"using seed: {seed}")
 
     cocotb.start_soon(Clock(dut.clk, 20, units="ns").start())
+    dut.valid_in.value = 0
+    dut.eof_in.value = 0
     await reset(dut)
+    # the PCS passes the FCS through from the MAC
+    scoreboard = Scoreboard("tx", byte_time_ns=20)
+    cocotb.start_soon(CodeGroupMonitor(dut.clk, dut.tx_data, callback=scoreboard.check, log=dut._log).run())
 
-    symbols = [0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274, 0x0fa, 0x125, 0x274, 0x274, 0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274]
-    cocotb.start_soon(serdes_emulator(dut,symbols))
+    await ClockCycles(dut.clk, 7)
+
+    for length in (64, 64, 65, 1500):
+        frame = random.randbytes(length)
+        scoreboard.expect(frame)
+        await send_frame(dut, frame + fcs(frame))
+        await ClockCycles(dut.clk, 12)
 
     await ClockCycles(dut.clk, 100)
+    scoreboard.report(dut._log)
+    assert scoreboard.passed()
 
 
 @cocotb.test()
-async def tx_test(dut):
+async def rx_frame_test(dut):
+    """Frames off the SERDES come out of the PCS with their FCS, including ones with a bad FCS"""
     seed = 12345 #int(time.time())
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 20, units="ns").start())
+    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
+    cocotb.start_soon(Clock(dut.rx_clk, 8, units="ns").start())
+    dut.valid_in.value = 0
+    dut.eof_in.value = 0
     await reset(dut)
 
-    await ClockCycles(dut.clk, 7)
-
-    await send_frame(dut, random.randbytes(64))
-    await send_frame(dut, random.randbytes(64))
+    frames = [random.randbytes(random.randrange(60, 200)) for _ in range(20)]
+    scoreboard = Scoreboard("rx")
+    for frame in frames[1:]:
+        scoreboard.expect(frame)
+    cocotb.start_soon(PayloadMonitor(dut.clk, dut.valid_out, dut.data_out, dut.eof_out,
+                                     callback=scoreboard.check, eof_byte=False).run())
+    # enough idles up front to bitslip into lock
+    serdes = SerdesModel(frame_stream(frames, lead=20, bad_fcs={0}), offset=3)
+    await serdes.drive(dut.rx_clk, dut.rx_data, dut.rx_bitslip)
 
-    await ClockCycles(dut.clk, 20)
+    await ClockCycles(dut.clk, 50)
+    scoreboard.report(dut._log)
+    assert scoreboard.passed(fcs_errors=1)
 
 
 #@cocotb.test()
@@ -108,6 +134,9 @@ async def autoneg_test(dut):
     cocotb.start_soon(Clock(dut.clk, 20, units="ns").start())
     await reset(dut)
 
+    cocotb.start_soon(Clock(dut.rx_clk, 20, units="ns").start())
+
     symbols = [0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274, 0x0fa, 0x125, 0x274, 0x274, 0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274]
-    cocotb.start_soon(serdes_emulator(dut,symbols))
+    serdes = SerdesModel(itertools.cycle(symbols))
+    cocotb.start_soon(serdes.drive(dut.rx_clk, dut.rx_data, dut.rx_bitslip))
     await ClockCycles(dut.clk, 100)
\ No newline at end of file
@@ -0,0 +1,100 @@
+# Python side of symbol_player.sv, for testbench toplevels that wrap their DUT with one (mini_mac_tb,
+# axi_over_ethernet_tb)
+#
+#   player = SymbolPlayer(dut, dut.rx_clk)
+#   cocotb.start_soon(player.play(frame_stream(frames)))   # chunked refill, any length
+#   await player.preload(code_groups)                      # or up to DEPTH symbols in one go
+#   await player.done()
+#
+# play() only wakes when the player's buffer is half empty and then refills it a chunk per clock,
+# so Python runs for a few cycles out of every DEPTH/2 instead of on every rx_clk edge.
+
+from array import array
+from itertools import islice
+
+from cocotb.triggers import RisingEdge, FallingEdge, ClockCycles
+
+import convert_8b10b
+
+DEPTH = 65536 # symbol_player DEPTH
+PRELOAD_FILE = "symbol_player.hex"
+# /I/ to pad a short last chunk with, by running disparity
+IDLE = tuple(list(convert_8b10b.idle(rd)[0]) for rd in (0, 1))
+
+
+def _rd_after(codes, rd: int) -> int:
+    """Running disparity after codes, the last unbalanced code group sets it"""
+    for code in reversed(codes):
+        ones = bin(code).count("1")
+        if ones != 5:
+            return int(ones > 5)
+    return rd
+
+
+class SymbolPlayer:
+    def __init__(self, dut, clk, prefix: str = "player_"):
+        self.clk = clk
+        self.enable = getattr(dut, prefix + "enable")
+        self.load_data = getattr(dut, prefix + "load_data")
+        self.load_valid = getattr(dut, prefix + "load_valid")
+        self.load_ready = getattr(dut, prefix + "load_ready")
+        self.preload_start = getattr(dut, prefix + "preload")
+        self.preload_cnt = getattr(dut, prefix + "preload_cnt")
+        self.level = getattr(dut, prefix + "level")
+        self.underflows = getattr(dut, prefix + "underflows")
+        self.chunk = len(self.load_data) // 10
+        self.rd = 0
+        self.loaded = 0
+        self.starved = 0 # underflows before play() had loaded its last chunk
+        self.load_valid.value = 0
+        self.preload_start.value = 0
+        self.enable.value = 0
+
+
+    async def play(self, symbols):
+        """Streams symbols into the player until they run out. A short last chunk is padded with idles."""
+        self.enable.value = 1
+        symbols = iter(symbols)
+        while chunk := list(islice(symbols, self.chunk)):
+            self.rd = _rd_after(chunk, self.rd)
+            while len(chunk) < self.chunk:
+                chunk.extend(IDLE[self.rd])
+                self.rd = 0
+            packed = 0
+            for code in reversed(chunk[:self.chunk]):
+                packed = (packed << 10) | code
+
+            await FallingEdge(self.clk)
+            while not self.load_ready.value:
+                self.load_valid.value = 0
+                await RisingEdge(self.load_ready)
+                await FallingEdge(self.clk)
+            self.load_data.value = packed
+            self.load_valid.value = 1
+            self.loaded += self.chunk
+        await FallingEdge(self.clk)
+        self.load_valid.value = 0
+        self.starved = self.underflows.value.integer
+
+
+    async def preload(self, symbols):
+        """Replaces the player's buffer with symbols through a $readmemh file"""
+        symbols = array("H", symbols)
+        if len(symbols) > DEPTH:
+            raise ValueError(f"{len(symbols)} symbols don't fit in the {DEPTH} symbol player")
+        with open(PRELOAD_FILE, "w") as f:
+            f.write("\n".join(map("{:03x}".format, symbols)) + "\n")
+        self.enable.value = 1
+        await FallingEdge(self.clk)
+        self.preload_cnt.value = len(symbols)
+        self.preload_start.value = 1
+        await FallingEdge(self.clk)
+        self.preload_start.value = 0
+        self.rd = _rd_after(symbols, 0)
+        self.loaded += len(symbols)
+
+
+    async def done(self):
+        """Waits until everything loaded has been played"""
+        while (level := self.level.value.integer) > 0:
+            await ClockCycles(self.clk, level)
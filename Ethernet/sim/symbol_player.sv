@@ -0,0 +1,109 @@
+// testbench only: plays 10 bit symbols handed over by Python out onto a SERDES rx_data bus,
+// one per clock, so long stimulus runs don't wake a Python coroutine on every rx_clk edge
+// (driven by symbol_player.py)
+//
+// refill:  CHUNK symbols at a time on load_data (first symbol in the low bits) while load_ready.
+//          load_ready rises once the buffer is half empty and stays up until it is nearly full,
+//          so the loader refills in bursts.
+// preload: Python writes up to DEPTH symbols to PRELOAD_FILE, one hex symbol per line, and
+//          pulses preload with the count. The buffer is replaced with $readmemh.
+//
+// bitslip behaves like SerdesModel: every cycle it is high drops one bit from the stream.
+// Whenever the buffer is empty the player sends /I2/ idles, so stimulus should end in idles (as
+// frame_stream and SymbolPlayer's padding do). underflows counts those cycles once anything has
+// been loaded, which includes the idles after the end of the stimulus.
+
+module symbol_player #(
+  parameter CHUNK = 32,
+  parameter DEPTH = 65536,
+  parameter PRELOAD_FILE = "symbol_player.hex"
+) (
+  input  logic                 clk,
+  input  logic                 reset,
+
+  // refill
+  input  logic [10*CHUNK-1:0]  load_data,
+  input  logic                 load_valid,
+  output logic                 load_ready,
+
+  // preload
+  input  logic                 preload,
+  input  logic [31:0]          preload_cnt,
+
+  output logic [31:0]          level,      // symbols buffered
+  output logic [31:0]          underflows,
+
+  input  logic                 bitslip,
+  output logic [9:0]           data_out
+);
+
+  localparam ADDR_SIZE = $clog2(DEPTH);
+  localparam
+    K28_5_RDN = 10'b0011111010, // /I2/, starting at RD-
+    D16_2_RDP = 10'b1001000101;
+
+  logic [9:0]           buffer [DEPTH-1:0];
+  logic [ADDR_SIZE-1:0] wr_ptr, rd_ptr;
+  logic                 refill;
+  logic                 started;
+  logic                 idle_odd; // sent the K28.5 of an idle, the D16.2 is next
+  logic [19:0]          window; // previous and current word, the output starts slip bits in
+  logic [3:0]           slip;
+  logic                 load, wrap;
+  logic [1:0]           pop;
+
+  assign data_out = window[19-slip-:10];
+
+  // a bitslip past 9 bits skips a whole word
+  assign wrap = bitslip && slip == 9;
+  assign pop = wrap ? 2 : 1;
+  assign load = load_valid && load_ready;
+  assign load_ready = refill && (DEPTH - level >= CHUNK);
+
+  always_ff @(posedge clk) begin
+    if (reset) begin
+      wr_ptr <= 0;
+      rd_ptr <= 0;
+      level <= 0;
+      refill <= 1;
+      started <= 0;
+      idle_odd <= 0;
+      underflows <= 0;
+      window <= 0;
+      slip <= 0;
+    end else if (preload) begin
+      $readmemh(PRELOAD_FILE, buffer, 0, preload_cnt - 1);
+      wr_ptr <= preload_cnt;
+      rd_ptr <= 0;
+      level <= preload_cnt;
+      refill <= 0;
+      started <= 1;
+    end else begin
+      if (load) begin
+        for (int i = 0; i < CHUNK; i++)
+          buffer[wr_ptr + i] <= load_data[10*i+:10];
+        wr_ptr <= wr_ptr + CHUNK;
+        started <= 1;
+      end
+
+      if (level >= pop && ~idle_odd) begin
+        window <= wrap ? {buffer[rd_ptr], buffer[rd_ptr + 1]} : {window[9:0], buffer[rd_ptr]};
+        slip <= wrap ? 0 : slip + bitslip;
+        rd_ptr <= rd_ptr + pop;
+        level <= level - pop + (load ? CHUNK : 0);
+      end else begin
+        // bitslips are ignored while idling
+        window <= {window[9:0], idle_odd ? D16_2_RDP : K28_5_RDN};
+        idle_odd <= ~idle_odd;
+        underflows <= underflows + (started && level < pop); // not when only finishing an idle
+        level <= level + (load ? CHUNK : 0);
+      end
+
+      if (level < DEPTH / 2)
+        refill <= 1;
+      else if (DEPTH - level < 2 * CHUNK)
+        refill <= 0;
+    end
+  end
+
+endmodule : symbol_player
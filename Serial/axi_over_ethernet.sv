@@ -1,4 +1,10 @@
-module axi_over_ethernet (
+module axi_over_ethernet #(
+  // responses are unicast to the host, so its socket filter can drop everything else
+  parameter HOST_MAC = 48'h123456ABCDEF,
+  parameter FPGA_MAC = 48'h0007ed123456,
+  // WAIT timeouts are given in microseconds
+  parameter CLK_FREQ_MHZ = 125
+) (
   input  logic       clk,
   input  logic       reset,
 
@@ -22,7 +28,10 @@ module axi_over_ethernet (
   logic [7:0] tx_data;
   logic       tx_eof;
 
-  mini_mac eth_mac (
+  mini_mac #(
+    .DEST_MAC(HOST_MAC),
+    .SRC_MAC(FPGA_MAC)
+  ) eth_mac (
     .clk,  // 125MHz clock
     .reset,
     .pcs_locked,
@@ -47,13 +56,40 @@ module axi_over_ethernet (
     OP_WRITE = 8'h10,
     OP_WRITE_ACK = 8'h11,
     OP_READ = 8'h20,
-    OP_READ_RSP = 8'h21
+    OP_READ_RSP = 8'h21,
+    OP_MASKED_WRITE = 8'h30,
+    OP_MASKED_WRITE_RSP = 8'h31,
+    OP_SET_BITS = 8'h40,
+    OP_SET_BITS_RSP = 8'h41,
+    OP_CLEAR_BITS = 8'h50,
+    OP_CLEAR_BITS_RSP = 8'h51,
+    OP_CAS = 8'h60,
+    OP_CAS_RSP = 8'h61,
+    OP_WAIT = 8'h70,
+    OP_WAIT_RSP = 8'h71,
+    OP_BATCH = 8'h80,
+    OP_BATCH_RSP = 8'h81,
+    OP_STREAM = 8'h90,
+    OP_STREAM_ACK = 8'h91,
+    OP_STREAM_DATA = 8'h93, // pushed, never requested directly
+    OP_ABORT = 8'h00 // ends a batch response early, the sub-operation was malformed
   } opcode_t;
 
+  // compare-and-swap buffers the new value until the whole compare is done
+  localparam CAS_MAX_LEN = 4;
+  // WAIT keeps mask, value and the last value read in registers
+  localparam WAIT_MAX_LEN = 4;
+
   enum {
     SER_IDLE,
     SER_OP,
     SER_SEQ_NUM,
+    SER_BATCH_CNT,
+    SER_BATCH_RSP_OP,
+    SER_BATCH_RSP_SEQ,
+    SER_BATCH_NEXT,
+    SER_BATCH_SUB_OP,
+    SER_BATCH_ABORT,
     SER_ADDR,
     SER_LEN,
     SER_WRITE,
@@ -65,6 +101,23 @@ module axi_over_ethernet (
     SER_READ_RSP_LEN,
     SER_READ_RSP_DATA,
     SER_READ_RSP_EOF,
+    SER_RMW_READ,
+    SER_RMW_WAIT,
+    SER_RMW_A,
+    SER_RMW_B,
+    SER_CAS_WRITE,
+    SER_RMW_STATUS,
+    SER_WAIT_TIMEOUT,
+    SER_WAIT_MASK,
+    SER_WAIT_VALUE,
+    SER_WAIT_READ,
+    SER_WAIT_WAIT,
+    SER_WAIT_CMP,
+    SER_WAIT_CHECK,
+    SER_WAIT_DATA,
+    SER_STREAM_RING,
+    SER_STREAM_INTERVAL,
+    SER_STREAM_START,
     SER_DISCARD
   } serial_state, next_serial_state;
 
@@ -83,6 +136,67 @@ module axi_over_ethernet (
 
   logic rx_discard, rx_ignore_pad;
 
+  // read-modify-write
+  logic       rmw_latch_a;
+  logic       rmw_compare;
+  logic       rmw_clear;
+  logic [7:0] rmw_a;
+  logic       rmw_mismatch;
+  logic       rx_eof_seen;
+  logic [CAS_MAX_LEN*8-1:0] cas_buf;
+  logic [2:0] cas_cnt;
+
+  // poll until (value & mask) == expected or timeout
+  logic update_wait_timeout;
+  logic update_wait_mask;
+  logic update_wait_value;
+  logic wait_compare;
+  logic [31:0] wait_timeout;
+  logic [WAIT_MAX_LEN*8-1:0] wait_mask;
+  logic [WAIT_MAX_LEN*8-1:0] wait_value;
+  logic [WAIT_MAX_LEN*8-1:0] wait_buf;
+
+  // BATCH: sub-operations run back to back, their responses are concatenated into one frame
+  logic       batch;
+  logic       batch_start;
+  logic       batch_next;
+  logic       batch_last;
+  logic [7:0] batch_cnt;
+
+  assign batch_last = ~batch || ~|batch_cnt;
+
+  // STREAM: push a STREAM_DATA frame every stream_interval us until cancelled
+  // a ring region is read a chunk at a time, wrapping at stream_ring_len, ring length 0 reads a FIFO address
+  logic        update_stream_ring;
+  logic        update_stream_interval;
+  logic        stream_start;
+  logic        stream_frame;
+  logic        stream_due;
+  logic        stream_hold;
+  logic        stream_active;
+  logic [15:0] stream_seq; // request that started the stream, a retransmission doesn't restart it
+  logic [31:0] stream_base;
+  logic [15:0] stream_len;
+  logic [31:0] stream_ring_len;
+  logic [31:0] stream_offset;
+  logic [31:0] stream_interval;
+  logic [31:0] stream_timer;
+  logic [15:0] stream_cnt;
+
+  assign stream_due = stream_active && ~|stream_timer;
+  // reading a FIFO, every byte comes from the same address
+  assign stream_hold = (opcode == OP_STREAM_DATA) && ~|stream_ring_len;
+
+  logic [$clog2(CLK_FREQ_MHZ)-1:0] us_cnt;
+  logic us_tick;
+
+  assign us_tick = (us_cnt == CLK_FREQ_MHZ - 1);
+
+  always_ff @(posedge clk) begin
+    if (reset || us_tick) us_cnt <= 0;
+    else                  us_cnt <= us_cnt + 1;
+  end
+
 
   always_ff @(posedge clk) begin
     if (reset) serial_state <= SER_IDLE;
@@ -94,18 +208,92 @@ module axi_over_ethernet (
 
     if (update_opcode)
       opcode <= opcode_t'(rx_data);
+    else if (stream_frame)
+      opcode <= OP_STREAM_DATA;
     if (update_seq_num)
       seq_num[idx*8+:8] <= rx_data;
+    else if (stream_frame)
+      seq_num <= stream_cnt;
 
     if (update_payload_len)
       payload_len[idx*8+:8] <= rx_data;
+    else if (stream_frame)
+      payload_len <= stream_len;
     else if (payload_len_decr)
       payload_len <= payload_len - 1;
     
     if (update_address)
       address[idx*8+:8] <= rx_data;
-    else if (address_incr)
+    else if (stream_frame)
+      address <= stream_base + stream_offset;
+    else if (address_incr && ~stream_hold)
       address <= address + 1;
+
+    if (rmw_latch_a)
+      rmw_a <= rx_data;
+
+    if (rmw_clear) begin
+      rmw_mismatch <= 0;
+      cas_cnt <= 0;
+    end else if (rmw_compare) begin
+      rmw_mismatch <= rmw_mismatch || (ram_r_data != rmw_a);
+      cas_buf <= {cas_buf[CAS_MAX_LEN*8-9:0], rx_data};
+      cas_cnt <= cas_cnt + 1;
+    end else if (wait_compare) begin
+      rmw_mismatch <= rmw_mismatch || ((ram_r_data & wait_mask[idx*8+:8]) != wait_value[idx*8+:8]);
+    end
+
+    if (update_wait_timeout)
+      wait_timeout[idx*8+:8] <= rx_data;
+    else if (us_tick && |wait_timeout)
+      wait_timeout <= wait_timeout - 1;
+    if (update_wait_mask)
+      wait_mask[idx*8+:8] <= rx_data;
+    if (update_wait_value)
+      wait_value[idx*8+:8] <= rx_data;
+    if (wait_compare)
+      wait_buf[idx*8+:8] <= ram_r_data;
+    // whether the rest of the request frame still has to be discarded
+    if (serial_state == SER_OP)
+      rx_eof_seen <= 0;
+    else if (rx_ready && rx_valid && rx_eof)
+      rx_eof_seen <= 1;
+
+    if (serial_state == SER_OP || stream_frame) begin
+      batch <= 0;
+    end else if (batch_start) begin
+      batch <= 1;
+      batch_cnt <= rx_data;
+    end else if (batch_next) begin
+      batch_cnt <= batch_cnt - 1;
+    end
+  end
+
+  always_ff @(posedge clk) begin
+    if (update_stream_ring)
+      stream_ring_len[idx*8+:8] <= rx_data;
+    if (update_stream_interval)
+      stream_interval[idx*8+:8] <= rx_data;
+
+    if (reset) begin
+      stream_active <= 0;
+    end else if (stream_start && ~(stream_active && seq_num == stream_seq)) begin
+      // a zero length request cancels the stream
+      stream_active <= |payload_len;
+      stream_seq <= seq_num;
+      stream_base <= address;
+      stream_len <= payload_len;
+      stream_offset <= 0;
+      stream_timer <= 0;
+      stream_cnt <= 0;
+    end else if (stream_frame) begin
+      stream_cnt <= stream_cnt + 1;
+      stream_timer <= stream_interval;
+      if (|stream_ring_len)
+        stream_offset <= (stream_offset + stream_len >= stream_ring_len) ? 0 : stream_offset + stream_len;
+    end else if (us_tick && |stream_timer) begin
+      stream_timer <= stream_timer - 1;
+    end
   end
 
   always_ff @(posedge clk) begin
@@ -129,19 +317,39 @@ module axi_over_ethernet (
     tx_valid = 0;
     tx_data = 0;
     tx_eof = 0;
+    rmw_latch_a = 0;
+    rmw_compare = 0;
+    rmw_clear = 0;
+    batch_start = 0;
+    batch_next = 0;
+    update_wait_timeout = 0;
+    update_wait_mask = 0;
+    update_wait_value = 0;
+    wait_compare = 0;
+    update_stream_ring = 0;
+    update_stream_interval = 0;
+    stream_start = 0;
+    stream_frame = 0;
 
     // temp
     ram_addr = 0;
     ram_we = 0;
+    ram_w_data = rx_data;
 
     case (serial_state)
+      // requests go ahead of stream frames, so a cancel always gets through
       SER_IDLE : begin
-        if (rx_valid)
+        if (rx_valid) begin
           next_serial_state = SER_OP;
+        end else if (stream_due) begin
+          stream_frame = 1;
+          next_serial_state = SER_READ_RSP_OP;
+        end
       end
       
       SER_OP : begin
         rx_ready = 1;
+        rmw_clear = 1;
         update_opcode = 1;
         next_idx = 1;
         next_serial_state = SER_SEQ_NUM;
@@ -152,7 +360,7 @@ module axi_over_ethernet (
         update_seq_num = 1;
         if (idx == 0) begin
           next_idx = 3;
-          next_serial_state = SER_ADDR;
+          next_serial_state = (opcode == OP_BATCH) ? SER_BATCH_CNT : SER_ADDR;
         end else begin
           next_idx = idx - 1;
         end
@@ -175,7 +383,19 @@ module axi_over_ethernet (
         if (idx == 0) begin
           case (opcode)
             OP_WRITE : next_serial_state = SER_WRITE;
-            OP_READ : next_serial_state = SER_READ_RSP_OP;
+            OP_READ,
+            OP_MASKED_WRITE,
+            OP_SET_BITS,
+            OP_CLEAR_BITS,
+            OP_CAS : next_serial_state = SER_READ_RSP_OP;
+            OP_WAIT : begin
+              next_idx = 3;
+              next_serial_state = SER_WAIT_TIMEOUT;
+            end
+            OP_STREAM : begin
+              next_idx = 3;
+              next_serial_state = SER_STREAM_RING;
+            end
             default : next_serial_state = SER_DISCARD;
           endcase
         end else begin
@@ -194,12 +414,14 @@ module axi_over_ethernet (
           next_serial_state = SER_WRITE_ACK;
       end
 
+      // inside a batch a write is acknowledged by the opcode alone
       SER_WRITE_ACK : begin
         tx_valid = 1;
-        tx_data = OP_WRITE_ACK;
+        tx_data = opcode | 8'h01; // WRITE_ACK or STREAM_ACK
+        tx_eof = batch && batch_last;
         if (tx_ready) begin
           next_idx = 1;
-          next_serial_state = SER_WRITE_ACK_SEQ;
+          next_serial_state = batch ? SER_BATCH_NEXT : SER_WRITE_ACK_SEQ;
         end
       end
 
@@ -208,7 +430,8 @@ module axi_over_ethernet (
         tx_data = seq_num[idx*8+:8];
         if (tx_ready) begin
           if (idx == 0) begin
-            next_serial_state = SER_IDLE;
+            // the padding after a stream request is still queued
+            next_serial_state = (opcode == OP_STREAM && ~rx_eof_seen) ? SER_DISCARD : SER_IDLE;
             tx_eof = 1;
           end else begin
             next_idx = idx - 1;
@@ -216,13 +439,25 @@ module axi_over_ethernet (
         end
       end
 
+      // responses to reads, RMW and WAIT requests share the same header
       SER_READ_RSP_OP : begin
-        rx_ignore_pad = 1;
-        tx_valid = 1;
-        tx_data = OP_READ_RSP;
-        if (tx_ready) begin
-          next_idx = 1;
-          next_serial_state = SER_READ_RSP_SEQ;
+        if (opcode == OP_READ) begin
+          rx_ignore_pad = ~batch; // the rest of a batch still has to be parsed
+          tx_valid = 1;
+          tx_data = OP_READ_RSP;
+        end else if (opcode == OP_STREAM_DATA) begin
+          tx_valid = 1;
+          tx_data = OP_STREAM_DATA;
+        end else if (opcode == OP_CAS && (payload_len > CAS_MAX_LEN || payload_len == 0)) begin
+          next_serial_state = batch ? SER_BATCH_ABORT : SER_DISCARD;
+        end else begin
+          tx_valid = 1;
+          tx_data = opcode | 8'h01;
+        end
+        // sub-responses in a batch share the batch's sequence number
+        if (tx_valid && tx_ready) begin
+          next_idx = batch ? 3 : 1;
+          next_serial_state = batch ? SER_READ_RSP_ADDR : SER_READ_RSP_SEQ;
         end
       end
 
@@ -256,7 +491,11 @@ module axi_over_ethernet (
         tx_valid = 1;
         tx_data = payload_len[idx*8+:8];
         if (tx_ready) begin
-          if (idx == 0) begin
+          if (idx == 0 && opcode == OP_WAIT) begin
+            next_serial_state = SER_WAIT_DATA;
+          end else if (idx == 0 && !(opcode inside {OP_READ, OP_STREAM_DATA})) begin
+            next_serial_state = SER_RMW_READ;
+          end else if (idx == 0) begin
             payload_len_decr = 1;
             address_incr = 1;
             ram_addr = address; // TEMP
@@ -284,8 +523,249 @@ module axi_over_ethernet (
       SER_READ_RSP_EOF : begin
         tx_valid = 1;
         tx_data = ram_r_data;
+        tx_eof = batch_last;
+        next_serial_state = batch ? SER_BATCH_NEXT : SER_IDLE;
+      end
+
+      // RMW requests are processed a byte at a time: read the old byte, send it back,
+      // consume one (set/clear bits) or two (masked write, CAS) operand bytes and write the result
+      SER_RMW_READ : begin
+        ram_addr = address; // TEMP
+        next_serial_state = SER_RMW_WAIT;
+      end
+
+      SER_RMW_WAIT : begin
+        ram_addr = address; // TEMP
+        next_serial_state = SER_RMW_A;
+      end
+
+      SER_RMW_A : begin
+        ram_addr = address; // TEMP
+        tx_valid = 1;
+        tx_data = ram_r_data;
+        if (tx_ready) begin
+          rx_ready = 1;
+          case (opcode)
+            OP_SET_BITS : begin
+              ram_we = 1;
+              ram_w_data = ram_r_data | rx_data;
+            end
+            OP_CLEAR_BITS : begin
+              ram_we = 1;
+              ram_w_data = ram_r_data & ~rx_data;
+            end
+            default : rmw_latch_a = 1;
+          endcase
+
+          if (opcode inside {OP_MASKED_WRITE, OP_CAS}) begin
+            next_serial_state = SER_RMW_B;
+          end else begin
+            payload_len_decr = 1;
+            address_incr = 1;
+            next_serial_state = (payload_len == 1) ? SER_RMW_STATUS : SER_RMW_READ;
+          end
+        end
+      end
+
+      // rmw_a is the data (masked write) or the expected value (CAS), rx_data the mask or the new value
+      SER_RMW_B : begin
+        ram_addr = address; // TEMP
+        rx_ready = 1;
+        payload_len_decr = 1;
+        address_incr = 1;
+        if (opcode == OP_MASKED_WRITE) begin
+          ram_we = 1;
+          ram_w_data = (ram_r_data & ~rx_data) | (rmw_a & rx_data);
+          next_serial_state = (payload_len == 1) ? SER_RMW_STATUS : SER_RMW_READ;
+        end else begin
+          rmw_compare = 1;
+          next_idx = cas_cnt;
+          next_serial_state = (payload_len == 1) ? SER_CAS_WRITE : SER_RMW_READ;
+        end
+      end
+
+      // address now points just past the operand, cas_buf holds the new value, first byte highest
+      SER_CAS_WRITE : begin
+        ram_we = ~rmw_mismatch;
+        ram_addr = address - idx - 1; // TEMP
+        ram_w_data = cas_buf[idx*8+:8];
+        if (idx == 0)
+          next_serial_state = SER_RMW_STATUS;
+        else
+          next_idx = idx - 1;
+      end
+
+      // trailing status byte, 1 if the write was applied
+      SER_RMW_STATUS : begin
+        tx_valid = 1;
+        tx_data = {7'b0, ~rmw_mismatch};
+        tx_eof = batch_last;
+        if (tx_ready)
+          next_serial_state = batch ? SER_BATCH_NEXT : rx_eof_seen ? SER_IDLE : SER_DISCARD;
+      end
+
+      // WAIT: timeout (us), then (mask, value) byte pairs
+      SER_WAIT_TIMEOUT : begin
+        rx_ready = 1;
+        update_wait_timeout = 1;
+        if (idx == 0) begin
+          if (payload_len > WAIT_MAX_LEN || payload_len == 0)
+            next_serial_state = batch ? SER_BATCH_ABORT : SER_DISCARD;
+          else
+            next_serial_state = SER_WAIT_MASK;
+        end else begin
+          next_idx = idx - 1;
+        end
+      end
+
+      SER_WAIT_MASK : begin
+        rx_ready = 1;
+        update_wait_mask = 1;
+        next_serial_state = SER_WAIT_VALUE;
+      end
+
+      SER_WAIT_VALUE : begin
+        rx_ready = 1;
+        update_wait_value = 1;
+        if (idx == payload_len - 1) begin
+          next_idx = 0;
+          next_serial_state = SER_WAIT_READ;
+        end else begin
+          next_idx = idx + 1;
+          next_serial_state = SER_WAIT_MASK;
+        end
+      end
+
+      // the rest of the request stays in the RX buffer until the poll is done, see SER_RMW_STATUS
+      SER_WAIT_READ : begin
+        ram_addr = address + idx; // TEMP
+        next_serial_state = SER_WAIT_WAIT;
+      end
+
+      SER_WAIT_WAIT : begin
+        ram_addr = address + idx; // TEMP
+        next_serial_state = SER_WAIT_CMP;
+      end
+
+      SER_WAIT_CMP : begin
+        ram_addr = address + idx; // TEMP
+        wait_compare = 1;
+        if (idx == payload_len - 1) begin
+          next_serial_state = SER_WAIT_CHECK;
+        end else begin
+          next_idx = idx + 1;
+          next_serial_state = SER_WAIT_READ;
+        end
+      end
+
+      SER_WAIT_CHECK : begin
+        next_idx = 0;
+        if (~rmw_mismatch || ~|wait_timeout) begin
+          next_serial_state = SER_READ_RSP_OP;
+        end else begin
+          rmw_clear = 1;
+          next_serial_state = SER_WAIT_READ;
+        end
+      end
+
+      // last value read, then the status byte (1 if it matched)
+      SER_WAIT_DATA : begin
+        tx_valid = 1;
+        tx_data = wait_buf[idx*8+:8];
+        if (tx_ready) begin
+          if (idx == payload_len - 1) begin
+            next_serial_state = SER_RMW_STATUS;
+          end else begin
+            next_idx = idx + 1;
+          end
+        end
+      end
+
+      // STREAM: ring length, then interval (us), the address and length are the chunk to read
+      SER_STREAM_RING : begin
+        rx_ready = 1;
+        update_stream_ring = 1;
+        if (idx == 0) begin
+          next_idx = 3;
+          next_serial_state = SER_STREAM_INTERVAL;
+        end else begin
+          next_idx = idx - 1;
+        end
+      end
+
+      SER_STREAM_INTERVAL : begin
+        rx_ready = 1;
+        update_stream_interval = 1;
+        if (idx == 0)
+          next_serial_state = SER_STREAM_START;
+        else
+          next_idx = idx - 1;
+      end
+
+      SER_STREAM_START : begin
+        stream_start = 1;
+        next_serial_state = SER_WRITE_ACK;
+      end
+
+      // BATCH: count, then sub-operations without sequence numbers
+      SER_BATCH_CNT : begin
+        rx_ready = 1;
+        batch_start = 1;
+        next_serial_state = SER_BATCH_RSP_OP;
+      end
+
+      SER_BATCH_RSP_OP : begin
+        tx_valid = 1;
+        tx_data = OP_BATCH_RSP;
+        if (tx_ready) begin
+          next_idx = 1;
+          next_serial_state = SER_BATCH_RSP_SEQ;
+        end
+      end
+
+      SER_BATCH_RSP_SEQ : begin
+        tx_valid = 1;
+        tx_data = seq_num[idx*8+:8];
+        if (tx_ready) begin
+          if (idx == 0)
+            next_serial_state = (batch_cnt == 0) ? SER_BATCH_ABORT : SER_BATCH_NEXT;
+          else
+            next_idx = idx - 1;
+        end
+      end
+
+      SER_BATCH_NEXT : begin
+        if (batch_cnt == 0)
+          next_serial_state = rx_eof_seen ? SER_IDLE : SER_DISCARD;
+        else
+          next_serial_state = SER_BATCH_SUB_OP;
+      end
+
+      SER_BATCH_SUB_OP : begin
+        rx_ready = 1;
+        update_opcode = 1;
+        rmw_clear = 1;
+        batch_next = 1;
+        next_idx = 3;
+        case (opcode_t'(rx_data))
+          OP_WRITE,
+          OP_READ,
+          OP_MASKED_WRITE,
+          OP_SET_BITS,
+          OP_CLEAR_BITS,
+          OP_CAS,
+          OP_WAIT : next_serial_state = SER_ADDR;
+          default : next_serial_state = SER_BATCH_ABORT;
+        endcase
+      end
+
+      // the response frame is already open, close it with an ABORT marker
+      SER_BATCH_ABORT : begin
+        tx_valid = 1;
+        tx_data = OP_ABORT;
         tx_eof = 1;
-        next_serial_state = SER_IDLE;
+        if (tx_ready)
+          next_serial_state = rx_eof_seen ? SER_IDLE : SER_DISCARD;
       end
 
       SER_DISCARD : begin
@@ -301,6 +781,7 @@ module axi_over_ethernet (
 
   logic          ram_we;
   logic [14-1:0] ram_addr;
+  logic [7:0]    ram_w_data;
   logic [7:0]    ram_r_data, ram_r_data2;
 
 
@@ -310,7 +791,7 @@ module axi_over_ethernet (
 
   always_ff @(posedge clk) begin
     if (ram_we)
-      ram[ram_addr] <= rx_data;
+      ram[ram_addr] <= ram_w_data;
     ram_r_data2 <= ram[ram_addr];
   end 
   always_ff @(posedge clk) begin
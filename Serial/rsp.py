@@ -30,171 +30,1038 @@
 # len (2 bytes)
 # payload (len bytes)
 
+## read-modify-write (masked write, set bits, clear bits, compare-and-swap):
+# opcode (rmw)
+# seqnum (2 byte)
+# address (4 byte)
+# len (2 bytes)
+# operands (len bytes for set/clear bits, len (a, b) byte pairs for masked write (data, mask) and CAS (expected, new))
+
+## read-modify-write response
+# opcode (rmw | 1)
+# seqnum (2 byte)
+# address (4 byte)
+# len (2 bytes)
+# old data (len bytes)
+# status (1 byte, 1 if the write was applied, only ever 0 for a failed CAS)
+
+## wait:
+# opcode (wait)
+# seqnum (2 byte)
+# address (4 byte)
+# len (2 bytes)
+# timeout (4 bytes, microseconds)
+# len (mask, value) byte pairs
+
+## wait response
+# opcode (wait rsp)
+# seqnum (2 byte)
+# address (4 byte)
+# len (2 bytes)
+# last value read (len bytes)
+# status (1 byte, 1 if (value & mask) == expected, 0 on timeout)
+
+## batch:
+# opcode (batch)
+# seqnum (2 byte)
+# count (1 byte)
+# count sub-operations, each a write/read/rmw/wait request without its seqnum
+
+## batch response
+# opcode (batch rsp)
+# seqnum (2 byte)
+# one sub-response per sub-operation, in order, each without its seqnum
+# (a write is acknowledged by its opcode alone, an abort opcode ends the list early)
+
+## stream:
+# opcode (stream)
+# seqnum (2 byte)
+# address (4 byte)
+# len (2 bytes, chunk length, 0 cancels the running stream)
+# ring len (4 bytes, chunks wrap back to address at this offset, 0 reads len bytes of a FIFO address)
+# interval (4 bytes, microseconds between chunks)
+
+## stream ack:
+# opcode (stream ack)
+# seqnum (2 byte)
+
+## stream data (pushed by the FPGA until the stream is cancelled)
+# opcode (stream data)
+# chunk count (2 byte, counts up from 0 for every new stream)
+# address (4 byte)
+# len (2 bytes)
+# payload (len bytes)
+
 
 
 import asyncio
+import bisect
+import concurrent.futures
+import ctypes
+import hashlib
+import json
+import os
+import queue
+import random
 import struct
-from socket import socket, htons, AF_PACKET, SOCK_RAW
+import threading
+import time
+from collections import deque
+from socket import socket, htons, AF_INET, AF_PACKET, AF_UNIX, SOCK_DGRAM, SOCK_RAW, SOCK_SEQPACKET, MSG_DONTWAIT, \
+                   SOL_SOCKET, SO_RCVTIMEO, CMSG_SPACE
 
 INTERFACE = "enp14s0"
 ETH_TYPE = 0x88B5
+# UDP encapsulation carries a frame without its ethernet header, one packet per datagram
+UDP_PORT = 0x88B5
+BROADCAST_MAC = 0xFFFFFFFFFFFF
+# where the axi_over_ethernet co-simulation bridge listens
+COSIM_SOCKET = "/tmp/rsp_cosim.sock"
+# retransmit interval (wall clock s) to use against the simulation, a window of frames through the RTL takes seconds
+COSIM_RTD = 30
 
 OPCODE = {
     "WRITE": 0x10,
     "WRITE_ACK": 0x11,
     "READ": 0x20,
     "READ_RSP": 0x21,
+    "MASKED_WRITE": 0x30,
+    "MASKED_WRITE_RSP": 0x31,
+    "SET_BITS": 0x40,
+    "SET_BITS_RSP": 0x41,
+    "CLEAR_BITS": 0x50,
+    "CLEAR_BITS_RSP": 0x51,
+    "CAS": 0x60,
+    "CAS_RSP": 0x61,
+    "WAIT": 0x70,
+    "WAIT_RSP": 0x71,
+    "BATCH": 0x80,
+    "BATCH_RSP": 0x81,
+    "STREAM": 0x90,
+    "STREAM_ACK": 0x91,
+    "STREAM_DATA": 0x93,
+    "ABORT": 0x00,
 }
+RMW_OPCODES = (OPCODE["MASKED_WRITE"], OPCODE["SET_BITS"], OPCODE["CLEAR_BITS"], OPCODE["CAS"])
+# opcodes the FPGA sends back, everything else is dropped by the socket filter
+RESPONSE_OPCODES = (OPCODE["WRITE_ACK"], OPCODE["READ_RSP"], OPCODE["WAIT_RSP"], OPCODE["BATCH_RSP"],
+                    OPCODE["STREAM_ACK"], OPCODE["STREAM_DATA"]) + tuple(op | 1 for op in RMW_OPCODES)
 
 MAX_FRAME_SIZE = 1498
+MAX_PAYLOAD_LEN = MAX_FRAME_SIZE - 29
+MAX_PACKET_LEN = MAX_PAYLOAD_LEN + 9 # payload plus the write/read header
+# the FPGA buffers the new value of a compare-and-swap, so it is limited to one 32 bit word
+CAS_MAX_LEN = 4
+# likewise WAIT keeps its mask and value in registers
+WAIT_MAX_LEN = 4
+
+# send priority classes, lower goes first
+HIGH_PRIORITY = 0 # CSR sized accesses
+BULK_PRIORITY = 1 # multi-frame transfers, read-ahead
+# bulk reads keep at most this many of their own requests in flight
+READ_DEPTH = 2
+# read-ahead that no read has asked for yet is resent this many times, then given up (it may be past the end of memory)
+PREFETCH_RETRIES = 3
+
+# asm-generic/socket.h, linux/if_packet.h, linux/filter.h
+SO_TIMESTAMPNS = 35
+SO_ATTACH_FILTER = 26
+SOL_PACKET = 263
+PACKET_FANOUT = 18
+PACKET_FANOUT_DATA = 22
+PACKET_FANOUT_CBPF = 6
+PACKET_FANOUT_FLAG_UNIQUEID = 0x2000
+SKF_NET_OFF = -0x100000
+# netinet/udp.h
+SOL_UDP = 17
+UDP_SEGMENT = 103
+UDP_GRO = 104
+UDP_MAX_SEGMENTS = 64
+UDP_MAX_GSO_LEN = 65000
+BPF_LD_W_ABS = 0x20
+BPF_LD_H_ABS = 0x28
+BPF_LD_B_ABS = 0x30
+BPF_JEQ_K = 0x15
+BPF_RET_K = 0x06
+BPF_RET_A = 0x16
+
+# RX worker threads hand responses back to the event loop at most this many at a time
+RX_BATCH = 64
+# seconds a blocked RX worker waits before checking whether its socket was closed
+RX_POLL = 0.1
 
 
 class RSP:
-    def __init__(self, rtd = 0.5, src_mac=0x123456ABCDEF, dest_mac=0x0007ED123456, dump_sim=False):
+    def __init__(self, rtd = 0.5, src_mac=0x123456ABCDEF, dest_mac=0x0007ED123456, dump_sim=False, journal=None,
+                 queues=1, interface=INTERFACE, sock=None, tracer=None, prefetch=0, prefetch_limit=2**32, window=64,
+                 reserve=8, boards=None, group_mac=None, group_retries=10, udp=None):
         self.seq_num = 0
         self.unacked_packets = {}
+        self.responses = {}
+        # at most `window` requests in flight, the last `reserve` slots only go to high priority requests
+        self.window = window
+        self.reserve = reserve
+        self.in_flight = 0
+        self.waiting = (deque(), deque()) # per priority class, FIFO
         self.rtd = rtd
         self.src_mac = src_mac.to_bytes(6)
         self.dest_mac = dest_mac.to_bytes(6)
+        # boards addressed by write_group, all of them receive frames sent to group_mac
+        # (a multicast address only they listen to, every FPGA on the segment would run a broadcast write)
+        self.boards = [board.to_bytes(6) for board in boards] if boards else [self.dest_mac]
+        self.group_mac = group_mac.to_bytes(6) if group_mac is not None else None
+        self.group_pending = {} # seq_num -> boards that haven't ACKed it yet
+        # unicast retransmissions to a board before write_group gives up on it
+        self.group_retries = group_retries
         self.dump_sim = dump_sim
-        self.rx_buffer ={}
+        # optional checkpoint journal for resumable transfers
+        if isinstance(journal, str):
+            journal = RSPJournal(journal)
+        self.journal = journal
+        # optional per-transaction latency tracer (see rsp_trace.py)
+        self.tracer = tracer
+        # sequential read-ahead, number of chunks kept in flight past the last read, never past prefetch_limit
+        # (the end of the readable address range, the FPGA doesn't answer reads beyond it)
+        self.prefetch = prefetch
+        self.prefetch_limit = prefetch_limit
+        self.prefetched = {} # chunk address -> (chunk len, seq_num, response future)
+        self.speculative = {} # seq_num -> chunk address, read-ahead requests no read has taken yet
+        self.last_read = None
+        # the FPGA runs at most one stream at a time
+        self.active_stream = None
         # async loop
         self.loop = asyncio.get_event_loop()
-        self.rx_event = asyncio.Event()
-        if not self.dump_sim:
+        self.rx_workers = []
+        self.sock = sock
+        self.own_sock = sock is None # a caller supplied socket is closed by its owner
+        # UDP transport, datagrams queued this loop iteration go out together as one GSO send
+        self.udp = udp is not None
+        self.udp_gso = True
+        self.udp_pending = []
+        if self.udp:
+            # (host, port), doesn't need CAP_NET_RAW and can be routed, eg. to LocalEndpoint(udp=True)
+            self.sock = socket(AF_INET, SOCK_DGRAM)
+            self.sock.connect(udp)
+            self.sock.setblocking(False)
+            self.sock.setsockopt(SOL_UDP, UDP_GRO, 1)
+            self._enable_timestamps(self.sock)
+            self.loop.add_reader(self.sock.fileno(), self._receive_udp)
+        elif sock is not None:
+            # caller supplied transport (eg. LocalEndpoint.host_sock)
+            self.sock.setblocking(False)
+            self._enable_timestamps(self.sock)
+            self.loop.add_reader(self.sock.fileno(), self._receive)
+        elif not self.dump_sim and queues > 1:
+            # send-only socket, responses are spread across a fanout group of RX queues
+            self.sock = socket(AF_PACKET, SOCK_RAW, 0)
+            self.sock.bind((interface, 0))
+            self.sock.setblocking(False)
+            self._open_rx_queues(interface, queues)
+        elif not self.dump_sim:
             # socket
-            self.sock = socket(AF_PACKET, SOCK_RAW, htons(ETH_TYPE))
-            self.sock.bind((INTERFACE, ETH_TYPE))
+            self.sock = self._open_rx_socket(interface)
             self.sock.setblocking(False)
             # register read handler
             self.loop.add_reader(self.sock.fileno(), self._receive)
-        
+
         #self.loop.create_task(self.debug_trigger())
 
+    def close(self):
+        """Stops the RX workers and retransmissions and closes the sockets RSP opened"""
+        # workers notice on their next recv, within RX_POLL
+        for sock, _ in self.rx_workers:
+            sock.close()
+        for _, worker in self.rx_workers:
+            worker.join()
+        self.rx_workers = []
+        for task in self.unacked_packets.values():
+            task.cancel()
+        if self.sock is not None and self.sock.fileno() >= 0:
+            self.loop.remove_reader(self.sock.fileno())
+            if self.own_sock:
+                self.sock.close()
+
+
     async def debug_trigger(self):
         await asyncio.sleep(10)
         print("bbb")
-        self.rx_event.set()
 
-    def write_data(self, address: int, data: bytes):
-        """Send packets to fpga, wait until they have all been acknowledged"""
-        self.loop.run_until_complete(self._write_data_async(address, data))
+    def write_data(self, address: int, data: bytes, resume: bool = False, spot_check: int = 0, priority: int = None):
+        """Send packets to fpga, wait until they have all been acknowledged
 
+        If a journal is attached, acknowledged address ranges are checkpointed as they complete.
+        resume=True skips ranges confirmed by an earlier, interrupted call with the same address and data,
+        after re-reading spot_check randomly chosen confirmed chunks to make sure they are still intact.
+        Transfers that fit in one frame default to HIGH_PRIORITY, they are sent ahead of any queued
+        bulk frames and may use the reserved part of the window, everything else is BULK_PRIORITY.
+        """
+        self.loop.run_until_complete(self._write_data_async(address, data, resume, spot_check, priority))
+
+
+    def read_data(self, address: int, byte_cnt: int, resume: bool = False, spot_check: int = 0, priority: int = None) -> bytes:
+        """Send read requests to fgpa, wait for data
 
-    def read_data(self, address: int, byte_cnt: int) -> bytes:
-        """Send read requests to fgpa, wait for data"""
-        data = self.loop.run_until_complete(self._read_data_async(address, byte_cnt))
+        If a journal is attached, received chunks are staged on disk next to the journal
+        so an interrupted download can be resumed (see write_data).
+        With prefetch enabled, a read that starts where the previous one ended requests the
+        next `prefetch` chunks (up to prefetch_limit) in the background, later reads are served from those responses.
+        """
+        data = self.loop.run_until_complete(self._read_data_async(address, byte_cnt, resume, spot_check, priority))
         return data
 
 
-    async def _write_data_async(self, address: int, data: bytes):
-        max_payload_len = MAX_FRAME_SIZE - 29
-        for payload in self.batch(data, max_payload_len):
-            frame = self._gen_frame(self._gen_write_packet(address, payload))
-            await self._send_frame(frame)
-            address += len(payload)
-            #await asyncio.sleep(0.001)
-
-        while self.unacked_packets:
-            await self.rx_event.wait()
-            self.rx_event.clear()
-        
-
-    async def _read_data_async(self, address: int, byte_cnt: int) -> bytes:
-        max_payload_len = MAX_FRAME_SIZE - 29
-        req_seqs = []
-        while byte_cnt:
-            req_len = min(byte_cnt, max_payload_len)
-            frame = self._gen_frame(self._gen_read_packet(address, req_len))
-            seq_num = await self._send_frame(frame)
-            req_seqs.append(seq_num)
-            byte_cnt -= req_len
-            address += req_len
-
-            while len(self.unacked_packets) > 2:
-                await asyncio.sleep(0.01)
-
-        # wait for all read responses (abusing sets bc im lazy)
-        missing_seq = set(req_seqs)
-        missing_seq -= self.rx_buffer.keys()
-        while missing_seq:
-            await self.rx_event.wait()
-            self.rx_event.clear()
-            missing_seq -= self.rx_buffer.keys()
-
-        # collect requested data
-        data = b''
-        for seq_num in req_seqs:
-            data += self.rx_buffer.pop(seq_num)
+    def write_group(self, address: int, data: bytes):
+        """Write the same data to every board in self.boards
+
+        Each chunk is sent once to group_mac and ACKed by every board individually.
+        A board that misses a frame gets it again unicast, the others aren't resent anything.
+        Raises TimeoutError if a board still hasn't ACKed a frame after group_retries resends.
+        """
+        self.loop.run_until_complete(self._write_group_async(address, data))
+
+
+    def masked_write(self, address: int, data: bytes, mask: bytes) -> bytes:
+        """Write only the bits set in mask, returns the old contents"""
+        return self.loop.run_until_complete(self._masked_write_async(address, data, mask))
+
+
+    def set_bits(self, address: int, bits: bytes) -> bytes:
+        """OR bits into memory, returns the old contents"""
+        return self.loop.run_until_complete(self._set_bits_async(address, bits))
+
+
+    def clear_bits(self, address: int, bits: bytes) -> bytes:
+        """Clear the bits set in bits, returns the old contents"""
+        return self.loop.run_until_complete(self._clear_bits_async(address, bits))
+
+
+    def compare_and_swap(self, address: int, expected: bytes, new: bytes) -> tuple:
+        """Write new only if memory still holds expected, returns (swapped, old contents)"""
+        return self.loop.run_until_complete(self._compare_and_swap_async(address, expected, new))
+
+
+    async def _masked_write_async(self, address: int, data: bytes, mask: bytes) -> bytes:
+        if len(data) != len(mask):
+            raise ValueError("data and mask must be the same length")
+        operands = bytes(b for pair in zip(data, mask) for b in pair)
+        return (await self._rmw_async(OPCODE["MASKED_WRITE"], address, len(data), operands))[0]
+
+
+    async def _set_bits_async(self, address: int, bits: bytes) -> bytes:
+        return (await self._rmw_async(OPCODE["SET_BITS"], address, len(bits), bits))[0]
+
+
+    async def _clear_bits_async(self, address: int, bits: bytes) -> bytes:
+        return (await self._rmw_async(OPCODE["CLEAR_BITS"], address, len(bits), bits))[0]
+
+
+    async def _compare_and_swap_async(self, address: int, expected: bytes, new: bytes) -> tuple:
+        if len(expected) != len(new):
+            raise ValueError("expected and new must be the same length")
+        if len(new) > CAS_MAX_LEN:
+            raise ValueError(f"compare-and-swap is limited to {CAS_MAX_LEN} bytes")
+        operands = bytes(b for pair in zip(expected, new) for b in pair)
+        old, status = await self._rmw_async(OPCODE["CAS"], address, len(new), operands)
+        return status, old
+
+
+    def submit(self, batch: "RSPBatch") -> list:
+        """Send a batch of operations in one frame, returns one result per operation (see RSPBatch)"""
+        return self.loop.run_until_complete(self._submit_async(batch))
+
+
+    async def _submit_async(self, batch: "RSPBatch") -> list:
+        if not batch.ops:
+            return []
+        for opcode, address, byte_cnt, _ in batch.ops:
+            if opcode != OPCODE["READ"] and opcode != OPCODE["WAIT"]:
+                self._invalidate_prefetch(address, address + byte_cnt)
+        return batch.parse(await self._batch_async(batch))
+
+
+    async def _batch_async(self, batch: "RSPBatch") -> bytes:
+        """Sends a non-empty batch, returns the response payload unparsed"""
+        rto = self.rtd + sum(int.from_bytes(body[:4]) / 1e6 for opcode, _, _, body in batch.ops if opcode == OPCODE["WAIT"])
+        _, rsp = await self._send_frame(self._gen_frame(self._gen_batch_packet(batch)), HIGH_PRIORITY, rto=rto)
+        return await rsp
+
+
+    def stream(self, address: int, byte_cnt: int, ring_len: int = 0, interval: float = 0.0) -> "RSPStream":
+        """Subscribe to chunks the FPGA pushes every interval seconds without being asked
+
+        The FPGA reads byte_cnt bytes at address + offset, offset stepping by byte_cnt and wrapping at
+        ring_len, so a capture buffer is swept over and over. ring_len=0 reads a FIFO address instead.
+        Iterate the returned RSPStream (for ... in, or async for) to get (chunk number, data), close() it to stop.
+        """
+        return self.loop.run_until_complete(self._stream_async(address, byte_cnt, ring_len, interval))
+
+
+    async def _stream_async(self, address: int, byte_cnt: int, ring_len: int = 0, interval: float = 0.0) -> "RSPStream":
+        if not 0 < byte_cnt <= MAX_PAYLOAD_LEN:
+            raise ValueError(f"stream chunks must be 1 to {MAX_PAYLOAD_LEN} bytes")
+        if ring_len % byte_cnt:
+            raise ValueError("ring length must be a multiple of the chunk length")
+        if self.active_stream is not None:
+            raise ValueError("a stream is already running, close it first")
+        # registered before the request goes out, the first chunk can overtake the ACK on another RX queue
+        self.active_stream = RSPStream(self, address, byte_cnt)
+        interval_us = min(int(interval * 1e6), 2 ** 32 - 1)
+        packet = self._gen_stream_packet(address, byte_cnt, ring_len, interval_us)
+        try:
+            _, ack = await self._send_frame(self._gen_frame(packet), HIGH_PRIORITY)
+            await ack
+        except BaseException:
+            self.active_stream = None
+            raise
+        return self.active_stream
+
+
+    async def _stream_cancel_async(self):
+        packet = self._gen_stream_packet(0, 0, 0, 0)
+        _, ack = await self._send_frame(self._gen_frame(packet), HIGH_PRIORITY)
+        await ack
+        self.active_stream = None
+
+
+    def wait_for(self, address: int, mask: bytes, value: bytes, timeout: float) -> tuple:
+        """Let the FPGA poll address until (contents & mask) == value, or timeout seconds pass
+
+        Nothing goes over the link while it waits, but the FPGA doesn't serve any other requests either.
+        Returns (matched, last value read).
+        """
+        return self.loop.run_until_complete(self._wait_for_async(address, mask, value, timeout))
+
+
+    async def _wait_for_async(self, address: int, mask: bytes, value: bytes, timeout: float) -> tuple:
+        if len(mask) != len(value):
+            raise ValueError("mask and value must be the same length")
+        if len(mask) > WAIT_MAX_LEN:
+            raise ValueError(f"wait is limited to {WAIT_MAX_LEN} bytes")
+        timeout_us = min(int(timeout * 1e6), 2 ** 32 - 1)
+        operands = bytes(b for pair in zip(mask, value) for b in pair)
+        packet = self._gen_wait_packet(address, len(mask), timeout_us, operands)
+        # don't retransmit while the FPGA is still legitimately polling
+        _, rsp = await self._send_frame(self._gen_frame(packet), HIGH_PRIORITY, rto=timeout_us / 1e6 + self.rtd)
+        payload = await rsp
+        return payload[len(mask):] == b"\x01", payload[:len(mask)]
+
+
+    async def _rmw_async(self, opcode: int, address: int, byte_cnt: int, operands: bytes) -> tuple:
+        """Sends one read-modify-write request, returns (old data, applied)"""
+        if len(operands) > MAX_PAYLOAD_LEN:
+            raise ValueError(f"{byte_cnt} byte read-modify-write doesn't fit in one frame")
+        self._invalidate_prefetch(address, address + byte_cnt)
+        frame = self._gen_frame(self._gen_rmw_packet(opcode, address, byte_cnt, operands))
+        _, rsp = await self._send_frame(frame, HIGH_PRIORITY)
+        payload = await rsp
+        return payload[:byte_cnt], payload[byte_cnt:] == b"\x01"
+
+
+    async def _write_data_async(self, address: int, data: bytes, resume: bool = False, spot_check: int = 0,
+                                priority: int = None):
+        if priority is None:
+            priority = self._default_priority(len(data))
+        tid = None
+        ranges = [(address, address + len(data))]
+        if self.journal is not None:
+            tid = self.journal.transfer_id("write", address, len(data), hashlib.blake2b(data).hexdigest())
+            if resume:
+                await self._spot_check(tid, address, spot_check, lambda start, end: data[start-address:end-address])
+                ranges = self.journal.missing(tid, address, address + len(data))
+            else:
+                self.journal.discard(tid)
+
+        self._invalidate_prefetch(address, address + len(data))
+        acks = []
+        try:
+            for start, end in ranges:
+                for chunk_addr, chunk_len in self.chunk_range(start, end):
+                    payload = data[chunk_addr-address:chunk_addr-address+chunk_len]
+                    frame = self._gen_frame(self._gen_write_packet(chunk_addr, payload))
+                    _, ack = await self._send_frame(frame, priority)
+                    if tid is not None:
+                        ack.add_done_callback(self._checkpoint(tid, address, chunk_addr, chunk_len))
+                    acks.append(ack)
+                    #await asyncio.sleep(0.001)
+
+            await asyncio.gather(*acks)
+        except BaseException:
+            self._abandon(acks)
+            raise
+        if tid is not None:
+            self.journal.finish(tid)
+
+
+    async def _write_group_async(self, address: int, data: bytes):
+        if self.group_mac is None:
+            raise ValueError("write_group needs the boards' multicast address, RSP(group_mac=...)")
+        self._invalidate_prefetch(address, address + len(data))
+        acks = []
+        try:
+            for chunk_addr, chunk_len in self.chunk_range(address, address + len(data)):
+                payload = data[chunk_addr-address:chunk_addr-address+chunk_len]
+                frame = self._gen_frame(self._gen_write_packet(chunk_addr, payload), self.group_mac)
+                _, ack = await self._send_frame(frame, BULK_PRIORITY, self.boards)
+                acks.append(ack)
+
+            await asyncio.gather(*acks)
+        except BaseException:
+            self._abandon(acks)
+            raise
+
+
+    async def _read_data_async(self, address: int, byte_cnt: int, resume: bool = False, spot_check: int = 0,
+                               priority: int = None) -> bytes:
+        if priority is None:
+            priority = self._default_priority(byte_cnt)
+        tid = None
+        ranges = [(address, address + byte_cnt)]
+        if self.journal is not None:
+            tid = self.journal.transfer_id("read", address, byte_cnt)
+            if not resume:
+                self.journal.discard(tid)
+            self.journal.stage(tid, byte_cnt)
+            if resume:
+                staged = lambda start, end: self.journal.load(tid, start - address, end - start)
+                await self._spot_check(tid, address, spot_check, staged)
+                ranges = self.journal.missing(tid, address, address + byte_cnt)
+
+        sequential = self.last_read == address
+
+        reqs = []
+        oldest = 0 # first response of this transfer still outstanding
+        try:
+            for start, end in ranges:
+                for chunk_addr, chunk_len in self.chunk_range(start, end):
+                    rsp = self._take_prefetched(chunk_addr, chunk_len)
+                    if rsp is None:
+                        frame = self._gen_frame(self._gen_read_packet(chunk_addr, chunk_len))
+                        _, rsp = await self._send_frame(frame, priority)
+                    if tid is not None:
+                        rsp.add_done_callback(self._checkpoint(tid, address, chunk_addr, chunk_len, staged=True))
+                    reqs.append(rsp)
+
+                    # only count our own requests, so concurrent transfers don't stall each other
+                    while len(reqs) - oldest > READ_DEPTH:
+                        if reqs[oldest].done():
+                            oldest += 1
+                        else:
+                            await asyncio.sleep(0.01)
+
+            if self.prefetch and sequential and byte_cnt:
+                await self._read_ahead(address + byte_cnt, byte_cnt)
+
+            # wait for all read responses and collect requested data
+            data = b"".join(await asyncio.gather(*reqs))
+        except BaseException:
+            self._abandon(reqs)
+            raise
+        # only a read that went through moves the sequential position on
+        self.last_read = address + byte_cnt
+        if tid is not None:
+            data = self.journal.load(tid, 0, byte_cnt)
+            self.journal.finish(tid)
         return data
 
 
-    async def _send_frame(self, frame):
-        print(f"Transmitting packet {self.seq_num}")
+    async def _read_ahead(self, address: int, byte_cnt: int):
+        """Keeps the first self.prefetch chunks of the next reads of byte_cnt bytes from address requested
+
+        They are chunked just like those reads will be, so every chunk is an exact hit.
+        """
+        chunks = []
+        start = address
+        while len(chunks) < self.prefetch and start < self.prefetch_limit:
+            end = min(start + byte_cnt, self.prefetch_limit)
+            chunks += self.chunk_range(start, end)
+            start = end
+        chunks = chunks[:self.prefetch]
+
+        # keep what is already requested, anything else was skipped over
+        for start in [s for s, (length, *_) in self.prefetched.items() if (s, length) not in chunks]:
+            self._drop_prefetch(start)
+        for chunk_addr, length in chunks:
+            if chunk_addr in self.prefetched:
+                continue
+            frame = self._gen_frame(self._gen_read_packet(chunk_addr, length))
+            seq_num, rsp = await self._send_frame(frame, BULK_PRIORITY)
+            self.prefetched[chunk_addr] = (length, seq_num, rsp)
+            self.speculative[seq_num] = chunk_addr
+
+
+    def _take_prefetched(self, address: int, byte_cnt: int):
+        """Returns the read-ahead response for exactly [address, address + byte_cnt), if there is one
+
+        The request is the caller's from then on, cancelling the response drops it.
+        """
+        length, seq_num, rsp = self.prefetched.get(address, (None, None, None))
+        if length != byte_cnt:
+            return None
+        del self.prefetched[address]
+        self.speculative.pop(seq_num, None) # wanted now, retransmitted for as long as it takes
+        return rsp
+
+
+    def _invalidate_prefetch(self, start: int, end: int):
+        """Drops read-ahead data overlapping a write"""
+        for s in [s for s, (length, *_) in self.prefetched.items() if s < end and start < s + length]:
+            self._drop_prefetch(s)
+
+
+    def _drop_prefetch(self, start: int):
+        """Forgets a read-ahead chunk and its request, if that hasn't been answered yet"""
+        _, seq_num, rsp = self.prefetched.pop(start)
+        self._drop_request(seq_num, rsp)
+        rsp.cancel()
+
+
+    def _abandon(self, responses: list):
+        """Cancels the requests of a transfer that failed or was cancelled, nobody will wait for the rest"""
+        for response in responses:
+            response.cancel() # dropped by the callback _send_frame put on it
+
+
+    def _drop_request(self, seq_num: int, response=None):
+        """Stops retransmitting a request nobody is waiting for anymore, frees its window slot
+
+        With response given, only if seq_num still belongs to it (it may have wrapped round to a newer request).
+        """
+        if response is not None and self.responses.get(seq_num) is not response:
+            return
+        task = self.unacked_packets.pop(seq_num, None)
+        if task is None:
+            return # already answered
+        task.cancel()
+        self.responses.pop(seq_num, None)
+        self.group_pending.pop(seq_num, None)
+        self.speculative.pop(seq_num, None)
+        self._release_slot()
+        if self.tracer is not None:
+            self.tracer.dropped(seq_num)
+
+
+    async def _spot_check(self, tid, base: int, count: int, expected):
+        """Re-read up to count confirmed chunks of a journaled transfer, forgetting any that don't match"""
+        if not count:
+            return
+        chunks = [c for start, end in self.journal.confirmed(tid) for c in self.chunk_range(start + base, end + base)]
+        for chunk_addr, chunk_len in random.sample(chunks, min(count, len(chunks))):
+            frame = self._gen_frame(self._gen_read_packet(chunk_addr, chunk_len))
+            _, rsp = await self._send_frame(frame, BULK_PRIORITY)
+            if await rsp != expected(chunk_addr, chunk_addr + chunk_len):
+                print(f"Spot check failed at {chunk_addr:#x}, resending {chunk_len} bytes")
+                self.journal.revoke(tid, chunk_addr - base, chunk_addr - base + chunk_len)
+
+
+    def _checkpoint(self, tid, base: int, address: int, byte_cnt: int, staged: bool = False):
+        """Returns a callback that records a completed chunk in the journal"""
+        def callback(rsp):
+            if rsp.cancelled():
+                return
+            if staged:
+                self.journal.store(tid, address - base, rsp.result())
+            else:
+                self.journal.confirm(tid, address - base, address - base + byte_cnt)
+        return callback
+
+
+    def _default_priority(self, byte_cnt: int) -> int:
+        return HIGH_PRIORITY if byte_cnt <= MAX_PAYLOAD_LEN else BULK_PRIORITY
+
+
+    async def _acquire_slot(self, priority: int):
+        """Waits for a free slot in the send window
+
+        Requests are granted in FIFO order within a class, and high priority requests
+        are always granted before bulk ones. Bulk requests can't take the reserved slots.
+        """
+        if not any(self.waiting[:priority + 1]) and self.in_flight < self._limit(priority):
+            self.in_flight += 1
+            return
+        waiter = self.loop.create_future()
+        self.waiting[priority].append(waiter)
+        try:
+            await waiter # slot is counted by _release_slot when it grants it
+        except asyncio.CancelledError:
+            if waiter in self.waiting[priority]:
+                self.waiting[priority].remove(waiter)
+            elif not waiter.cancelled():
+                self._release_slot() # granted after all, pass it on
+            raise
+
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        for priority, waiting in enumerate(self.waiting):
+            while waiting and self.in_flight < self._limit(priority):
+                waiter = waiting.popleft()
+                if not waiter.done():
+                    self.in_flight += 1
+                    waiter.set_result(None)
+            if waiting:
+                break # lower classes wait behind this one
+
+
+    def _limit(self, priority: int) -> int:
+        return self.window if priority == HIGH_PRIORITY else self.window - self.reserve
+
+
+    async def _send_frame(self, frame, priority: int = BULK_PRIORITY, boards: list = None, rto: float = None):
+        """Sends a request, returns its sequence number and a future for the response
+
+        With boards given the frame is a group request, it completes once every board has responded.
+        rto overrides the retransmit interval (self.rtd) for requests the FPGA takes a while to answer.
+        """
+        if not self.dump_sim:
+            await self._acquire_slot(priority)
+        seq_num = self.seq_num
+        # other requests may have been sent while we waited for a slot, restamp the sequence number
+        frame = frame[:15] + seq_num.to_bytes(2) + frame[17:]
+        print(f"Transmitting packet {seq_num}")
+        response = self.loop.create_future()
+
+        # increment seq_num
+        self.seq_num += 1
+        if self.seq_num >= 2 ** 16:
+            self.seq_num = 0
+
         if self.dump_sim:
             frame += self.compute_crc32(frame)
             ff = ", ".join([f"{i:#04x}" for i in list(frame)])
             with open("stim.dump", "w") as stim:
                 stim.write(f"[{ff}]\n")
+            response.set_result(b"")
         else:
-            await self.loop.sock_sendall(self.sock, frame)
-            # Put packet in retransmit queue
-            task = self.loop.create_task(self._retransmit_packet(self.seq_num, frame))
-            self.unacked_packets[self.seq_num] = task
-        
-        # increment seq_num
-        prev_seq_num = self.seq_num
-        self.seq_num += 1
-        if self.seq_num > 2 ** 16:
-            self.seq_num = 0
-        return prev_seq_num
+            if self.tracer is not None:
+                self.tracer.begin(seq_num, frame[14], len(frame))
+            # Put packet in retransmit queue before it can be answered
+            if boards:
+                self.group_pending[seq_num] = set(boards)
+                task = self.loop.create_task(self._retransmit_group(seq_num, frame))
+            else:
+                task = self.loop.create_task(self._retransmit_packet(seq_num, frame, rto or self.rtd))
+            self.unacked_packets[seq_num] = task
+            self.responses[seq_num] = response
+            # a caller that gives up on the response (cancelled) gives up the request too
+            response.add_done_callback(lambda r: r.cancelled() and self._drop_request(seq_num, r))
+            try:
+                if self.udp:
+                    self._send_udp(frame) # stamped sent once the datagram has actually gone out, in _flush_udp
+                else:
+                    await self.loop.sock_sendall(self.sock, frame)
+                    # after the send, so waiting on a full socket counts as host time, not wire/FPGA time
+                    if self.tracer is not None:
+                        self.tracer.sent(seq_num)
+            except BaseException:
+                self._drop_request(seq_num)
+                raise
+
+        return seq_num, response
 
 
     def _receive(self):
         """Receives a packet and decodes it"""
         try:
-            frame = self.sock.recv(65535)
+            frame, rx_time = self._recv(self.sock)
         except BlockingIOError:
-            pass
+            return
+
+        response = self._parse_frame(frame)
+        if response is not None:
+            self._on_response(*response, rx_time)
+
+
+    def _receive_udp(self):
+        """Receives whatever datagrams are queued, GRO may have merged several into one read"""
+        # the FPGA side of the tunnel is whoever the socket is connected to
+        header = self.src_mac + self.dest_mac + ETH_TYPE.to_bytes(2)
+        for _ in range(RX_BATCH):
+            try:
+                data, ancdata, _, _ = self.sock.recvmsg(65535, CMSG_SPACE(4) + CMSG_SPACE(16))
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+            segment = len(data)
+            rx_time = time.time_ns() if self.tracer is not None else None
+            for level, kind, cmsg in ancdata:
+                if level == SOL_UDP and kind == UDP_GRO:
+                    segment = struct.unpack("i", cmsg[:4])[0]
+                elif level == SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                    sec, nsec = struct.unpack("qq", cmsg)
+                    rx_time = sec * 1_000_000_000 + nsec
+            for offset in range(0, len(data), segment):
+                response = self._parse_frame(header + data[offset:offset+segment])
+                if response is not None:
+                    self._on_response(*response, rx_time)
+
+
+    def _send_udp(self, frame: bytes):
+        """Queues a frame's packet, the queue is flushed once the loop gets round to it"""
+        if not self.udp_pending:
+            self.loop.call_soon(self._flush_udp)
+        self.udp_pending.append(frame[14:])
+
 
+    def _flush_udp(self):
+        """Sends queued packets, runs of equal length packets share one sendmsg (UDP_SEGMENT)
+
+        A shorter packet can end a run, the kernel splits it back into datagrams (or the NIC does).
+        """
+        pending, self.udp_pending = self.udp_pending, []
+        start = 0
+        while start < len(pending):
+            size = len(pending[start])
+            end = start + 1
+            if self.udp_gso:
+                limit = min(len(pending), start + UDP_MAX_SEGMENTS, start + UDP_MAX_GSO_LEN // size)
+                while end < limit and len(pending[end - 1]) == size and len(pending[end]) <= size:
+                    end += 1
+            try:
+                if end - start > 1:
+                    self.sock.sendmsg([b"".join(pending[start:end])], [(SOL_UDP, UDP_SEGMENT, struct.pack("H", size))])
+                else:
+                    self.sock.send(pending[start])
+            except BlockingIOError:
+                pass # lost, like a dropped frame, retransmission covers it
+            except ConnectionRefusedError:
+                pass # nothing listening (yet), same again
+            except OSError:
+                if end - start == 1 or not self.udp_gso:
+                    raise
+                print("UDP segmentation offload unavailable, sending datagrams one at a time")
+                self.udp_gso = False
+                continue
+            if self.tracer is not None:
+                # only the first send of each request is stamped, retransmissions are a no-op
+                for packet in pending[start:end]:
+                    self.tracer.sent(int.from_bytes(packet[1:3]))
+            start = end
+
+
+    def _resend(self, frame: bytes):
+        if self.udp:
+            self._send_udp(frame)
+        else:
+            self.sock.send(frame)
+
+
+    def _recv(self, sock, flags: int = 0):
+        """Reads one frame, along with its kernel receive timestamp (ns) when tracing"""
+        if self.tracer is None:
+            return sock.recv(65535, flags), None
+
+        frame, ancdata, _, _ = sock.recvmsg(65535, CMSG_SPACE(16), flags)
+        for level, kind, data in ancdata:
+            if level == SOL_SOCKET and kind == SO_TIMESTAMPNS:
+                sec, nsec = struct.unpack("qq", data)
+                return frame, sec * 1_000_000_000 + nsec
+        return frame, time.time_ns()
+
+
+    def _enable_timestamps(self, sock):
+        if self.tracer is not None:
+            sock.setsockopt(SOL_SOCKET, SO_TIMESTAMPNS, 1)
+
+
+    def _parse_frame(self, frame: bytes):
+        """Strips the ethernet header and decodes a response into (opcode, seq_num, payload, board)
+
+        board is the source MAC of the responding FPGA.
+
+        Returns None for frames that aren't responses (eg. our own outgoing requests).
+        Safe to call from RX worker threads, it doesn't touch any session state.
+        """
         # strip ethernet header
-        dest, src, ethtype = struct.unpack_from("!6s6sH", frame, 0)
+        board = frame[6:12]
         packet = frame[14:]
 
         opcode, seq_num = struct.unpack_from("!BH", packet)
 
         if opcode == OPCODE["WRITE_ACK"]:
-            if seq_num in self.unacked_packets:
-                task = self.unacked_packets.pop(seq_num)
-                task.cancel()
-                print(f"ACK received for {seq_num}")
+            return opcode, seq_num, b"", board
 
-        elif opcode == OPCODE["READ_RSP"]:
-            if seq_num in self.unacked_packets:
-                task = self.unacked_packets.pop(seq_num)
-                task.cancel()
-                print(f"Resp received for {seq_num}")
-            
+        elif opcode == OPCODE["STREAM_ACK"]:
+            return opcode, seq_num, b"", board
+
+        elif opcode in (OPCODE["READ_RSP"], OPCODE["STREAM_DATA"]):
+            address, len = struct.unpack_from("!IH", packet, 3)
+            payload = packet[9:9+len]
+            return opcode, seq_num, payload, board
+
+        elif opcode == OPCODE["BATCH_RSP"]:
+            # sub-responses, only the batch knows how to split them
+            return opcode, seq_num, packet[3:], board
+
+        elif opcode in RESPONSE_OPCODES:
+            # read-modify-write, old data followed by the status byte
             address, len = struct.unpack_from("!IH", packet, 3)
-            payload = packet[9:]
-            self.rx_buffer[seq_num] = payload
-        self.rx_event.set()
+            payload = packet[9:9+len+1]
+            return opcode, seq_num, payload, board
 
+        return None
 
-    async def _retransmit_packet(self, seq_num, packet):
-        """Sends a packet every self.rtd seconds until it is ACKed"""
+
+    def _on_response(self, opcode, seq_num, payload, board=None, rx_time=None):
+        if opcode == OPCODE["STREAM_DATA"]:
+            # seq_num is the chunk count, not a request
+            if self.active_stream is not None:
+                self.active_stream._push(seq_num, payload)
+            return
+
+        pending = self.group_pending.get(seq_num)
+        if pending is not None:
+            pending.discard(board)
+            if pending:
+                return # still waiting on other boards
+            del self.group_pending[seq_num]
+
+        if seq_num in self.unacked_packets:
+            task = self.unacked_packets.pop(seq_num)
+            task.cancel()
+            self.speculative.pop(seq_num, None)
+            self._release_slot()
+            if self.tracer is not None:
+                self.tracer.responded(seq_num, rx_time)
+            if opcode == OPCODE["WRITE_ACK"]:
+                print(f"ACK received for {seq_num}")
+            else:
+                print(f"Resp received for {seq_num}")
+            self._complete(seq_num, payload)
+            if self.tracer is not None:
+                self.tracer.completed(seq_num)
+
+
+    def _on_responses(self, responses):
+        for response in responses:
+            self._on_response(*response)
+
+
+    def _open_rx_queues(self, interface: str, queues: int):
+        """Opens one AF_PACKET socket per RX queue and joins them to a PACKET_FANOUT group
+
+        A classic BPF program steers each response to queue (seq_num % queues), so every
+        worker owns a fixed slice of the sequence space. Workers block in recv() and parse
+        frames off the event loop thread, then merge completions back through the loop.
+        STREAM_DATA all goes to the first queue, its seq_num is the chunk count and chunks spread
+        over several workers could reach the loop out of order.
+        """
+        for idx in range(queues):
+            sock = self._open_rx_socket(interface)
+            if idx == 0:
+                # let the kernel pick a free group id, so several RSP instances don't share a group
+                sock.setsockopt(SOL_PACKET, PACKET_FANOUT, (PACKET_FANOUT_CBPF | PACKET_FANOUT_FLAG_UNIQUEID) << 16)
+                group_id = sock.getsockopt(SOL_PACKET, PACKET_FANOUT) & 0xFFFF
+                # the steering program is shared by the whole group
+                attach_bpf(sock, SOL_PACKET, PACKET_FANOUT_DATA, [
+                    (BPF_LD_B_ABS, 0, 0, SKF_NET_OFF),     # A = opcode
+                    (BPF_JEQ_K, 0, 1, OPCODE["STREAM_DATA"]),
+                    (BPF_RET_K, 0, 0, 0),                  # stream chunks, in order on the first queue
+                    (BPF_LD_H_ABS, 0, 0, SKF_NET_OFF + 1), # A = seq_num (after the 1 byte opcode)
+                    (BPF_RET_A, 0, 0, 0),                  # queue = A % queues
+                ])
+            else:
+                sock.setsockopt(SOL_PACKET, PACKET_FANOUT, group_id | (PACKET_FANOUT_CBPF << 16))
+            # a thread blocked in recv() isn't woken by another closing the socket, so don't block forever
+            sock.setsockopt(SOL_SOCKET, SO_RCVTIMEO, struct.pack("ll", 0, int(RX_POLL * 1e6)))
+            worker = threading.Thread(target=self._rx_worker, args=(sock,), name=f"rsp-rx{idx}", daemon=True)
+            worker.start()
+            self.rx_workers.append((sock, worker))
+
+
+    def _open_rx_socket(self, interface: str):
+        """AF_PACKET socket that only ever sees RSP responses from our FPGA addressed to us
+
+        The filter runs in the kernel, so stray traffic on a shared segment (other boards,
+        other hosts, our own requests looping back) never wakes us up. It is attached before
+        the socket is bound to the EtherType, so no unfiltered frame can be queued.
+        """
+        sock = socket(AF_PACKET, SOCK_RAW, 0)
+        boards = self.boards if self.dest_mac in self.boards else [self.dest_mac] + self.boards
+        attach_bpf(sock, SOL_SOCKET, SO_ATTACH_FILTER, rsp_filter(self.src_mac, boards))
+        self._enable_timestamps(sock)
+        sock.bind((interface, ETH_TYPE))
+        return sock
+
+
+    def _rx_worker(self, sock):
+        """Receive loop for one fanout queue, runs until close()"""
+        while True:
+            frames = []
+            try:
+                frames.append(self._recv(sock))
+                # drain whatever else is already queued so the loop is woken once per batch
+                while len(frames) < RX_BATCH:
+                    frames.append(self._recv(sock, MSG_DONTWAIT))
+            except BlockingIOError:
+                pass # nothing (more) queued, or RX_POLL passed
+            except OSError:
+                return # socket closed
+
+            responses = []
+            for frame, rx_time in frames:
+                # one malformed frame mustn't take down the queue, every response steered here would be lost
+                try:
+                    response = self._parse_frame(frame)
+                except Exception as e:
+                    print(f"Dropped malformed frame ({len(frame)} bytes): {e!r}")
+                    continue
+                if response is not None:
+                    responses.append((*response, rx_time))
+            if responses:
+                self.loop.call_soon_threadsafe(self._on_responses, responses)
+
+
+    def _complete(self, seq_num, payload):
+        response = self.responses.pop(seq_num, None)
+        if response is not None and not response.done():
+            response.set_result(payload)
+
+
+    async def _retransmit_packet(self, seq_num, packet, rto):
+        """Sends a packet every rto seconds until it is ACKed, unanswered read-ahead is given up"""
         try:
+            retries = 0
             while True:
-                await asyncio.sleep(self.rtd)
+                await asyncio.sleep(rto)
+                if seq_num in self.speculative and retries == PREFETCH_RETRIES:
+                    print(f"Giving up read-ahead packet {seq_num}")
+                    self._drop_prefetch(self.speculative[seq_num]) # cancels this task too
+                    break
+                retries += 1
                 if seq_num in self.unacked_packets:
                     print(f"Retransmitting packet {seq_num}")
-                    self.sock.send(packet)
+                    if self.tracer is not None:
+                        self.tracer.retried(seq_num)
+                    self._resend(packet)
                 else:
                     break
         except asyncio.CancelledError:
             pass
 
 
+    async def _retransmit_group(self, seq_num, frame):
+        """Every self.rtd seconds, resends a group frame unicast to each board that hasn't ACKed it
+
+        After self.group_retries resends the request is dropped and fails with TimeoutError.
+        """
+        try:
+            for _ in range(self.group_retries):
+                await asyncio.sleep(self.rtd)
+                for board in self.group_pending.get(seq_num, ()):
+                    print(f"Retransmitting packet {seq_num} to {board.hex(':')}")
+                    if self.tracer is not None:
+                        self.tracer.retried(seq_num)
+                    self._resend(board + frame[6:])
+            await asyncio.sleep(self.rtd)
+        except asyncio.CancelledError:
+            return # ACKed by every board
+
+        missing = ", ".join(board.hex(":") for board in self.group_pending.get(seq_num, ()))
+        response = self.responses.get(seq_num)
+        self._drop_request(seq_num)
+        if response is not None and not response.done():
+            response.set_exception(TimeoutError(f"{missing} didn't ACK packet {seq_num}"))
+
+
     def _gen_write_packet(self, address: int, data: bytes) -> bytes:
         """Wrap data and address in a write packet"""
         packet =  OPCODE["WRITE"].to_bytes(1) # opcode (write)
@@ -203,7 +1070,7 @@ class RSP:
         packet += len(data).to_bytes(2)       # len (2 bytes)
         packet += data                        # payload (len bytes)
         return packet
-    
+
 
     def _gen_wrick_ack_packet(self) -> bytes:
         packet =  OPCODE["WRITE_ACK"].to_bytes(1) # opcode (write)
@@ -219,15 +1086,53 @@ class RSP:
         packet += byte_cnt.to_bytes(2)       # len (2 bytes)
         return packet
 
-    def _gen_frame(self, packet: bytes) -> bytes:
+    def _gen_rmw_packet(self, opcode: int, address: int, byte_cnt: int, operands: bytes) -> bytes:
+        """Wrap address and operands in a read-modify-write packet"""
+        packet = opcode.to_bytes(1)          # opcode (rmw)
+        packet += self.seq_num.to_bytes(2)   # seqnum (2 byte)
+        packet += address.to_bytes(4)        # address (4 byte)
+        packet += byte_cnt.to_bytes(2)       # len (2 bytes)
+        packet += operands                   # operands
+        return packet
+
+    def _gen_wait_packet(self, address: int, byte_cnt: int, timeout_us: int, operands: bytes) -> bytes:
+        """Wrap address, timeout and (mask, value) pairs in a wait packet"""
+        packet = OPCODE["WAIT"].to_bytes(1)  # opcode (wait)
+        packet += self.seq_num.to_bytes(2)   # seqnum (2 byte)
+        packet += address.to_bytes(4)        # address (4 byte)
+        packet += byte_cnt.to_bytes(2)       # len (2 bytes)
+        packet += timeout_us.to_bytes(4)     # timeout (4 bytes)
+        packet += operands                   # (mask, value) pairs
+        return packet
+
+    def _gen_stream_packet(self, address: int, byte_cnt: int, ring_len: int, interval_us: int) -> bytes:
+        """Stream subscription, byte_cnt 0 cancels"""
+        packet =  OPCODE["STREAM"].to_bytes(1) # opcode (stream)
+        packet += self.seq_num.to_bytes(2)     # seqnum (2 byte)
+        packet += address.to_bytes(4)          # address (4 byte)
+        packet += byte_cnt.to_bytes(2)         # len (2 bytes)
+        packet += ring_len.to_bytes(4)         # ring len (4 bytes)
+        packet += interval_us.to_bytes(4)      # interval (4 bytes)
+        return packet
+
+
+    def _gen_batch_packet(self, batch: "RSPBatch") -> bytes:
+        """Wrap a batch of sub-operations in a batch packet"""
+        packet = OPCODE["BATCH"].to_bytes(1)   # opcode (batch)
+        packet += self.seq_num.to_bytes(2)     # seqnum (2 byte)
+        packet += len(batch.ops).to_bytes(1)   # count (1 byte)
+        packet += batch.pack()                 # sub-operations
+        return packet
+
+    def _gen_frame(self, packet: bytes, dest_mac: bytes = None) -> bytes:
         """Wrap packet in an ethernet frame"""
-        frame =  self.dest_mac
+        frame =  dest_mac or self.dest_mac
         frame += self.src_mac
         frame += ETH_TYPE.to_bytes(2)
         frame += packet.ljust(46, b"\x00")
         return frame
-    
-    
+
+
     def compute_crc32(self, frame_bytes: bytes) -> bytes:
         """
         Compute Ethernet CRC-32 (IEEE 802.3) for a given frame.
@@ -247,7 +1152,7 @@ class RSP:
 
         inv_crc = (~crc) & 0xFFFFFFFF
         return struct.pack("<I", inv_crc)
-    
+
 
     def write_pcap(self, filename: str, frame: bytes):
         """ Saves frame to a .pcap file for analysis in Wireshark"""
@@ -274,4 +1179,535 @@ class RSP:
 
     def batch(self, data: bytes, n: int) -> bytes:
         for i in range(0, len(data), n):
-            yield data[i:i+n]
\ No newline at end of file
+            yield data[i:i+n]
+
+
+    def chunk_range(self, start: int, end: int, n: int = MAX_PAYLOAD_LEN):
+        """Split the address range [start, end) into (address, len) requests of at most n bytes"""
+        for address in range(start, end, n):
+            yield address, min(n, end - address)
+
+
+def cosim_socket(path: str = COSIM_SOCKET, timeout: float = 300) -> socket:
+    """Connects to a running axi_over_ethernet simulation (Serial/sim/axi_over_ethernet, make cosim)
+
+    Pass the result to RSP(sock=..., rtd=COSIM_RTD). Waits up to timeout seconds for the simulation to come up.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket(AF_UNIX, SOCK_SEQPACKET)
+        try:
+            sock.connect(path)
+            return sock
+        except (FileNotFoundError, ConnectionRefusedError):
+            sock.close()
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.5)
+
+
+def rsp_filter(host_mac: bytes, fpga_macs: list, opcodes=RESPONSE_OPCODES) -> list:
+    """Classic BPF program accepting RSP responses sent to host_mac by any of fpga_macs"""
+    prog = [
+        (BPF_LD_W_ABS, 0, 0, 0),  (BPF_JEQ_K, 0, "drop", int.from_bytes(host_mac[:4])), # destination
+        (BPF_LD_H_ABS, 0, 0, 4),  (BPF_JEQ_K, 0, "drop", int.from_bytes(host_mac[4:])),
+        (BPF_LD_H_ABS, 0, 0, 12), (BPF_JEQ_K, 0, "drop", ETH_TYPE),
+        (BPF_LD_B_ABS, 0, 0, 14),
+    ]
+    prog += [(BPF_JEQ_K, "source", 0, opcode) for opcode in opcodes]
+    prog += ["drop", (BPF_RET_K, 0, 0, 0), "source"]
+    # one block per board, so jump offsets stay short however many boards there are
+    for i, mac in enumerate(fpga_macs):
+        prog += [
+            (BPF_LD_W_ABS, 0, 0, 6),  (BPF_JEQ_K, 0, f"src{i+1}", int.from_bytes(mac[:4])),
+            (BPF_LD_H_ABS, 0, 0, 10), (BPF_JEQ_K, 0, f"src{i+1}", int.from_bytes(mac[4:])),
+            (BPF_RET_K, 0, 0, 0xFFFF),
+            f"src{i+1}",
+        ]
+    prog += [(BPF_RET_K, 0, 0, 0)]
+
+    # resolve labels into relative jump offsets
+    labels = {}
+    insns = []
+    for item in prog:
+        if isinstance(item, str):
+            labels[item] = len(insns)
+        else:
+            insns.append(item)
+    offset = lambda target, idx: labels[target] - idx - 1 if isinstance(target, str) else target
+    return [(code, offset(jt, idx), offset(jf, idx), k) for idx, (code, jt, jf, k) in enumerate(insns)]
+
+
+def attach_bpf(sock, level: int, optname: int, insns: list):
+    """Attaches a classic BPF program, given as (code, jt, jf, k) tuples, with setsockopt"""
+    filters = b"".join(struct.pack("HBBI", code, jt, jf, k & 0xFFFFFFFF) for code, jt, jf, k in insns)
+    buf = ctypes.create_string_buffer(filters, len(filters))
+    # struct sock_fprog holds a pointer, keep buf alive until the kernel has copied it
+    fprog = struct.pack("HL", len(insns), ctypes.addressof(buf))
+    sock.setsockopt(level, optname, fprog)
+
+
+class RSPStream:
+    """Chunks pushed by the FPGA for one RSP.stream subscription
+
+    Iterating yields (chunk number, data), synchronously or with async for. Chunk numbers count up
+    from 0, extended past the 16 bit count on the wire. Chunks lost on the link, or dropped because
+    more than `buffer` were waiting to be consumed, show up as a jump in the number and are
+    counted in self.lost. Iteration ends once the stream is closed.
+    Sync iteration and close() work from any thread but the one running the RSP loop, which has to use
+    async for and aclose() (eg. the loop thread of RSPThread or RSPDaemon).
+    """
+    def __init__(self, rsp: RSP, address: int, byte_cnt: int, buffer: int = 1024):
+        self.rsp = rsp
+        self.address = address
+        self.byte_cnt = byte_cnt
+        self.chunks = deque(maxlen=buffer)
+        self.waiter = None
+        self.next_chunk = 0 # number of the next chunk expected from the FPGA
+        self.lost = 0
+        self.closed = False
+
+
+    def close(self):
+        """Cancel the stream on the FPGA, chunks already received can still be iterated"""
+        if not self.closed:
+            self._run(self.aclose())
+
+
+    async def aclose(self):
+        if not self.closed:
+            self.closed = True
+            await self.rsp._stream_cancel_async()
+            self._wake()
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+    def __iter__(self):
+        while True:
+            try:
+                yield self._run(self.__anext__())
+            except StopAsyncIteration:
+                return
+
+
+    def __aiter__(self):
+        return self
+
+
+    async def __anext__(self) -> tuple:
+        while not self.chunks:
+            if self.closed:
+                raise StopAsyncIteration
+            self.waiter = self.rsp.loop.create_future()
+            await self.waiter
+        return self.chunks.popleft()
+
+
+    def _push(self, count: int, payload: bytes):
+        # the count on the wire is 16 bit, anything more than half a wrap behind is a stale duplicate
+        delta = (count - self.next_chunk) & 0xFFFF
+        if delta >= 0x8000 or self.closed:
+            return
+        if delta:
+            print(f"Stream lost {delta} chunks before chunk {self.next_chunk + delta}")
+        if len(self.chunks) == self.chunks.maxlen:
+            self.lost += 1 # oldest one is pushed out
+        self.lost += delta
+        self.chunks.append((self.next_chunk + delta, payload))
+        self.next_chunk += delta + 1
+        self._wake()
+
+
+    def _wake(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+
+    def _run(self, coro):
+        """Runs coro on the RSP loop, from a thread that doesn't run it"""
+        loop = self.rsp.loop
+        if not loop.is_running():
+            return loop.run_until_complete(coro)
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            coro.close()
+            raise RuntimeError("RSPStream can't block the loop it runs on, use async for and aclose()")
+        # the loop belongs to another thread (RSPThread), wait on it from here
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+
+class RSPBatch:
+    """Collects operations for RSP.submit, the FPGA runs them in order and answers them all in one frame
+
+    submit returns one result per operation, in the order they were added:
+    write -> None, read -> data, masked_write/set_bits/clear_bits -> old contents,
+    compare_and_swap -> (swapped, old contents), wait_for -> (matched, last value read)
+    Adding an operation raises ValueError once the request or its response would no longer fit in a frame.
+    """
+    def __init__(self):
+        self.ops = [] # (opcode, address, byte_cnt, body)
+        self.request_len = 4
+        self.response_len = 3
+
+
+    def write(self, address: int, data: bytes):
+        self._add(OPCODE["WRITE"], address, len(data), data, 1)
+
+
+    def read(self, address: int, byte_cnt: int):
+        self._add(OPCODE["READ"], address, byte_cnt, b"", 7 + byte_cnt)
+
+
+    def masked_write(self, address: int, data: bytes, mask: bytes):
+        if len(data) != len(mask):
+            raise ValueError("data and mask must be the same length")
+        self._add(OPCODE["MASKED_WRITE"], address, len(data), self._pairs(data, mask), 8 + len(data))
+
+
+    def set_bits(self, address: int, bits: bytes):
+        self._add(OPCODE["SET_BITS"], address, len(bits), bits, 8 + len(bits))
+
+
+    def clear_bits(self, address: int, bits: bytes):
+        self._add(OPCODE["CLEAR_BITS"], address, len(bits), bits, 8 + len(bits))
+
+
+    def compare_and_swap(self, address: int, expected: bytes, new: bytes):
+        if len(expected) != len(new):
+            raise ValueError("expected and new must be the same length")
+        if not 0 < len(new) <= CAS_MAX_LEN:
+            raise ValueError(f"compare-and-swap is limited to {CAS_MAX_LEN} bytes")
+        self._add(OPCODE["CAS"], address, len(new), self._pairs(expected, new), 8 + len(new))
+
+
+    def wait_for(self, address: int, mask: bytes, value: bytes, timeout: float):
+        if len(mask) != len(value):
+            raise ValueError("mask and value must be the same length")
+        if not 0 < len(mask) <= WAIT_MAX_LEN:
+            raise ValueError(f"wait is limited to {WAIT_MAX_LEN} bytes")
+        timeout_us = min(int(timeout * 1e6), 2 ** 32 - 1)
+        self._add(OPCODE["WAIT"], address, len(mask), timeout_us.to_bytes(4) + self._pairs(mask, value), 8 + len(mask))
+
+
+    def parse(self, payload: bytes) -> list:
+        """Splits a batch response payload into per-operation results"""
+        results = []
+        pos = 0
+        for idx, (opcode, _, byte_cnt, _) in enumerate(self.ops):
+            if pos >= len(payload):
+                raise ValueError(f"batch response ends before operation {idx}")
+            if payload[pos] == OPCODE["ABORT"]:
+                raise ValueError(f"FPGA rejected batch operation {idx} ({opcode:#04x}), the rest was skipped")
+            if opcode == OPCODE["WRITE"]:
+                results.append(None)
+                pos += 1
+                continue
+            data = payload[pos+7:pos+7+byte_cnt]
+            status = payload[pos+7+byte_cnt:pos+8+byte_cnt] == b"\x01"
+            if opcode == OPCODE["READ"]:
+                results.append(data)
+                pos += 7 + byte_cnt
+            else:
+                results.append((status, data) if opcode in (OPCODE["CAS"], OPCODE["WAIT"]) else data)
+                pos += 8 + byte_cnt
+        return results
+
+
+    def pack(self) -> bytes:
+        """The sub-operations as they go on the wire, opcode, address, len and body each"""
+        return b"".join(opcode.to_bytes(1) + address.to_bytes(4) + byte_cnt.to_bytes(2) + body
+                        for opcode, address, byte_cnt, body in self.ops)
+
+
+    @classmethod
+    def unpack(cls, data: bytes) -> "RSPBatch":
+        """Rebuilds a batch from pack()ed sub-operations"""
+        batch = cls()
+        pos = 0
+        while pos < len(data):
+            opcode, address, byte_cnt = struct.unpack_from("!BIH", data, pos)
+            if opcode in (OPCODE["WRITE"], OPCODE["SET_BITS"], OPCODE["CLEAR_BITS"]):
+                body_len = byte_cnt
+            elif opcode == OPCODE["READ"]:
+                body_len = 0
+            elif opcode in (OPCODE["MASKED_WRITE"], OPCODE["CAS"]):
+                body_len = 2 * byte_cnt
+            elif opcode == OPCODE["WAIT"]:
+                body_len = 4 + 2 * byte_cnt
+            else:
+                raise ValueError(f"opcode {opcode:#04x} can't be batched")
+            pos += 7
+            if pos + body_len > len(data):
+                raise ValueError("batch ends part way through an operation")
+            response_len = 1 if opcode == OPCODE["WRITE"] else 7 + byte_cnt if opcode == OPCODE["READ"] else 8 + byte_cnt
+            batch._add(opcode, address, byte_cnt, data[pos:pos+body_len], response_len)
+            pos += body_len
+        return batch
+
+
+    def _add(self, opcode: int, address: int, byte_cnt: int, body: bytes, response_len: int):
+        if not byte_cnt:
+            raise ValueError("empty operation")
+        if (len(self.ops) == 255 or self.request_len + 7 + len(body) > MAX_PACKET_LEN or
+                self.response_len + response_len > MAX_PACKET_LEN):
+            raise ValueError("batch is full, submit it and start another")
+        self.ops.append((opcode, address, byte_cnt, body))
+        self.request_len += 7 + len(body)
+        self.response_len += response_len
+
+
+    def _pairs(self, a: bytes, b: bytes) -> bytes:
+        return bytes(x for pair in zip(a, b) for x in pair)
+
+
+class RSPThread:
+    """Thread-safe RSP client
+
+    One background thread owns the RSP instance and its event loop. Every method can be called
+    from any thread, it queues the request and returns a concurrent.futures.Future, call
+    .result() on it to block. All threads share one socket and one send window, so requests from
+    different threads overlap on the link instead of each thread opening its own raw socket.
+
+      conn = RSPThread(rtd=0.01)
+      csr = conn.read_data(0x100, 4).result()
+      for count, data in conn.stream(0x1000, 64, ring_len=4096).result():
+          ...
+
+    Keyword arguments are passed through to RSP. The sync methods of the RSP instance itself
+    (conn.rsp) must not be used, they would run a second loop.
+    """
+    def __init__(self, **kwargs):
+        self.requests = queue.SimpleQueue() # (coroutine function, args, future)
+        started = concurrent.futures.Future()
+        self.thread = threading.Thread(target=self._run, args=(kwargs, started), name="rsp-loop", daemon=True)
+        self.thread.start()
+        self.rsp = started.result() # re-raises anything RSP() raised
+        self.loop = self.rsp.loop
+
+
+    def write_data(self, address: int, data: bytes, resume: bool = False, spot_check: int = 0, priority: int = None):
+        return self._queue(self.rsp._write_data_async, address, data, resume, spot_check, priority)
+
+
+    def read_data(self, address: int, byte_cnt: int, resume: bool = False, spot_check: int = 0, priority: int = None):
+        return self._queue(self.rsp._read_data_async, address, byte_cnt, resume, spot_check, priority)
+
+
+    def write_group(self, address: int, data: bytes):
+        return self._queue(self.rsp._write_group_async, address, data)
+
+
+    def masked_write(self, address: int, data: bytes, mask: bytes):
+        return self._queue(self.rsp._masked_write_async, address, data, mask)
+
+
+    def set_bits(self, address: int, bits: bytes):
+        return self._queue(self.rsp._set_bits_async, address, bits)
+
+
+    def clear_bits(self, address: int, bits: bytes):
+        return self._queue(self.rsp._clear_bits_async, address, bits)
+
+
+    def compare_and_swap(self, address: int, expected: bytes, new: bytes):
+        return self._queue(self.rsp._compare_and_swap_async, address, expected, new)
+
+
+    def submit(self, batch: "RSPBatch"):
+        return self._queue(self.rsp._submit_async, batch)
+
+
+    def wait_for(self, address: int, mask: bytes, value: bytes, timeout: float):
+        return self._queue(self.rsp._wait_for_async, address, mask, value, timeout)
+
+
+    def stream(self, address: int, byte_cnt: int, ring_len: int = 0, interval: float = 0.0):
+        """The future's result is the RSPStream, iterate and close it from any thread but the loop's"""
+        return self._queue(self.rsp._stream_async, address, byte_cnt, ring_len, interval)
+
+
+    def close(self):
+        """Stops the loop thread once the requests already queued have completed"""
+        if self.thread.is_alive():
+            self._queue(None).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+
+
+    def _run(self, kwargs: dict, started):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            rsp = RSP(**kwargs)
+        except Exception as e:
+            started.set_exception(e)
+            return
+        self.pending = set()
+        started.set_result(rsp)
+        loop.run_forever()
+        # stopped by close(), let the retransmissions rsp.close() cancels finish before the loop goes
+        rsp.close()
+        loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop), return_exceptions=True))
+        loop.close()
+
+
+    def _queue(self, fn, *args):
+        future = concurrent.futures.Future()
+        self.requests.put((fn, args, future))
+        # one wakeup drains everything queued so far
+        self.loop.call_soon_threadsafe(self._drain)
+        return future
+
+
+    def _drain(self):
+        """Runs on the loop thread, starts a task for every queued request"""
+        while True:
+            try:
+                fn, args, future = self.requests.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue # cancelled before it was started
+            if fn is None:
+                # close(), wait for everything started before it
+                task = self.loop.create_task(asyncio.wait(set(self.pending)) if self.pending else asyncio.sleep(0))
+            else:
+                task = self.loop.create_task(fn(*args))
+                self.pending.add(task)
+            task.add_done_callback(lambda task, future=future: self._done(task, future))
+
+
+    def _done(self, task, future):
+        self.pending.discard(task)
+        if task.cancelled():
+            future.set_exception(concurrent.futures.CancelledError())
+        elif task.exception() is not None:
+            future.set_exception(task.exception())
+        else:
+            future.set_result(task.result())
+
+
+class RSPJournal:
+    """Persistent record of the address ranges confirmed during long transfers
+
+    Ranges are stored relative to the start of each transfer and merged as they complete.
+    Downloaded data is staged in a sidecar file per transfer so it survives a crash too.
+    The journal is rewritten atomically at most every flush_interval seconds.
+    """
+    def __init__(self, path: str, flush_interval: float = 1.0):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.last_flush = time.monotonic()
+        self.staged = {}
+        self.transfers = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.transfers = json.load(f)
+
+
+    def transfer_id(self, op: str, address: int, byte_cnt: int, digest: str = "") -> str:
+        return f"{op}:{address:#x}:{byte_cnt:#x}:{digest}"
+
+
+    def confirmed(self, tid) -> list:
+        return self.transfers.get(tid, [])
+
+
+    def missing(self, tid, start: int, end: int) -> list:
+        """Absolute address ranges in [start, end) that have not been confirmed yet"""
+        ranges = []
+        cursor = start
+        for c_start, c_end in self.confirmed(tid):
+            if start + c_start > cursor:
+                ranges.append((cursor, start + c_start))
+            cursor = max(cursor, start + c_end)
+        if cursor < end:
+            ranges.append((cursor, end))
+        return ranges
+
+
+    def confirm(self, tid, start: int, end: int):
+        ranges = self.transfers.setdefault(tid, [])
+        i = bisect.bisect_left(ranges, [start, end])
+        # merge with neighbours
+        if i > 0 and ranges[i-1][1] >= start:
+            i -= 1
+            start = ranges[i][0]
+            end = max(end, ranges[i][1])
+            del ranges[i]
+        while i < len(ranges) and ranges[i][0] <= end:
+            end = max(end, ranges[i][1])
+            del ranges[i]
+        ranges.insert(i, [start, end])
+
+        if time.monotonic() - self.last_flush > self.flush_interval:
+            self.flush()
+
+
+    def revoke(self, tid, start: int, end: int):
+        ranges = []
+        for c_start, c_end in self.confirmed(tid):
+            if c_start < start:
+                ranges.append([c_start, min(c_end, start)])
+            if c_end > end:
+                ranges.append([max(c_start, end), c_end])
+        self.transfers[tid] = ranges
+
+
+    def stage(self, tid, byte_cnt: int):
+        """Open (or reopen) the sidecar file that holds downloaded data"""
+        if tid not in self.staged:
+            fd = os.open(self._staged_path(tid), os.O_RDWR | os.O_CREAT)
+            os.ftruncate(fd, byte_cnt)
+            self.staged[tid] = fd
+
+
+    def store(self, tid, offset: int, payload: bytes):
+        os.pwrite(self.staged[tid], payload, offset)
+        self.confirm(tid, offset, offset + len(payload))
+
+
+    def load(self, tid, offset: int, byte_cnt: int) -> bytes:
+        return os.pread(self.staged[tid], byte_cnt, offset)
+
+
+    def discard(self, tid):
+        """Forget any progress recorded for a transfer"""
+        self.transfers.pop(tid, None)
+        fd = self.staged.pop(tid, None)
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(self._staged_path(tid)):
+            os.remove(self._staged_path(tid))
+
+
+    def finish(self, tid):
+        self.discard(tid)
+        self.flush()
+
+
+    def flush(self):
+        # staged data has to hit the disk before the ranges that describe it
+        for fd in self.staged.values():
+            os.fsync(fd)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.transfers, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+        self.last_flush = time.monotonic()
+
+
+    def _staged_path(self, tid) -> str:
+        return f"{self.path}.{hashlib.blake2b(tid.encode(), digest_size=8).hexdigest()}.part"
@@ -0,0 +1,341 @@
+#!/bin/python3
+# RSP daemon: one process owns the board's socket and sequence space, any number of client processes share it
+#
+# daemon:  python3 rsp_daemon.py [interface]      (or RSPDaemon(sock=...).serve_forever())
+# clients: conn = RSPClient()
+#          conn.write_data(0x0, data)
+#
+# Clients have the blocking calls of RSP but for stream and write_group, an RSPBatch passed to submit
+# goes through as one BATCH request and the daemon hands back the raw response for the client to parse.
+#
+# Every client gets its own shared memory block (multiprocessing.shared_memory) holding two rings,
+# requests from the client and responses from the daemon. Payloads are copied straight into and out
+# of the rings. The unix socket a client connects on only carries the shared memory name at startup,
+# then single byte doorbells saying a ring has new records.
+#
+# ring:     head (8 bytes, bytes ever written), tail (8 bytes, bytes ever read), capacity bytes of records
+# request:  record len (4 bytes), request id (4 bytes), opcode (1 byte, RSP OPCODE), pad (3 bytes),
+#           address (8 bytes), len (4 bytes), param (4 bytes, WAIT timeout in us), payload
+#           (BATCH: len is the operation count, payload the packed operations)
+# response: record len (4 bytes), request id (4 bytes), status (1 byte, 0 ok, 1 error message), pad (3 bytes), payload
+# records start 8 byte aligned, a record may wrap around the end of the ring
+
+import os
+import struct
+import sys
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from socket import socket, AF_UNIX, SOCK_SEQPACKET
+
+from rsp import RSP, RSPBatch, OPCODE, INTERFACE
+
+DAEMON_SOCKET = "/tmp/rsp_daemon.sock"
+RING_SIZE = 1 << 22
+
+REQUEST = struct.Struct("<IIB3xQII")
+RESPONSE = struct.Struct("<IIB3x")
+STATUS_OK = 0
+STATUS_ERROR = 1
+# room reserved for an error message in place of a response
+ERROR_LEN = 256
+
+
+def aligned(length: int) -> int:
+    return (length + 7) & ~7
+
+
+class ShmRing:
+    """Single producer, single consumer record ring in a shared memory buffer"""
+    def __init__(self, buf, offset: int, capacity: int):
+        self.index = buf[offset:offset+16].cast("Q") # head, tail
+        self.data = buf[offset+16:offset+16+capacity]
+        self.capacity = capacity
+
+
+    def free(self) -> int:
+        return self.capacity - (self.index[0] - self.index[1])
+
+
+    def put(self, header: bytes, payload: bytes = b"") -> bool:
+        """Appends one record, returns False if there isn't room for it"""
+        length = len(header) + len(payload)
+        if aligned(length) > self.free():
+            return False
+        head = self.index[0]
+        self._write(head, header)
+        self._write(head + len(header), payload)
+        self.index[0] = head + aligned(length) # publish
+        return True
+
+
+    def get(self):
+        """Removes the oldest record, returns None if the ring is empty"""
+        tail = self.index[1]
+        if tail == self.index[0]:
+            return None
+        # records are 8 byte aligned, so the length never wraps
+        pos = tail % self.capacity
+        length = int.from_bytes(self.data[pos:pos+4], "little")
+        record = self._read(tail, length)
+        self.index[1] = tail + aligned(length)
+        return record
+
+
+    def release(self):
+        self.index.release()
+        self.data.release()
+
+
+    def _write(self, offset: int, data: bytes):
+        pos = offset % self.capacity
+        first = min(len(data), self.capacity - pos)
+        self.data[pos:pos+first] = data[:first]
+        self.data[:len(data)-first] = data[first:]
+
+
+    def _read(self, offset: int, length: int) -> bytes:
+        pos = offset % self.capacity
+        first = min(length, self.capacity - pos)
+        return bytes(self.data[pos:pos+first]) + bytes(self.data[:length-first])
+
+
+class RSPDaemon:
+    def __init__(self, path: str = DAEMON_SOCKET, ring_size: int = RING_SIZE, **kwargs):
+        """Serves client processes on a unix socket at path, keyword arguments go to RSP"""
+        self.rsp = RSP(**kwargs)
+        self.loop = self.rsp.loop
+        self.path = path
+        self.ring_size = ring_size
+        self.clients = []
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket(AF_UNIX, SOCK_SEQPACKET)
+        self.server.bind(path)
+        self.server.listen()
+        self.server.setblocking(False)
+        self.loop.add_reader(self.server.fileno(), self._accept)
+
+
+    def serve_forever(self):
+        try:
+            self.loop.run_forever()
+        finally:
+            self.close()
+
+
+    def close(self):
+        for client in list(self.clients):
+            self._disconnect(client)
+        self.loop.remove_reader(self.server.fileno())
+        self.server.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.rsp.close()
+
+
+    def _accept(self):
+        try:
+            conn, _ = self.server.accept()
+        except BlockingIOError:
+            return
+        conn.setblocking(False)
+        shm = SharedMemory(create=True, size=2 * (16 + self.ring_size))
+        client = (conn, shm, ShmRing(shm.buf, 0, self.ring_size), ShmRing(shm.buf, 16 + self.ring_size, self.ring_size))
+        self.clients.append(client)
+        conn.send(f"{shm.name} {self.ring_size}".encode())
+        self.loop.add_reader(conn.fileno(), self._doorbell, client)
+        print(f"RSP daemon: client connected ({shm.name})")
+
+
+    def _doorbell(self, client):
+        conn, _, requests, _ = client
+        try:
+            if not conn.recv(4096):
+                self._disconnect(client)
+                return
+        except BlockingIOError:
+            return
+        except OSError:
+            self._disconnect(client)
+            return
+        while (record := requests.get()) is not None:
+            _, req_id, opcode, address, byte_cnt, param = REQUEST.unpack_from(record)
+            payload = record[REQUEST.size:]
+            self.loop.create_task(self._serve(client, req_id, opcode, address, byte_cnt, param, payload))
+
+
+    async def _serve(self, client, req_id: int, opcode: int, address: int, byte_cnt: int, param: int, payload: bytes):
+        try:
+            result = await self._dispatch(opcode, address, byte_cnt, param, payload)
+            status = STATUS_OK
+        except Exception as e:
+            result = str(e).encode()[:ERROR_LEN]
+            status = STATUS_ERROR
+        if client not in self.clients:
+            return # gone while the request was in flight
+        conn, _, _, responses = client
+        # the client only submits requests whose response it has room for
+        responses.put(RESPONSE.pack(RESPONSE.size + len(result), req_id, status), result)
+        try:
+            conn.send(b"\x01")
+        except BlockingIOError:
+            pass # doorbells already queued will wake it
+        except OSError:
+            self._disconnect(client)
+
+
+    async def _dispatch(self, opcode: int, address: int, byte_cnt: int, param: int, payload: bytes) -> bytes:
+        rsp = self.rsp
+        if opcode == OPCODE["WRITE"]:
+            await rsp._write_data_async(address, payload)
+            return b""
+        elif opcode == OPCODE["READ"]:
+            return await rsp._read_data_async(address, byte_cnt)
+        elif opcode == OPCODE["MASKED_WRITE"]:
+            return await rsp._masked_write_async(address, payload[:byte_cnt], payload[byte_cnt:])
+        elif opcode == OPCODE["SET_BITS"]:
+            return await rsp._set_bits_async(address, payload)
+        elif opcode == OPCODE["CLEAR_BITS"]:
+            return await rsp._clear_bits_async(address, payload)
+        elif opcode == OPCODE["CAS"]:
+            swapped, old = await rsp._compare_and_swap_async(address, payload[:byte_cnt], payload[byte_cnt:])
+            return old + bytes([swapped])
+        elif opcode == OPCODE["WAIT"]:
+            matched, value = await rsp._wait_for_async(address, payload[:byte_cnt], payload[byte_cnt:], param / 1e6)
+            return value + bytes([matched])
+        elif opcode == OPCODE["BATCH"]:
+            return await rsp._batch_async(RSPBatch.unpack(payload))
+        raise ValueError(f"unsupported opcode {opcode:#04x}")
+
+
+    def _disconnect(self, client):
+        conn, shm, requests, responses = client
+        self.clients.remove(client)
+        self.loop.remove_reader(conn.fileno())
+        conn.close()
+        requests.release()
+        responses.release()
+        shm.close()
+        shm.unlink()
+        print(f"RSP daemon: client disconnected ({shm.name})")
+
+
+class RSPClient:
+    """RSP access through a running RSPDaemon, same blocking calls as RSP except stream and write_group"""
+    def __init__(self, path: str = DAEMON_SOCKET):
+        self.sock = socket(AF_UNIX, SOCK_SEQPACKET)
+        self.sock.connect(path)
+        name, ring_size = self.sock.recv(256).decode().split()
+        ring_size = int(ring_size)
+        self.shm = SharedMemory(name=name)
+        # the daemon owns the block, don't let this process' resource tracker unlink it on exit
+        resource_tracker.unregister(self.shm._name, "shared_memory")
+        self.requests = ShmRing(self.shm.buf, 0, ring_size)
+        self.responses = ShmRing(self.shm.buf, 16 + ring_size, ring_size)
+        # large transfers are split so several requests fit in the rings at once
+        self.max_chunk = ring_size // 4
+        self.req_id = 0
+
+
+    def write_data(self, address: int, data: bytes):
+        data = memoryview(data)
+        self._call([(OPCODE["WRITE"], addr, size, 0, data[addr-address:addr-address+size], 0)
+                    for addr, size in self._chunks(address, len(data))])
+
+
+    def read_data(self, address: int, byte_cnt: int) -> bytes:
+        return b"".join(self._call([(OPCODE["READ"], addr, size, 0, b"", size)
+                                    for addr, size in self._chunks(address, byte_cnt)]))
+
+
+    def masked_write(self, address: int, data: bytes, mask: bytes) -> bytes:
+        return self._call([(OPCODE["MASKED_WRITE"], address, len(data), 0, data + mask, len(data))])[0]
+
+
+    def set_bits(self, address: int, bits: bytes) -> bytes:
+        return self._call([(OPCODE["SET_BITS"], address, len(bits), 0, bits, len(bits))])[0]
+
+
+    def clear_bits(self, address: int, bits: bytes) -> bytes:
+        return self._call([(OPCODE["CLEAR_BITS"], address, len(bits), 0, bits, len(bits))])[0]
+
+
+    def compare_and_swap(self, address: int, expected: bytes, new: bytes) -> tuple:
+        result = self._call([(OPCODE["CAS"], address, len(new), 0, expected + new, len(new) + 1)])[0]
+        return bool(result[-1]), result[:-1]
+
+
+    def wait_for(self, address: int, mask: bytes, value: bytes, timeout: float) -> tuple:
+        timeout_us = min(int(timeout * 1e6), 2 ** 32 - 1)
+        result = self._call([(OPCODE["WAIT"], address, len(mask), timeout_us, mask + value, len(mask) + 1)])[0]
+        return bool(result[-1]), result[:-1]
+
+
+    def submit(self, batch: RSPBatch) -> list:
+        if not batch.ops:
+            return []
+        payload = self._call([(OPCODE["BATCH"], 0, len(batch.ops), 0, batch.pack(), batch.response_len)])[0]
+        return batch.parse(payload)
+
+
+    def close(self):
+        self.sock.close()
+        self.requests.release()
+        self.responses.release()
+        self.shm.close()
+
+
+    def _chunks(self, address: int, byte_cnt: int):
+        for offset in range(0, byte_cnt, self.max_chunk):
+            yield address + offset, min(self.max_chunk, byte_cnt - offset)
+
+
+    def _call(self, ops: list) -> list:
+        """Runs (opcode, address, len, param, payload, response len) requests, keeping as many in flight as the rings allow"""
+        results = [None] * len(ops)
+        error = None
+        pending = {} # request id -> (index, response space reserved)
+        reserved = 0
+        submitted = 0
+        while submitted < len(ops) or pending:
+            rang = False
+            while submitted < len(ops):
+                opcode, address, byte_cnt, param, payload, response_len = ops[submitted]
+                space = aligned(RESPONSE.size + max(response_len, ERROR_LEN))
+                if reserved + space > self.responses.capacity:
+                    break
+                header = REQUEST.pack(REQUEST.size + len(payload), self.req_id, opcode, address, byte_cnt, param)
+                if not self.requests.put(header, payload):
+                    break
+                pending[self.req_id] = (submitted, space)
+                reserved += space
+                self.req_id = (self.req_id + 1) & 0xFFFFFFFF
+                submitted += 1
+                rang = True
+            if rang:
+                self.sock.send(b"\x01")
+
+            if not self.sock.recv(4096):
+                raise ConnectionError("RSP daemon went away")
+            while (record := self.responses.get()) is not None:
+                _, req_id, status = RESPONSE.unpack_from(record)
+                idx, space = pending.pop(req_id)
+                reserved -= space
+                payload = record[RESPONSE.size:]
+                if status != STATUS_OK:
+                    error = error or ValueError(f"RSP daemon: {payload.decode()}")
+                results[idx] = payload
+        # raised once everything has come back, so no stale responses are left in the ring
+        if error is not None:
+            raise error
+        return results
+
+
+def main():
+    daemon = RSPDaemon(interface=sys.argv[1] if len(sys.argv) > 1 else INTERFACE)
+    print(f"RSP daemon listening on {daemon.path}")
+    daemon.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
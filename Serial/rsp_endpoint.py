@@ -0,0 +1,210 @@
+# software stand-in for an FPGA running axi_over_ethernet
+#
+# Serves RSP requests out of a bytearray on one end of a datagram socketpair.
+# Pass host_sock to RSP(sock=...) to run host scripts without hardware:
+#
+#   ep = LocalEndpoint()
+#   conn = RSP(sock=ep.host_sock)
+#
+# or, over UDP on the loopback interface (no privileges needed):
+#
+#   ep = LocalEndpoint(udp=True)
+#   conn = RSP(udp=ep.address)
+
+import random
+import struct
+import threading
+import time
+from socket import socket, socketpair, AF_INET, AF_UNIX, SOCK_DGRAM
+
+from rsp import ETH_TYPE, OPCODE, CAS_MAX_LEN, WAIT_MAX_LEN
+
+
+class LocalEndpoint:
+    def __init__(self, mem_size: int = 1 << 16, mac: int = 0x0007ED123456, drop_rate: float = 0.0, latency: float = 0.0,
+                 udp: bool = False):
+        """drop_rate randomly discards requests to exercise retransmission, latency (s) delays every response"""
+        self.mem = bytearray(mem_size)
+        self.mac = mac.to_bytes(6)
+        self.drop_rate = drop_rate
+        self.latency = latency
+        self.poll_interval = 1e-4 # WAIT
+        self.stream = None # (request seq_num, stop event) of the running STREAM
+        self.reply = None # sends a packet to the host of the last request, stream chunks go there too
+        self.udp = udp
+        if udp:
+            self.sock = socket(AF_INET, SOCK_DGRAM)
+            self.sock.bind(("127.0.0.1", 0))
+            self.address = self.sock.getsockname()
+            self.host_sock = None
+        else:
+            self.host_sock, self.sock = socketpair(AF_UNIX, SOCK_DGRAM)
+        self.thread = threading.Thread(target=self.serve, name="rsp-endpoint", daemon=True)
+        self.thread.start()
+
+
+    def serve(self):
+        while True:
+            try:
+                if self.udp:
+                    packet, host = self.sock.recvfrom(65535)
+                else:
+                    frame = self.sock.recv(65535)
+            except OSError:
+                return # closed
+            if random.random() < self.drop_rate:
+                continue
+
+            if self.udp:
+                self.reply = lambda packet, host=host: self.sock.sendto(packet, host)
+            else:
+                header = frame[6:12] + self.mac + ETH_TYPE.to_bytes(2)
+                packet = frame[14:]
+                self.reply = lambda packet, header=header: self.sock.send(header + packet.ljust(46, b"\x00"))
+            try:
+                responses = self.handle(packet)
+            except ValueError as e:
+                print(f"Endpoint dropped request: {e}")
+                continue
+            for packet in responses:
+                if self.latency:
+                    time.sleep(self.latency)
+                self.reply(packet)
+
+
+    def handle(self, packet: bytes) -> list:
+        """Executes one request packet, returns the response packets"""
+        opcode, seq_num = struct.unpack_from("!BH", packet)
+
+        if opcode == OPCODE["WRITE"]:
+            address, length = struct.unpack_from("!IH", packet, 3)
+            self.mem[self._span(address, length)] = packet[9:9+length]
+            return [struct.pack("!BH", OPCODE["WRITE_ACK"], seq_num)]
+
+        elif opcode == OPCODE["READ"]:
+            address, length = struct.unpack_from("!IH", packet, 3)
+            payload = self.mem[self._span(address, length)]
+            return [struct.pack("!BHIH", OPCODE["READ_RSP"], seq_num, address, length) + payload]
+
+        elif opcode in (OPCODE["SET_BITS"], OPCODE["CLEAR_BITS"]):
+            address, length = struct.unpack_from("!IH", packet, 3)
+            span = self._span(address, length)
+            old = bytes(self.mem[span])
+            bits = packet[9:9+length]
+            if opcode == OPCODE["SET_BITS"]:
+                self.mem[span] = bytes(o | b for o, b in zip(old, bits))
+            else:
+                self.mem[span] = bytes(o & ~b for o, b in zip(old, bits))
+            return [struct.pack("!BHIH", opcode | 1, seq_num, address, length) + old + b"\x01"]
+
+        elif opcode in (OPCODE["MASKED_WRITE"], OPCODE["CAS"]):
+            address, length = struct.unpack_from("!IH", packet, 3)
+            if opcode == OPCODE["CAS"] and not 0 < length <= CAS_MAX_LEN:
+                return []
+            span = self._span(address, length)
+            old = bytes(self.mem[span])
+            a, b = packet[9:9+2*length:2], packet[10:10+2*length:2]
+            applied = True
+            if opcode == OPCODE["MASKED_WRITE"]:
+                self.mem[span] = bytes((o & ~m) | (d & m) for o, d, m in zip(old, a, b))
+            elif old == a:
+                self.mem[span] = b
+            else:
+                applied = False
+            return [struct.pack("!BHIH", opcode | 1, seq_num, address, length) + old + bytes([applied])]
+
+        elif opcode == OPCODE["WAIT"]:
+            address, length, timeout_us = struct.unpack_from("!IHI", packet, 3)
+            if not 0 < length <= WAIT_MAX_LEN:
+                return []
+            span = self._span(address, length)
+            mask, value = packet[13:13+2*length:2], packet[14:14+2*length:2]
+            # like the FPGA, nothing else is served while polling
+            deadline = time.monotonic() + timeout_us / 1e6
+            while True:
+                current = bytes(self.mem[span])
+                matched = all(c & m == v for c, m, v in zip(current, mask, value))
+                if matched or time.monotonic() >= deadline:
+                    break
+                time.sleep(self.poll_interval)
+            return [struct.pack("!BHIH", OPCODE["WAIT_RSP"], seq_num, address, length) + current + bytes([matched])]
+
+        elif opcode == OPCODE["STREAM"]:
+            address, length, ring_len, interval_us = struct.unpack_from("!IHII", packet, 3)
+            # a retransmitted request doesn't restart the stream
+            if self.stream is None or self.stream[0] != seq_num:
+                if self.stream is not None:
+                    self.stream[1].set()
+                    self.stream = None
+                if length:
+                    stop = threading.Event()
+                    self.stream = (seq_num, stop)
+                    args = (self.reply, address, length, ring_len, interval_us / 1e6, stop)
+                    threading.Thread(target=self.push, args=args, name="rsp-stream", daemon=True).start()
+            return [struct.pack("!BH", OPCODE["STREAM_ACK"], seq_num)]
+
+        elif opcode == OPCODE["BATCH"]:
+            response = struct.pack("!BH", OPCODE["BATCH_RSP"], seq_num)
+            pos = 4
+            for _ in range(packet[3]):
+                sub_op = packet[pos]
+                length = struct.unpack_from("!H", packet, pos + 5)[0]
+                size = self._sub_op_size(sub_op, length)
+                if size is None:
+                    return [response + bytes([OPCODE["ABORT"]])]
+                # sub-operations are plain requests without a seqnum, and so are their responses
+                sub_rsp = self.handle(packet[pos:pos+1] + bytes(2) + packet[pos+1:pos+size])
+                if not sub_rsp:
+                    return [response + bytes([OPCODE["ABORT"]])]
+                response += sub_rsp[0][:1] + sub_rsp[0][3:]
+                pos += size
+            return [response]
+
+        # the RTL silently discards unknown opcodes
+        return []
+
+
+    def push(self, reply, address: int, length: int, ring_len: int, interval: float, stop):
+        """Sends STREAM_DATA chunks until stopped, drop_rate applies to them too"""
+        count = 0
+        offset = 0
+        while not stop.is_set():
+            if ring_len:
+                chunk = self.mem[self._span(address + offset, length)]
+            else:
+                chunk = bytes([self.mem[address]]) * length # FIFO, a plain memory doesn't pop
+            if random.random() >= self.drop_rate:
+                packet = struct.pack("!BHIH", OPCODE["STREAM_DATA"], count & 0xFFFF, address + offset, length) + chunk
+                try:
+                    reply(packet)
+                except OSError:
+                    return
+            count += 1
+            if ring_len:
+                offset = (offset + length) % ring_len
+            stop.wait(interval)
+
+
+    def _sub_op_size(self, opcode: int, length: int):
+        """Size of a batched sub-operation, None if it can't be batched"""
+        if opcode in (OPCODE["WRITE"], OPCODE["SET_BITS"], OPCODE["CLEAR_BITS"]):
+            return 7 + length
+        elif opcode == OPCODE["READ"]:
+            return 7
+        elif opcode in (OPCODE["MASKED_WRITE"], OPCODE["CAS"]):
+            return 7 + 2 * length
+        elif opcode == OPCODE["WAIT"]:
+            return 11 + 2 * length
+        return None
+
+
+    def close(self):
+        self.sock.close()
+        if self.host_sock is not None:
+            self.host_sock.close()
+
+
+    def _span(self, address: int, length: int) -> slice:
+        if address + length > len(self.mem):
+            raise ValueError(f"access {address:#x}+{length} is outside the {len(self.mem)} byte memory")
+        return slice(address, address + length)
@@ -0,0 +1,116 @@
+# per-transaction latency tracing for the reliable serial protocol
+#
+# Each sampled request is stamped at four points (all CLOCK_REALTIME, ns):
+#   enqueue  - request handed to RSP._send_frame
+#   send     - the socket send returned
+#   response - kernel receive timestamp of the first response (SO_TIMESTAMPNS)
+#   complete - response parsed and the caller's future resolved
+#
+# enqueue -> send is host scheduling and socket backpressure, send -> response is the wire plus the FPGA (AXI) latency,
+# response -> complete is host RX processing.
+# A local endpoint can answer before the send call has returned, send -> response may then be a few us negative.
+
+import json
+import struct
+import time
+from collections import deque
+
+TRACE_MAGIC = b"RSPT"
+TRACE_VERSION = 1
+# seq, opcode, retries, frame len, enqueue, send, response, complete
+TRACE_RECORD = struct.Struct("<HBBIqqqq")
+
+
+class RSPTracer:
+    def __init__(self, sample: int = 1, max_records: int = 1 << 16):
+        """Trace one in every `sample` requests, keeping the most recent max_records"""
+        self.sample = sample
+        self.count = 0
+        self.active = {}
+        self.records = deque(maxlen=max_records)
+
+
+    def begin(self, seq_num: int, opcode: int, length: int):
+        self.count += 1
+        if self.count % self.sample == 0:
+            self.active[seq_num] = [seq_num, opcode, 0, length, time.time_ns(), 0, 0, 0]
+
+
+    def sent(self, seq_num: int):
+        record = self.active.get(seq_num)
+        if record is not None and not record[5]:
+            record[5] = time.time_ns()
+
+
+    def retried(self, seq_num: int):
+        record = self.active.get(seq_num)
+        if record is not None:
+            record[2] = min(record[2] + 1, 255)
+
+
+    def responded(self, seq_num: int, rx_time: int = None):
+        record = self.active.get(seq_num)
+        if record is not None:
+            record[6] = rx_time or time.time_ns()
+
+
+    def dropped(self, seq_num: int):
+        """The request was abandoned before it was answered, it isn't recorded"""
+        self.active.pop(seq_num, None)
+
+
+    def completed(self, seq_num: int):
+        record = self.active.pop(seq_num, None)
+        if record is not None:
+            record[7] = time.time_ns()
+            self.records.append(tuple(record))
+
+
+    def summary(self) -> dict:
+        """Median and worst case latency (us) of each phase over the recorded transactions"""
+        phases = {"host_tx": (4, 5), "wire_fpga": (5, 6), "host_rx": (6, 7), "total": (4, 7)}
+        result = {}
+        for name, (start, end) in phases.items():
+            lat = sorted((r[end] - r[start]) / 1000 for r in self.records)
+            if lat:
+                result[name] = {"p50": lat[len(lat) // 2], "p99": lat[int(len(lat) * 0.99)], "max": lat[-1]}
+        return result
+
+
+    def write_binary(self, filename: str):
+        """Compact dump, one TRACE_RECORD per transaction after an 8 byte header"""
+        with open(filename, "wb") as f:
+            f.write(TRACE_MAGIC + struct.pack("<I", TRACE_VERSION))
+            for record in self.records:
+                f.write(TRACE_RECORD.pack(*record))
+
+
+    @staticmethod
+    def read_binary(filename: str) -> list:
+        with open(filename, "rb") as f:
+            data = f.read()
+        if data[:4] != TRACE_MAGIC:
+            raise ValueError(f"{filename} is not an RSP trace")
+        return list(TRACE_RECORD.iter_unpack(data[8:]))
+
+
+    def write_chrome(self, filename: str):
+        """Chrome trace-event JSON (chrome://tracing, ui.perfetto.dev), one async track per transaction"""
+        events = []
+        for seq_num, opcode, retries, length, *stamps in self.records:
+            args = {"seq": seq_num, "opcode": f"{opcode:#04x}", "retries": retries, "len": length}
+            events.append(self._event("b", "request", seq_num, stamps[0], args))
+            for name, start, end in (("host_tx", 0, 1), ("wire_fpga", 1, 2), ("host_rx", 2, 3)):
+                events.append(self._event("b", name, seq_num, stamps[start]))
+                events.append(self._event("e", name, seq_num, stamps[end]))
+            events.append(self._event("e", "request", seq_num, stamps[3]))
+
+        with open(filename, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ns"}, f)
+
+
+    def _event(self, ph: str, name: str, seq_num: int, ts: int, args: dict = None) -> dict:
+        event = {"name": name, "cat": "rsp", "ph": ph, "id": seq_num, "pid": 0, "tid": 0, "ts": ts / 1000}
+        if args:
+            event["args"] = args
+        return event
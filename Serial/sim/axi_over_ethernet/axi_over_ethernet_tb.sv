@@ -0,0 +1,75 @@
+// cocotb toplevel: axi_over_ethernet with a symbol_player that can drive serdes_rx_data in place of
+// the serdes_rx_data port (player_enable), see symbol_player.py
+// Both clocks are generated here rather than by cocotb, whose Clock wakes Python on every edge.
+// serdes_rx_clk runs rx_clk_ppm faster than clk (the PHY's clock against ours), it can be changed at any time.
+
+module axi_over_ethernet_tb #(
+  parameter CLK_PERIOD_PS = 8000,
+  parameter RX_CLK_PHASE_PS = 2500,
+  parameter PLAYER_CHUNK = 32
+) (
+  output logic       clk,
+  input  logic       reset,
+
+  output logic       pcs_locked,
+
+  // SERDES interface
+  output logic       serdes_rx_clk,
+  input  logic signed [31:0] rx_clk_ppm,
+  input  logic [9:0] serdes_rx_data,
+  output logic       serdes_rx_bitslip,
+  output logic [9:0] serdes_tx_data,
+
+  // symbol player
+  input  logic                       player_enable,
+  input  logic [10*PLAYER_CHUNK-1:0] player_load_data,
+  input  logic                       player_load_valid,
+  output logic                       player_load_ready,
+  input  logic                       player_preload,
+  input  logic [31:0]                player_preload_cnt,
+  output logic [31:0]                player_level,
+  output logic [31:0]                player_underflows
+);
+
+  logic [9:0] player_data;
+
+  initial begin
+    clk = 0;
+    forever #(CLK_PERIOD_PS / 2000.0) clk = ~clk;
+  end
+
+  initial begin
+    serdes_rx_clk = 0;
+    #(RX_CLK_PHASE_PS / 1000.0);
+    /* verilator lint_off ZERODLY */
+    forever #(CLK_PERIOD_PS / 2000.0 / (1.0 + $itor(rx_clk_ppm) * 1e-6)) serdes_rx_clk = ~serdes_rx_clk;
+    /* verilator lint_on ZERODLY */
+  end
+
+  symbol_player #(
+    .CHUNK(PLAYER_CHUNK)
+  ) player (
+    .clk(serdes_rx_clk),
+    .reset,
+    .load_data(player_load_data),
+    .load_valid(player_load_valid),
+    .load_ready(player_load_ready),
+    .preload(player_preload),
+    .preload_cnt(player_preload_cnt),
+    .level(player_level),
+    .underflows(player_underflows),
+    .bitslip(serdes_rx_bitslip && player_enable),
+    .data_out(player_data)
+  );
+
+  axi_over_ethernet dut (
+    .clk,
+    .reset,
+    .pcs_locked,
+    .serdes_rx_clk,
+    .serdes_rx_data(player_enable ? player_data : serdes_rx_data),
+    .serdes_rx_bitslip,
+    .serdes_tx_data
+  );
+
+endmodule : axi_over_ethernet_tb
@@ -0,0 +1,38 @@
+#!/bin/python3
+# Runs the RSP client against the axi_over_ethernet RTL instead of a board.
+# Start `make cosim` in this directory first, then run this script.
+
+import random
+import sys
+import time
+
+sys.path.insert(0, "../..")
+from rsp import RSP, COSIM_RTD, cosim_socket
+
+# the RTL test memory is 16KiB
+TEST_BYTES = 2**13
+
+
+def main():
+    random.seed(123)
+    conn = RSP(sock=cosim_socket(), rtd=COSIM_RTD)
+    data = random.randbytes(TEST_BYTES)
+
+    start = time.time()
+    conn.write_data(0x0, data)
+    write_time = time.time() - start
+
+    start = time.time()
+    readback = b"".join(conn.read_data(i, min(1000, len(data) - i)) for i in range(0, len(data), 1000))
+    read_time = time.time() - start
+
+    print(f"write: {len(data)} B in {write_time:.1f} s wall, read: {len(data)} B in {read_time:.1f} s wall")
+    for idx, (g, r) in enumerate(zip(data, readback)):
+        if g != r:
+            print(f"Error at idx {idx} - sent byte {g} =/= read byte {r}")
+            sys.exit(1)
+    print("readback matches")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Co-simulation bridge: lets the RSP host client talk to the axi_over_ethernet RTL
+#
+# sim side:  make cosim            (runs cosim_test, which serves the socket until the host disconnects)
+# host side: RSP(sock=cosim_socket(), rtd=COSIM_RTD)
+#
+# Frames from the host get a preamble, FCS and idles and are 8b/10b encoded onto serdes_rx_data.
+# serdes_tx_data is decoded back into frames, the FCS checked and stripped, and sent to the host.
+# Host scripts, windowing and retransmission run unchanged, only much slower than on hardware
+# (hence rsp.COSIM_RTD).
+
+import os
+import zlib
+from collections import deque
+from socket import socket, AF_UNIX, SOCK_SEQPACKET
+
+import cocotb
+from cocotb.triggers import RisingEdge
+from cocotb.utils import get_sim_time
+
+import convert_8b10b
+from frame_stream import frame_stream, idle_stream
+
+K27_7 = 0xFB # start of frame
+K29_7 = 0xFD # end of frame
+SFD   = 0xD5
+FCS_RESIDUE = 0x2144DF1C # crc32 of a frame including a good FCS
+IPG = 14 # code groups from the end of a frame to the next /S/, /T/R/ and 6 idles
+
+
+class RSPBridge:
+    def __init__(self, dut, path: str):
+        self.dut = dut
+        self.path = path
+        if os.path.exists(path):
+            os.remove(path)
+        self.server = socket(AF_UNIX, SOCK_SEQPACKET)
+        self.server.bind(path)
+        self.server.listen(1)
+        self.server.setblocking(False)
+        self.conn = None
+        self.running = False
+        self.unclaimed = deque() # frames sent while no host was connected, for self-checking tests
+
+        self.symbols = deque()
+        self.tx_rd = 0 # running disparity of serdes_tx_data
+
+        self.frames_in = 0
+        self.frames_out = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.fcs_errors = 0
+        self.first_frame_time = None
+        self.last_frame_time = None
+
+
+    async def run(self):
+        """Serve the host until it disconnects"""
+        self.running = True
+        cocotb.start_soon(self.tx_monitor())
+        await self.rx_driver()
+        self.running = False
+        self.report()
+        self.server.close()
+        os.remove(self.path)
+
+
+    async def rx_driver(self):
+        """Drives serdes_rx_data every serdes_rx_clk, idling whenever the host has nothing queued"""
+        while self.running:
+            if not self.symbols:
+                if not self.poll():
+                    return
+                if not self.symbols:
+                    self.queue_idle()
+            self.dut.serdes_rx_data.value = self.symbols.popleft()
+            await RisingEdge(self.dut.serdes_rx_clk)
+
+
+    async def tx_monitor(self):
+        """Reassembles frames from serdes_tx_data and forwards them to the host"""
+        frame = None
+        preamble = False
+        while self.running:
+            await RisingEdge(self.dut.clk)
+            value = self.dut.serdes_tx_data.value
+            if not value.is_resolvable:
+                continue
+            # one code group a cycle, frames are timed to the code group they end on
+            byte, ctrl, self.tx_rd, disparity_err, violation = convert_8b10b.decode(value.integer, self.tx_rd)
+
+            if ctrl and byte == K27_7:
+                frame = bytearray()
+                preamble = True
+            elif frame is None:
+                continue
+            elif ctrl and byte == K29_7:
+                self.deliver(bytes(frame))
+                frame = None
+            elif ctrl or disparity_err or violation:
+                self.dut._log.warning("RSP bridge: code violation inside a frame, dropping it")
+                frame = None
+            elif preamble:
+                preamble = byte != SFD
+            else:
+                frame.append(byte)
+
+
+    def poll(self) -> bool:
+        """Accepts the host connection and queues its next frame, returns False once the host has gone"""
+        if self.conn is None:
+            try:
+                self.conn, _ = self.server.accept()
+            except BlockingIOError:
+                return True
+            self.conn.setblocking(False)
+            self.dut._log.info("RSP host connected")
+
+        try:
+            frame = self.conn.recv(65535)
+        except BlockingIOError:
+            return True
+        if not frame:
+            self.dut._log.info("RSP host disconnected")
+            return False
+
+        if self.first_frame_time is None:
+            self.first_frame_time = get_sim_time("ns")
+        self.frames_in += 1
+        self.bytes_in += len(frame)
+        self.queue_frame(frame)
+        return True
+
+
+    def deliver(self, frame: bytes):
+        if zlib.crc32(frame) != FCS_RESIDUE:
+            self.fcs_errors += 1
+            self.dut._log.warning("RSP bridge: bad FCS on transmitted frame")
+            return
+        self.frames_out += 1
+        self.bytes_out += len(frame)
+        self.last_frame_time = get_sim_time("ns")
+        if self.conn is not None:
+            self.conn.send(frame[:-4])
+        else:
+            self.unclaimed.append(frame[:-4])
+
+
+    def queue_frame(self, frame: bytes):
+        # frames always end in idles, which leave RD-
+        self.symbols.extend(frame_stream([frame], ipg=IPG, lead=0))
+
+
+    def queue_idle(self):
+        self.symbols.extend(idle_stream(1))
+
+
+    def report(self):
+        log = self.dut._log
+        log.info(f"RSP bridge: {self.frames_in} frames ({self.bytes_in} B) in, "
+                 f"{self.frames_out} frames ({self.bytes_out} B) out, {self.fcs_errors} FCS errors")
+        if self.first_frame_time is not None and self.last_frame_time is not None:
+            elapsed = self.last_frame_time - self.first_frame_time
+            if elapsed > 0:
+                gbps = (self.bytes_in + self.bytes_out) * 8 / elapsed
+                log.info(f"RSP bridge: {elapsed:.0f} ns simulated, {gbps:.3f} Gb/s combined frame throughput")
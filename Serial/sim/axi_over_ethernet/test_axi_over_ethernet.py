@@ -6,29 +6,32 @@ import time
 import cocotb
 from cocotb.triggers import Timer, ReadOnly, ReadWrite, ClockCycles, RisingEdge, FallingEdge
 from cocotb.clock import Clock
+from cocotb.utils import get_sim_time
 
 lib_path = "../.."
 sys.path.insert(0, lib_path)
 lib_path = "../../../Ethernet/sim"
 sys.path.insert(0, lib_path)
-from rsp import RSP
+from rsp import RSP, RSPBatch, COSIM_SOCKET, OPCODE
+from rsp_bridge import RSPBridge
 import convert_8b10b
+from frame_stream import frame_stream
+from symbol_player import SymbolPlayer
+
+# clk (8 ns) and serdes_rx_clk (rx_clk_ppm faster) are generated by axi_over_ethernet_tb
+RX_CLK_PPM = 100 # 802.3 allows each end's clock +-100 ppm
 
 
 @cocotb.coroutine
-async def reset(dut):
+async def reset(dut, rx_clk_ppm=RX_CLK_PPM):
     await RisingEdge(dut.clk)
+    dut.rx_clk_ppm.value = rx_clk_ppm
     dut.reset.value = 1
+    dut.player_enable.value = 0 # back to the rx_data port, in case an earlier test left the player on
     await ClockCycles(dut.clk, 5)
     dut.reset.value = 0
     print("DUT reset")
 
-@cocotb.coroutine
-async def serdes_driver(dut, symbols):
-    for sym in symbols:
-        dut.serdes_rx_data.value = sym
-        await RisingEdge(dut.serdes_rx_clk)
-
 @cocotb.coroutine
 async def send_frame(dut, frame):
     for b in frame[:-1]:
@@ -54,54 +57,248 @@ async def rx_test(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8000, units="ps").start())
-    await Timer(2.5, units="ns")
-    cocotb.start_soon(Clock(dut.serdes_rx_clk, 7950, units="ps").start())
     await reset(dut)
 
-    # write data
-    data = [0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50, 0xfb]
-    ctrl = [1, 0, 1, 0, 1, 0, 1, 0, 1, 0, 1]
-    data.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    ctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    data.extend([0x00, 0x07, 0xed, 0x12, 0x34, 0x56, 0x12, 0x34, 0x56, 0xab, 0xcd, 0xef, 0x88, 0xb5, 0x10, 0x00, 0x00, 0x00, 0x00, 0x00, 0x0d, 0x00, 0x40, 0xf5, 0x2d, 0x1e, 0x81, 0xc9, 0x33, 0x8d, 0xa3, 0xe8, 0x9b, 0xcc, 0x4e, 0x74, 0xbf, 0xe2, 0x04, 0x13, 0x97, 0x07, 0xf5, 0xc2, 0xbe, 0x75, 0x1e, 0x33, 0x14, 0xaf, 0x84, 0x99, 0x36, 0xa0, 0xf8, 0xbc, 0xb1, 0x4b, 0x13, 0x64, 0x28, 0xb3, 0x1b, 0xed, 0xcc, 0x43, 0x27, 0x1f, 0x1c, 0x29, 0x6d, 0x35, 0x73, 0x40, 0x84, 0xa3, 0x50, 0x42, 0x74, 0x61, 0x31, 0x1b, 0x24, 0x3f, 0xa7, 0x03, 0x62, 0xdf, 0x88, 0xc3, 0x06])
-    ctrl.extend([0] * (len(data) - len(ctrl)))
-    data.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50, 0xbc, 0x50, 0xbc, 0x50])
-    ctrl.extend([1, 1, 1, 1, 0, 1, 0, 1, 0])
-
-    # read data
-    rdata = []
-    rctrl = []
-    rdata.extend([0xbc, 0x50, 0xbc, 0x50, 0xfb])
-    rctrl.extend([1, 0, 1, 0, 1])
-    rdata.extend([0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0x55, 0xD5])
-    rctrl.extend([0, 0, 0, 0, 0, 0, 0, 0])
-    rdata.extend([0x00, 0x07, 0xed, 0x12, 0x34, 0x56, 0x12, 0x34, 0x56, 0xab, 0xcd, 0xef, 0x88, 0xb5, 0x20, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0d, 0x00, 0x40, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0x05, 0x47, 0x38, 0x05])
-    rctrl.extend([0] * (len(rdata) - len(rctrl)))
-    rdata.extend([0xfd, 0xf7, 0xf7, 0xbc, 0x50])
-    rctrl.extend([1, 1, 1, 1, 0])
-
-    rdata *= 70
-    rctrl *= 70
-
-    data.extend(rdata)
-    ctrl.extend(rctrl)
-
-    code_groups = convert_8b10b.encode(data, ctrl)
+    # write 64 bytes at 0x0, then read them back 70 times, FCS appended by frame_stream
+    write = bytes([0x00, 0x07, 0xed, 0x12, 0x34, 0x56, 0x12, 0x34, 0x56, 0xab, 0xcd, 0xef, 0x88, 0xb5, 0x10, 0x00, 0x00, 0x00, 0x00, 0x00, 0x0d, 0x00, 0x40, 0xf5, 0x2d, 0x1e, 0x81, 0xc9, 0x33, 0x8d, 0xa3, 0xe8, 0x9b, 0xcc, 0x4e, 0x74, 0xbf, 0xe2, 0x04, 0x13, 0x97, 0x07, 0xf5, 0xc2, 0xbe, 0x75, 0x1e, 0x33, 0x14, 0xaf, 0x84, 0x99, 0x36, 0xa0, 0xf8, 0xbc, 0xb1, 0x4b, 0x13, 0x64, 0x28, 0xb3, 0x1b, 0xed, 0xcc, 0x43, 0x27, 0x1f, 0x1c, 0x29, 0x6d, 0x35, 0x73, 0x40, 0x84, 0xa3, 0x50, 0x42, 0x74, 0x61, 0x31, 0x1b, 0x24, 0x3f, 0xa7, 0x03, 0x62])
+    read = bytes([0x00, 0x07, 0xed, 0x12, 0x34, 0x56, 0x12, 0x34, 0x56, 0xab, 0xcd, 0xef, 0x88, 0xb5, 0x20, 0x00, 0x01, 0x00, 0x00, 0x00, 0x0d, 0x00, 0x40]).ljust(60, b"\x00")
+
+    # back to back reads, 3 idles apart
+    code_groups = frame_stream([write] + [read] * 70, ipg=9)
     
-    cocotb.start_soon(serdes_driver(dut,code_groups))
+    player = SymbolPlayer(dut, dut.serdes_rx_clk)
+    cocotb.start_soon(player.play(code_groups))
 
     await ClockCycles(dut.clk, 10000)
 
 
 
+class RequestHarness:
+    """Clocks the DUT and exchanges single request/response frames through a socketless RSPBridge"""
+    def __init__(self, dut, path: str):
+        self.dut = dut
+        self.bridge = RSPBridge(dut, path)
+        self.conn = RSP(dump_sim=True) # only used to build and parse frames
+
+    async def start(self):
+        dut = self.dut
+        await reset(dut)
+
+        self.bridge.running = True
+        cocotb.start_soon(self.bridge.rx_driver())
+        cocotb.start_soon(self.bridge.tx_monitor())
+        while not dut.pcs_locked.value:
+            await RisingEdge(dut.clk)
+        await ClockCycles(dut.clk, 100)
+
+    async def request(self, packet):
+        self.bridge.queue_frame(self.conn._gen_frame(packet))
+        return await self.receive()
+
+    async def receive(self):
+        while not self.bridge.unclaimed:
+            await RisingEdge(self.dut.clk)
+        return self.conn._parse_frame(self.bridge.unclaimed.popleft())
+
+    def stop(self):
+        self.bridge.running = False
+        self.bridge.server.close()
+        os.remove(self.bridge.path)
+
+
+@cocotb.test()
+async def rmw_test(dut):
+    """Read-modify-write opcodes against the test RAM, frames built by the host client"""
+    harness = RequestHarness(dut, "/tmp/rsp_rmw_test.sock")
+    await harness.start()
+    conn = harness.conn
+    request = harness.request
+
+    async def rmw(opcode, address, operands, byte_cnt=None):
+        byte_cnt = byte_cnt or len(operands)
+        op, _, payload, _ = await request(conn._gen_rmw_packet(OPCODE[opcode], address, byte_cnt, operands))
+        assert op == OPCODE[opcode] | 1
+        return payload[:-1], payload[-1]
+
+    async def read(address, byte_cnt):
+        return (await request(conn._gen_read_packet(address, byte_cnt)))[2]
+
+    mem = bytearray(random.randbytes(300))
+    await request(conn._gen_write_packet(0x100, bytes(mem)))
+
+    bits = random.randbytes(4)
+    assert await rmw("SET_BITS", 0x100, bits) == (mem[:4], 1)
+    mem[:4] = bytes(o | b for o, b in zip(mem, bits))
+    assert await rmw("CLEAR_BITS", 0x102, bits) == (mem[2:6], 1)
+    mem[2:6] = bytes(o & ~b for o, b in zip(mem[2:], bits))
+
+    # long enough that the last operand byte ends the frame
+    data, mask = random.randbytes(200), random.randbytes(200)
+    operands = bytes(b for pair in zip(data, mask) for b in pair)
+    assert await rmw("MASKED_WRITE", 0x100, operands, 200) == (mem[:200], 1)
+    mem[:200] = bytes((o & ~m) | (d & m) for o, d, m in zip(mem, data, mask))
+
+    new = random.randbytes(4)
+    miss = bytes(b ^ 1 for b in mem[:4])
+    assert await rmw("CAS", 0x100, bytes(b for pair in zip(miss, new) for b in pair), 4) == (mem[:4], 0)
+    assert await rmw("CAS", 0x100, bytes(b for pair in zip(mem, new) for b in pair), 4) == (mem[:4], 1)
+    mem[:4] = new
+
+    assert await read(0x100, 300) == mem
+    harness.stop()
+
+
+@cocotb.test()
+async def wait_test(dut):
+    """WAIT returns as soon as the masked value matches, or once its timeout expires"""
+    harness = RequestHarness(dut, "/tmp/rsp_wait_test.sock")
+    await harness.start()
+    conn = harness.conn
+
+    async def wait(address, mask, value, timeout_us):
+        operands = bytes(b for pair in zip(mask, value) for b in pair)
+        start = get_sim_time("us")
+        op, _, payload, _ = await harness.request(conn._gen_wait_packet(address, len(mask), timeout_us, operands))
+        assert op == OPCODE["WAIT_RSP"]
+        return payload[-1], payload[:-1], get_sim_time("us") - start
+
+    await harness.request(conn._gen_write_packet(0x40, bytes([0x81, 0x42, 0x00, 0x10])))
+
+    matched, value, _ = await wait(0x40, b"\xff\x0f", b"\x81\x02", 1000)
+    assert (matched, value) == (1, b"\x81\x42")
+    matched, value, elapsed = await wait(0x40, b"\x01\x00\x00\x10", b"\x00\x00\x00\x10", 20)
+    assert (matched, value) == (0, b"\x81\x42\x00\x10")
+    assert elapsed >= 20
+
+    # later requests queue up behind a WAIT
+    await harness.request(conn._gen_write_packet(0x43, b"\x11"))
+    assert (await harness.request(conn._gen_read_packet(0x40, 4)))[2] == b"\x81\x42\x00\x11"
+    harness.stop()
+
+
+@cocotb.test()
+async def batch_test(dut):
+    """Sub-operations of a BATCH run in order and come back in one response"""
+    harness = RequestHarness(dut, "/tmp/rsp_batch_test.sock")
+    await harness.start()
+    conn = harness.conn
+
+    async def submit(batch):
+        op, _, payload, _ = await harness.request(conn._gen_batch_packet(batch))
+        assert op == OPCODE["BATCH_RSP"]
+        return batch.parse(payload)
+
+    batch = RSPBatch()
+    for i in range(10):
+        batch.write(0x400 + 4 * i, (i * 0x01010101).to_bytes(4))
+    batch.set_bits(0x404, b"\xf0")
+    batch.masked_write(0x40c, b"\xaa\xbb", b"\x0f\xf0")
+    batch.compare_and_swap(0x410, b"\x04\x04", b"\x12\x34")
+    batch.wait_for(0x410, b"\xff", b"\x12", 10)
+    batch.read(0x400, 20)
+    assert await submit(batch) == [None] * 10 + [
+        b"\x01", b"\x03\x03", (True, b"\x04\x04"), (True, b"\x12"),
+        bytes.fromhex("00000000 f1010101 02020202 0ab30303 12340404"),
+    ]
+
+    # a full frame, the last sub-operation ends the request
+    batch = RSPBatch()
+    data = random.randbytes(700)
+    batch.read(0x800, 8)
+    batch.write(0x800, data)
+    assert (await submit(batch))[1] is None
+    batch = RSPBatch()
+    batch.read(0x800, 700)
+    assert await submit(batch) == [data]
+
+    # malformed sub-operations end the batch with an abort marker
+    batch = RSPBatch()
+    batch.write(0x600, b"\x07")
+    batch.ops.append((OPCODE["CAS"], 0x600, 8, bytes(16)))
+    batch.read(0x600, 1)
+    try:
+        await submit(batch)
+        assert False, "malformed batch wasn't rejected"
+    except ValueError:
+        pass
+    assert (await harness.request(conn._gen_read_packet(0x600, 1)))[2] == b"\x07"
+    harness.stop()
+
+
+@cocotb.test()
+async def stream_test(dut):
+    """STREAM pushes chunks of a ring region at the configured interval until cancelled"""
+    harness = RequestHarness(dut, "/tmp/rsp_stream_test.sock")
+    await harness.start()
+    conn = harness.conn
+
+    mem = random.randbytes(64)
+    await harness.request(conn._gen_write_packet(0x200, mem))
+
+    async def chunk():
+        op, count, payload, _ = await harness.receive()
+        assert op == OPCODE["STREAM_DATA"]
+        return count, payload, get_sim_time("us")
+
+    conn.seq_num = 7
+    subscribe = conn._gen_stream_packet(0x200, 16, 64, 5)
+    assert (await harness.request(subscribe))[:2] == (OPCODE["STREAM_ACK"], 7)
+    last = 0
+    for i in range(6):
+        count, payload, time = await chunk()
+        offset = (i % 4) * 16
+        assert (count, payload) == (i, mem[offset:offset+16])
+        # chunk 0 goes out behind the ACK, the rest are an interval apart
+        assert i < 2 or time - last > 5 - 0.016 # /S/ is aligned to an even code group
+        last = time
+
+    # a retransmitted subscription is ACKed again without restarting the count
+    harness.bridge.queue_frame(conn._gen_frame(subscribe))
+    responses = [await harness.receive() for _ in range(3)]
+    assert (OPCODE["STREAM_ACK"], 7) in [r[:2] for r in responses]
+    assert all(r[1] >= 6 for r in responses if r[0] == OPCODE["STREAM_DATA"])
+
+    # requests are still served in between chunks
+    harness.bridge.queue_frame(conn._gen_frame(conn._gen_read_packet(0x210, 4)))
+    while (response := await harness.receive())[0] == OPCODE["STREAM_DATA"]:
+        pass
+    assert response[:3] == (OPCODE["READ_RSP"], 7, mem[16:20])
+
+    conn.seq_num = 8
+    harness.bridge.queue_frame(conn._gen_frame(conn._gen_stream_packet(0, 0, 0, 0)))
+    while (response := await harness.receive())[0] == OPCODE["STREAM_DATA"]:
+        pass
+    assert response[:2] == (OPCODE["STREAM_ACK"], 8)
+    await Timer(20, units="us")
+    assert not harness.bridge.unclaimed
+
+    # FIFO mode, every byte of a chunk comes from the same address, back to back
+    assert (await harness.request(conn._gen_stream_packet(0x205, 4, 0, 0)))[0] == OPCODE["STREAM_ACK"]
+    for i in range(3):
+        assert (await chunk())[:2] == (i, bytes([mem[5]]) * 4)
+    conn.seq_num = 9
+    harness.bridge.queue_frame(conn._gen_frame(conn._gen_stream_packet(0, 0, 0, 0)))
+    while (await harness.receive())[0] == OPCODE["STREAM_DATA"]:
+        pass
+    harness.stop()
+
+
+@cocotb.test(skip="RSP_COSIM" not in os.environ)
+async def cosim_test(dut):
+    """Serves a host RSP client (see rsp_bridge.py) until it disconnects, run with `make cosim`"""
+    await reset(dut)
+
+    bridge = RSPBridge(dut, os.environ.get("RSP_COSIM") or COSIM_SOCKET)
+    await bridge.run()
+    assert bridge.fcs_errors == 0
+
+
 #@cocotb.test()
 async def tx_test(dut):
     seed = 12345 #int(time.time())
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
     await reset(dut)
 
     await ClockCycles(dut.clk, 7)
@@ -118,7 +315,6 @@ async def autoneg_test(dut):
     random.seed(seed)
     print(f"using seed: {seed}")
 
-    cocotb.start_soon(Clock(dut.clk, 8, units="ns").start())
     await reset(dut)
 
     symbols = [0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274, 0x0fa, 0x125, 0x274, 0x274, 0x0fa, 0x2aa, 0x18b, 0x18b, 0x305, 0x2d5, 0x18b, 0x18b, 0x305, 0x2aa, 0x274, 0x274]
@@ -0,0 +1,780 @@
+# Host side RSP tests against LocalEndpoint, no hardware needed
+# (the PACKET_FANOUT test runs on the loopback interface, it is skipped without CAP_NET_RAW)
+#
+#   cd Serial && python -m pytest -q test_rsp.py
+
+import asyncio
+import concurrent.futures
+import errno
+import os
+import random
+import selectors
+import struct
+import subprocess
+import sys
+import threading
+import time
+from socket import socket, socketpair, AF_PACKET, AF_UNIX, SOCK_DGRAM, SOCK_RAW, SOL_SOCKET
+
+import pytest
+
+from rsp import RSP, RSPBatch, RSPJournal, RSPThread, BULK_PRIORITY, HIGH_PRIORITY, ETH_TYPE, MAX_PAYLOAD_LEN, \
+                OPCODE, PREFETCH_RETRIES, SO_ATTACH_FILTER, SOL_UDP, UDP_GRO, UDP_MAX_SEGMENTS, attach_bpf, rsp_filter
+from rsp_daemon import RSPClient
+from rsp_endpoint import LocalEndpoint
+from rsp_trace import RSPTracer
+
+MEM_SIZE = 1 << 16
+GROUP_MAC = 0x01005E0088B5
+# CutEndpoint answers every chunk that starts below CUT, a transfer from 0 gets CUT_CHUNKS chunks through
+CUT = 10000
+CUT_CHUNKS = -(-CUT // MAX_PAYLOAD_LEN)
+PACKET_OUTGOING = 4
+
+
+def can_open_raw() -> bool:
+    try:
+        socket(AF_PACKET, SOCK_RAW, 0).close()
+        return True
+    except PermissionError:
+        return False
+
+needs_raw = pytest.mark.skipif(not can_open_raw(), reason="AF_PACKET sockets need CAP_NET_RAW")
+
+
+@pytest.fixture(autouse=True)
+def loop():
+    # every RSP picks up the current loop, give each test a fresh one
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    yield loop
+    # whatever a test left behind, eg. retransmissions close() cancelled but that haven't run since
+    tasks = asyncio.all_tasks(loop)
+    for task in tasks:
+        task.cancel()
+    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+    loop.close()
+    asyncio.set_event_loop(None)
+
+
+@pytest.fixture
+def endpoint():
+    ep = LocalEndpoint(mem_size=MEM_SIZE)
+    yield ep
+    ep.close()
+
+
+def settle(conn, seconds: float = 0.05):
+    """Lets responses that are still on their way (and cancellation callbacks) run"""
+    conn.loop.run_until_complete(asyncio.sleep(seconds))
+
+
+def assert_idle(conn):
+    assert conn.in_flight == 0
+    assert not conn.unacked_packets
+    assert not conn.responses
+    assert not any(conn.waiting)
+
+
+def interrupt(conn, transfer):
+    """Runs a transfer until it stalls and gives up on it, like a script killed part way through"""
+    with pytest.raises(asyncio.TimeoutError):
+        conn.loop.run_until_complete(asyncio.wait_for(transfer, 0.5))
+    conn.close()
+
+
+class CutEndpoint(LocalEndpoint):
+    """Doesn't answer requests at or above address cut, a link that went down part way through a transfer"""
+    def __init__(self, cut: int, **kwargs):
+        self.cut = cut
+        super().__init__(**kwargs)
+
+
+    def handle(self, packet: bytes) -> list:
+        if struct.unpack_from("!I", packet, 3)[0] >= self.cut:
+            raise ValueError("link down")
+        return super().handle(packet)
+
+
+class Segment:
+    """Several LocalEndpoints on one shared segment, frames reach a board by its MAC or by group_mac"""
+    def __init__(self, macs: list, group_mac: int, drop_rates: dict = None):
+        self.host_sock, self.hub = socketpair(AF_UNIX, SOCK_DGRAM)
+        self.group_mac = group_mac.to_bytes(6)
+        # drop_rate 1.0 is a board that never answers, as if it had gone away
+        drop_rates = drop_rates or {}
+        self.boards = [LocalEndpoint(mem_size=MEM_SIZE, mac=mac, drop_rate=drop_rates.get(mac, 0.0)) for mac in macs]
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.hub, selectors.EVENT_READ)
+        for board in self.boards:
+            self.selector.register(board.host_sock, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    frame = key.fileobj.recv(65535)
+                    if key.fileobj is not self.hub:
+                        self.hub.send(frame)
+                        continue
+                    for board in self.boards:
+                        if frame[:6] in (board.mac, self.group_mac):
+                            board.host_sock.send(frame)
+                except OSError:
+                    return # closed
+
+
+    def close(self):
+        self.hub.close()
+        for board in self.boards:
+            board.close()
+        self.host_sock.close()
+
+
+class FakeUDP:
+    """Stands in for RSP's UDP socket, records what is sent and hands out queued reads"""
+    def __init__(self, reads: list = None, gso: bool = True):
+        self.sent = [] # (datagram or GSO buffer, segment size)
+        self.reads = reads or []
+        self.gso = gso
+
+
+    def send(self, data: bytes):
+        self.sent.append((data, None))
+
+
+    def sendmsg(self, buffers: list, ancdata: list):
+        if not self.gso:
+            raise OSError(errno.EIO, "UDP_SEGMENT not supported")
+        self.sent.append((b"".join(buffers), struct.unpack("H", ancdata[0][2])[0]))
+
+
+    def recvmsg(self, bufsize: int, ancbufsize: int):
+        if not self.reads:
+            raise BlockingIOError
+        return self.reads.pop(0)
+
+
+class RawBridge:
+    """Puts a LocalEndpoint on a network interface, it answers the ethernet frames sent to its MAC there"""
+    def __init__(self, endpoint: LocalEndpoint, interface: str = "lo"):
+        self.endpoint = endpoint
+        self.raw = socket(AF_PACKET, SOCK_RAW, 0)
+        self.raw.bind((interface, ETH_TYPE))
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.raw, selectors.EVENT_READ)
+        self.selector.register(endpoint.host_sock, selectors.EVENT_READ)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+
+    def _run(self):
+        while True:
+            for key, _ in self.selector.select():
+                try:
+                    if key.fileobj is self.raw:
+                        frame, (_, _, pkttype, *_) = self.raw.recvfrom(65535)
+                        if pkttype != PACKET_OUTGOING and frame[:6] == self.endpoint.mac:
+                            self.endpoint.host_sock.send(frame)
+                    else:
+                        self.raw.send(self.endpoint.host_sock.recv(65535))
+                except OSError:
+                    return # closed
+
+
+    def close(self):
+        self.raw.close()
+        self.endpoint.close()
+
+
+def test_journal_resumes_interrupted_write(tmp_path):
+    ep = CutEndpoint(cut=CUT, mem_size=MEM_SIZE)
+    path = str(tmp_path / "journal.json")
+    data = random.randbytes(30000)
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path, flush_interval=0))
+    interrupt(conn, conn._write_data_async(0, data))
+    # chunks starting below the cut were ACKed and checkpointed
+    acked = CUT_CHUNKS * MAX_PAYLOAD_LEN
+    assert list(RSPJournal(path).transfers.values()) == [[[0, acked]]]
+
+    # a new process picks up where the first one left off
+    ep.cut = MEM_SIZE
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path))
+    conn.write_data(0, data, resume=True)
+    assert ep.mem[:len(data)] == data
+    assert conn.seq_num == len(list(conn.chunk_range(acked, len(data))))
+    assert RSPJournal(path).transfers == {}
+    conn.close()
+    ep.close()
+
+
+def test_journal_spot_check_resends_corrupted_chunk(tmp_path):
+    ep = CutEndpoint(cut=CUT, mem_size=MEM_SIZE)
+    path = str(tmp_path / "journal.json")
+    data = random.randbytes(30000)
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path, flush_interval=0))
+    interrupt(conn, conn._write_data_async(0, data))
+
+    ep.cut = MEM_SIZE
+    ep.mem[3000:3010] = bytes(10) # lost by the board since, eg. it was reset
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path))
+    conn.write_data(0, data, resume=True, spot_check=100)
+    assert ep.mem[:len(data)] == data
+    # every confirmed chunk was read back, the corrupted one went out again along with the rest
+    assert conn.seq_num == CUT_CHUNKS + 1 + len(list(conn.chunk_range(CUT_CHUNKS * MAX_PAYLOAD_LEN, len(data))))
+    conn.close()
+    ep.close()
+
+
+def test_journal_resumes_interrupted_read(tmp_path):
+    ep = CutEndpoint(cut=CUT, mem_size=MEM_SIZE)
+    ep.mem[:] = random.randbytes(MEM_SIZE)
+    path = str(tmp_path / "journal.json")
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path, flush_interval=0))
+    interrupt(conn, conn._read_data_async(0, 30000))
+
+    # staged chunks come off the disk, only the rest is read
+    ep.cut = MEM_SIZE
+    conn = RSP(sock=ep.host_sock, rtd=0.05, journal=RSPJournal(path))
+    assert conn.read_data(0, 30000, resume=True) == ep.mem[:30000]
+    assert conn.seq_num == len(list(conn.chunk_range(CUT_CHUNKS * MAX_PAYLOAD_LEN, 30000)))
+    assert not list(tmp_path.glob("*.part"))
+    conn.close()
+    ep.close()
+
+
+@needs_raw
+def test_fanout_queues_survive_malformed_frame(capsys):
+    bridge = RawBridge(LocalEndpoint(mem_size=MEM_SIZE))
+    conn = RSP(rtd=0.05, queues=4, interface="lo")
+    data = random.randbytes(20000)
+    conn.write_data(0, data)
+    assert conn.read_data(0, len(data)) == data
+
+    # a response cut short after its opcode, steered to the first queue
+    bridge.raw.send(conn.src_mac + bridge.endpoint.mac + ETH_TYPE.to_bytes(2) + bytes([OPCODE["READ_RSP"]]))
+    settle(conn)
+    assert "Dropped malformed frame" in capsys.readouterr().out
+    # every queue still answers, sequence numbers cycle through all of them
+    for address in range(0, 8000, 1000):
+        assert conn.read_data(address, 4) == data[address:address+4]
+
+    workers = [worker for _, worker in conn.rx_workers]
+    conn.close()
+    assert not any(worker.is_alive() for worker in workers)
+    assert_idle(conn)
+    bridge.close()
+
+
+@pytest.mark.parametrize("udp", [False, True])
+def test_tracer_stamps_every_phase(udp):
+    ep = LocalEndpoint(mem_size=MEM_SIZE, udp=udp)
+    tracer = RSPTracer()
+    conn = RSP(rtd=0.05, tracer=tracer, **({"udp": ep.address} if udp else {"sock": ep.host_sock}))
+    conn.write_data(0, bytes(5000))
+    conn.read_data(0, 100)
+    assert len(tracer.records) == 5
+    for _, _, retries, _, enqueue, sent, response, complete in tracer.records:
+        assert retries == 0
+        assert 0 < enqueue <= sent <= complete
+        assert 0 < response <= complete
+    # an abandoned request leaves no record behind
+    with pytest.raises(asyncio.TimeoutError):
+        conn.loop.run_until_complete(asyncio.wait_for(conn._read_data_async(MEM_SIZE, 4), 0.2))
+    settle(conn)
+    assert not tracer.active
+    assert len(tracer.records) == 5
+    conn.close()
+    ep.close()
+
+
+def test_prefetch_hit_and_invalidate(endpoint):
+    endpoint.mem[:] = random.randbytes(MEM_SIZE)
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05, prefetch=4, prefetch_limit=MEM_SIZE)
+    conn.read_data(0, 1000)
+    conn.read_data(1000, 1000) # sequential, the next four reads are requested in the background
+    settle(conn)
+    assert sorted(conn.prefetched) == [2000, 3000, 4000, 5000]
+    sent = conn.seq_num
+    assert conn.read_data(2000, 1000) == endpoint.mem[2000:3000]
+    assert conn.seq_num == sent + 1 # only the read-ahead top up went out
+
+    # a write over read-ahead data drops it, the next read doesn't see stale data
+    conn.write_data(3500, b"\xaa" * 10)
+    assert 3000 not in conn.prefetched
+    assert conn.read_data(3000, 1000) == endpoint.mem[3000:4000]
+    assert endpoint.mem[3500:3510] == b"\xaa" * 10
+    settle(conn)
+    assert_idle(conn)
+    conn.close()
+
+
+def test_failed_read_keeps_sequential_position():
+    ep = CutEndpoint(cut=MEM_SIZE, mem_size=MEM_SIZE)
+    conn = RSP(sock=ep.host_sock, rtd=0.05, prefetch=4, prefetch_limit=MEM_SIZE)
+    conn.read_data(0, 1000)
+    ep.cut = 1000
+    with pytest.raises(asyncio.TimeoutError):
+        conn.loop.run_until_complete(asyncio.wait_for(conn._read_data_async(1000, 1000), 0.2))
+    settle(conn, conn.rtd * (PREFETCH_RETRIES + 2)) # until what it read ahead is given up
+    assert not conn.prefetched
+    # reading on from where the last good read ended is still sequential
+    ep.cut = MEM_SIZE
+    conn.read_data(1000, 1000)
+    assert sorted(conn.prefetched) == [2000, 3000, 4000, 5000]
+    settle(conn)
+    assert_idle(conn)
+    conn.close()
+    ep.close()
+
+
+def test_filter_passes_only_our_boards_responses():
+    host, other_host = bytes.fromhex("123456abcdef"), bytes.fromhex("123456abcd00")
+    boards = [bytes.fromhex("0007ed000001"), bytes.fromhex("0007ed000002")]
+    stranger = bytes.fromhex("0007ed000003")
+    # the same classic BPF program works on any socket, it sees the whole frame on a unix datagram socket too
+    tx, rx = socketpair(AF_UNIX, SOCK_DGRAM)
+    attach_bpf(rx, SOL_SOCKET, SO_ATTACH_FILTER, rsp_filter(host, boards))
+    rx.setblocking(False)
+
+    frame = lambda dst, src, opcode, eth_type=ETH_TYPE: dst + src + eth_type.to_bytes(2) + bytes([opcode, 0, 1]).ljust(46, b"\0")
+    wanted = [frame(host, board, opcode) for board in boards for opcode in (OPCODE["WRITE_ACK"], OPCODE["READ_RSP"])]
+    unwanted = [
+        frame(boards[0], host, OPCODE["READ"]),               # our own request looping back
+        frame(host, stranger, OPCODE["READ_RSP"]),            # another board on the segment
+        frame(other_host, boards[0], OPCODE["READ_RSP"]),     # another host's response
+        frame(host, boards[0], OPCODE["READ_RSP"], 0x0800),   # not RSP at all
+        frame(host, boards[0], 0x12),                         # not a response opcode
+    ]
+    for f in unwanted + wanted:
+        tx.send(f)
+    received = []
+    while True:
+        try:
+            received.append(rx.recv(65535))
+        except BlockingIOError:
+            break
+    assert received == wanted
+    tx.close()
+    rx.close()
+
+
+def test_window_released_after_mixed_workload(endpoint):
+    # no prefetch_limit on purpose, read-ahead runs off the end of memory and is never answered
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05, prefetch=8)
+    random.seed(1)
+    data = random.randbytes(MEM_SIZE)
+    conn.write_data(0, data)
+    for address in range(60000, 65000, 1000):
+        assert conn.read_data(address, 1000) == data[address:address+1000]
+    assert conn.set_bits(0x10, b"\x0f") == data[0x10:0x11]
+    # a read nobody waits for anymore (the endpoint ignores reads past the end of memory)
+    with pytest.raises(asyncio.TimeoutError):
+        conn.loop.run_until_complete(asyncio.wait_for(conn._read_data_async(MEM_SIZE, 4), 0.2))
+    # overwrites the read-ahead buffer, what is past the end of memory is given up
+    conn.write_data(60000, bytes(MEM_SIZE - 60000))
+    conn.read_data(0, 5000) # not sequential, no read-ahead
+    settle(conn, conn.rtd * (PREFETCH_RETRIES + 2))
+    assert not conn.prefetched
+    assert_idle(conn)
+    conn.close()
+
+
+def test_bulk_lane_survives_dropped_prefetches(endpoint):
+    # 8 bulk slots, exactly what one unanswerable read-ahead takes
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05, prefetch=8, window=16, reserve=8)
+    for _ in range(5):
+        for address in range(61000, 65000, 1000):
+            conn.read_data(address, 1000)
+        conn.write_data(0, bytes(100)) # small, high priority
+        conn.read_data(0, 100)         # jumps away from the read-ahead
+    # bulk transfers still get through
+    conn.loop.run_until_complete(asyncio.wait_for(conn._write_data_async(0, bytes(20000), priority=BULK_PRIORITY), 5))
+    # it may have got through before all of the read-ahead was given up
+    settle(conn, conn.rtd * (PREFETCH_RETRIES + 2))
+    assert_idle(conn)
+    conn.close()
+
+
+def test_high_priority_granted_ahead_of_queued_bulk(endpoint):
+    conn = RSP(sock=endpoint.host_sock, window=2, reserve=0)
+    order = []
+
+    async def acquire(priority: int, name: str):
+        await conn._acquire_slot(priority)
+        order.append(name)
+
+    async def scenario():
+        await conn._acquire_slot(BULK_PRIORITY)
+        await conn._acquire_slot(BULK_PRIORITY)
+        waiters = [asyncio.ensure_future(acquire(priority, name)) for priority, name in
+                   [(BULK_PRIORITY, "bulk1"), (HIGH_PRIORITY, "high1"), (BULK_PRIORITY, "bulk2"), (HIGH_PRIORITY, "high2")]]
+        await asyncio.sleep(0)
+        for _ in range(len(waiters)):
+            conn._release_slot()
+            await asyncio.sleep(0)
+        await asyncio.gather(*waiters)
+
+    conn.loop.run_until_complete(scenario())
+    assert order == ["high1", "high2", "bulk1", "bulk2"]
+    conn._release_slot()
+    conn._release_slot()
+    assert_idle(conn)
+    conn.close()
+
+
+def test_reserved_slots_only_go_to_high_priority(endpoint):
+    conn = RSP(sock=endpoint.host_sock, window=4, reserve=2)
+
+    async def scenario():
+        await conn._acquire_slot(BULK_PRIORITY)
+        await conn._acquire_slot(BULK_PRIORITY)
+        bulk = asyncio.ensure_future(conn._acquire_slot(BULK_PRIORITY))
+        await asyncio.wait_for(conn._acquire_slot(HIGH_PRIORITY), 0.1)
+        await asyncio.wait_for(conn._acquire_slot(HIGH_PRIORITY), 0.1)
+        await asyncio.sleep(0.01)
+        assert not bulk.done()
+        # a freed reserved slot doesn't go to bulk either
+        conn._release_slot()
+        await asyncio.sleep(0.01)
+        assert not bulk.done()
+        conn._release_slot()
+        conn._release_slot()
+        await asyncio.wait_for(bulk, 0.1)
+
+    conn.loop.run_until_complete(scenario())
+    assert conn.in_flight == 2
+    conn.close()
+
+
+def test_csr_read_overtakes_bulk_write():
+    # every response takes a while, so the bulk write is limited by the window for most of its length
+    ep = LocalEndpoint(mem_size=MEM_SIZE, latency=0.002)
+    conn = RSP(sock=ep.host_sock, rtd=1, window=8, reserve=2)
+
+    async def scenario():
+        bulk = asyncio.ensure_future(conn._write_data_async(0, bytes(40000)))
+        await asyncio.sleep(0.01)
+        assert conn.waiting[BULK_PRIORITY]
+        await conn._read_data_async(0xF000, 4)
+        assert not bulk.done()
+        await bulk
+
+    conn.loop.run_until_complete(scenario())
+    assert_idle(conn)
+    conn.close()
+    ep.close()
+
+
+def test_group_write_drops_silent_board():
+    macs = [0x0007ED000001, 0x0007ED000002, 0x0007ED000003]
+    segment = Segment(macs, GROUP_MAC, drop_rates={macs[1]: 1.0})
+    conn = RSP(sock=segment.host_sock, rtd=0.02, boards=macs, group_mac=GROUP_MAC, group_retries=3)
+    data = random.randbytes(5000)
+    with pytest.raises(TimeoutError, match="00:07:ed:00:00:02"):
+        conn.write_group(0x100, data)
+    settle(conn)
+    assert not conn.group_pending
+    assert_idle(conn)
+    # the others got every chunk
+    assert segment.boards[0].mem[0x100:0x100+len(data)] == data
+    assert segment.boards[2].mem[0x100:0x100+len(data)] == data
+    conn.close()
+    segment.close()
+
+
+def test_group_write_resends_to_lossy_board_only(capsys):
+    macs = [0x0007ED000001, 0x0007ED000002, 0x0007ED000003]
+    segment = Segment(macs, GROUP_MAC, drop_rates={macs[1]: 0.3})
+    conn = RSP(sock=segment.host_sock, rtd=0.02, boards=macs, group_mac=GROUP_MAC)
+    data = random.randbytes(20000)
+    conn.write_group(0x100, data)
+    for board in segment.boards:
+        assert board.mem[0x100:0x100+len(data)] == data
+    resent = [line for line in capsys.readouterr().out.splitlines() if line.startswith("Retransmitting")]
+    assert resent
+    assert all(line.endswith("to 00:07:ed:00:00:02") for line in resent)
+    settle(conn)
+    assert not conn.group_pending
+    assert_idle(conn)
+    conn.close()
+    segment.close()
+
+
+def test_group_write_needs_group_mac(endpoint):
+    conn = RSP(sock=endpoint.host_sock, boards=[0x0007ED123456])
+    with pytest.raises(ValueError, match="group_mac"):
+        conn.write_group(0, bytes(10))
+    assert_idle(conn)
+    conn.close()
+
+
+def test_wait_for_matches_when_bits_change(endpoint):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    # the FPGA side sets the flag while the endpoint polls, nothing can come in over the link meanwhile
+    setter = threading.Timer(0.1, endpoint.mem.__setitem__, (0x100, 0x81))
+    setter.start()
+    assert conn.wait_for(0x100, b"\x80", b"\x80", 2.0) == (True, b"\x81")
+    setter.join()
+    conn.close()
+
+
+def test_wait_for_timeout_returns_last_value(endpoint, capsys):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    conn.write_data(0x100, b"\x01\x02")
+    start = time.monotonic()
+    assert conn.wait_for(0x100, b"\x80\xff", b"\x80\x02", 0.3) == (False, b"\x01\x02")
+    assert time.monotonic() - start >= 0.3
+    # polling for longer than rtd is not a lost request
+    assert "Retransmitting" not in capsys.readouterr().out
+    assert_idle(conn)
+    conn.close()
+
+
+def test_thread_client_shared_by_many_threads(endpoint):
+    conn = RSPThread(sock=endpoint.host_sock, rtd=0.05)
+
+    def worker(idx: int):
+        data = random.randbytes(4096)
+        conn.write_data(idx * 4096, data).result(5)
+        assert conn.read_data(idx * 4096, 4096).result(5) == data
+        conn.set_bits(0xFF00, bytes([1 << idx])).result(5)
+
+    with concurrent.futures.ThreadPoolExecutor(8) as pool:
+        list(pool.map(worker, range(8)))
+    # no set_bits got lost between threads
+    assert endpoint.mem[0xFF00] == 0xFF
+    # errors come back through the future, and the loop thread carries on
+    with pytest.raises(ValueError, match="same length"):
+        conn.masked_write(0, b"\x01\x02", b"\xff").result(5)
+    assert conn.read_data(0xFF00, 1).result(5) == b"\xff"
+    conn.close()
+    assert not conn.thread.is_alive()
+    assert_idle(conn.rsp)
+
+
+def take(stream, n: int) -> list:
+    chunks = []
+    for chunk in stream:
+        chunks.append(chunk)
+        if len(chunks) == n:
+            break
+    return chunks
+
+
+def test_stream_sweeps_ring(endpoint):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    ring = random.randbytes(4 * 64)
+    conn.write_data(0x1000, ring)
+    stream = conn.stream(0x1000, 64, ring_len=len(ring), interval=0.001)
+    chunks = take(stream, 10)
+    # numbered from 0, wrapping over the ring
+    assert [count for count, _ in chunks] == list(range(10))
+    for count, data in chunks:
+        offset = count % 4 * 64
+        assert data == ring[offset:offset+64]
+    assert stream.lost == 0
+    stream.close()
+    assert conn.active_stream is None
+    conn.close()
+
+
+def test_stream_fifo_repeats_one_address(endpoint):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    conn.write_data(0x2000, b"\x5a\xa5")
+    with conn.stream(0x2000, 16, interval=0.001) as stream:
+        assert [data for _, data in take(stream, 5)] == [b"\x5a" * 16] * 5
+    conn.close()
+
+
+def test_stream_counts_lost_chunks(endpoint):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    stream = conn.stream(0x1000, 64, ring_len=4096, interval=0.001)
+    random.seed(2)
+    endpoint.drop_rate = 0.2 # chunks only, the subscription went through
+    chunks = take(stream, 200)
+    endpoint.drop_rate = 0.0
+    stream.close()
+    counts = [count for count, _ in chunks]
+    assert counts == sorted(set(counts))
+    assert stream.lost == counts[-1] + 1 - len(chunks) > 0
+    conn.close()
+
+
+def test_stream_close_ends_iteration(endpoint):
+    conn = RSP(sock=endpoint.host_sock, rtd=0.05)
+    stream = conn.stream(0x1000, 64, ring_len=4096, interval=0.001)
+    take(stream, 3)
+    stream.close()
+    # what had arrived is still handed out, then iteration stops and the FPGA sends no more
+    list(stream)
+    assert list(stream) == []
+    settle(conn)
+    assert not stream.chunks
+    # a new subscription can start
+    conn.stream(0x1000, 64, ring_len=4096).close()
+    assert_idle(conn)
+    conn.close()
+
+
+def test_thread_client_stream(endpoint):
+    conn = RSPThread(sock=endpoint.host_sock, rtd=0.05)
+    stream = conn.stream(0x1000, 64, ring_len=4096, interval=0.001).result(5)
+    # iterated from this thread while the RSP loop runs on its own
+    assert [count for count, _ in take(stream, 5)] == list(range(5))
+    closer = threading.Thread(target=stream.close)
+    closer.start()
+    closer.join(5)
+    list(stream)
+    assert conn.rsp.active_stream is None
+    conn.close()
+
+
+@needs_raw
+def test_fanout_keeps_stream_in_order():
+    bridge = RawBridge(LocalEndpoint(mem_size=MEM_SIZE))
+    conn = RSP(rtd=0.05, queues=4, interface="lo")
+    stream = conn.stream(0x1000, 64, ring_len=4096, interval=10)
+    assert take(stream, 1)[0][0] == 0
+    # a burst of chunks behind the first, numbered across every queue's share of the sequence space
+    header = conn.src_mac + bridge.endpoint.mac + ETH_TYPE.to_bytes(2)
+    for count in range(1, 200):
+        bridge.raw.send(header + struct.pack("!BHIH", OPCODE["STREAM_DATA"], count, 0x1000, 64) + bytes(64))
+    counts = []
+    for count, _ in stream:
+        counts.append(count)
+        if count == 199:
+            break
+    assert counts == list(range(1, 200))
+    assert stream.lost == 0
+    stream.close()
+    conn.close()
+    bridge.close()
+
+
+# a process of its own, with its own LocalEndpoint, SIGTERM shuts it down
+DAEMON = """
+import signal, sys
+from rsp_daemon import RSPDaemon
+from rsp_endpoint import LocalEndpoint
+ep = LocalEndpoint()
+daemon = RSPDaemon(sys.argv[1], ring_size=1 << 16, sock=ep.host_sock, rtd=0.05)
+daemon.loop.add_signal_handler(signal.SIGTERM, daemon.loop.stop)
+daemon.serve_forever()
+"""
+
+
+def test_daemon_round_trip_and_errors(tmp_path):
+    # not a multiprocessing child, clients and daemon mustn't share a resource tracker
+    path = str(tmp_path / "rsp_daemon.sock")
+    daemon = subprocess.Popen([sys.executable, "-c", DAEMON, path], cwd=os.path.dirname(__file__),
+                              stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while not os.path.exists(path):
+        assert time.monotonic() < deadline and daemon.poll() is None
+        time.sleep(0.01)
+    client, other = RSPClient(path), RSPClient(path)
+
+    # bigger than the ring, goes through as several requests
+    data = random.randbytes(50000)
+    client.write_data(0, data)
+    assert other.read_data(0, len(data)) == data
+    assert client.set_bits(0x10, b"\x80") == data[0x10:0x11]
+    assert client.compare_and_swap(0, data[:4], b"abcd") == (True, data[:4])
+    assert other.compare_and_swap(0, data[:4], b"efgh") == (False, b"abcd")
+    # an error in the daemon comes back to the client that asked, which can carry on
+    with pytest.raises(ValueError, match="RSP daemon: data and mask must be the same length"):
+        client.masked_write(0, b"\x01\x02", b"\xff")
+    assert client.read_data(0, 4) == b"abcd"
+
+    # a batch goes through as one request, the client parses the response
+    batch = RSPBatch()
+    batch.write(0x20, b"\x11\x22")
+    batch.read(0x20, 2)
+    batch.compare_and_swap(0x20, b"\x11\x22", b"\x33\x44")
+    batch.wait_for(0x20, b"\xff", b"\x33", 1.0)
+    assert client.submit(batch) == [None, b"\x11\x22", (True, b"\x11\x22"), (True, b"\x33")]
+    assert other.read_data(0x20, 2) == b"\x33\x44"
+    with pytest.raises(ValueError, match="RSP daemon: opcode 0x90 can't be batched"):
+        client._call([(OPCODE["BATCH"], 0, 1, 0, bytes([OPCODE["STREAM"]]) + bytes(6), 16)])
+
+    client.close()
+    other.close()
+    daemon.terminate()
+    assert daemon.wait(10) == 0
+    assert not os.path.exists(path)
+
+
+def test_udp_round_trip():
+    ep = LocalEndpoint(mem_size=MEM_SIZE, udp=True)
+    conn = RSP(udp=ep.address, rtd=0.05)
+    data = random.randbytes(40000)
+    conn.write_data(0, data) # a window of equal sized chunks, sent with UDP_SEGMENT
+    assert conn.udp_gso
+    assert ep.mem[:len(data)] == data
+    assert conn.read_data(0, len(data)) == data
+    assert conn.set_bits(0x10, b"\x01") == data[0x10:0x11]
+    batch = RSPBatch()
+    batch.write(0x100, b"abcd")
+    batch.read(0x100, 4)
+    assert conn.submit(batch)[1] == b"abcd"
+    assert_idle(conn)
+    conn.close()
+    ep.close()
+
+
+def test_udp_flush_batches_equal_sized_runs():
+    ep = LocalEndpoint(mem_size=MEM_SIZE, udp=True)
+    conn = RSP(udp=ep.address)
+    sock, conn.sock = conn.sock, FakeUDP()
+    # a shorter packet can end a run, a longer one starts the next
+    conn.udp_pending = [bytes([i]) * 100 for i in range(3)] + [b"s" * 50, b"t" * 100, b"u" * 200]
+    conn._flush_udp()
+    assert conn.sock.sent == [
+        (bytes(100) + b"\x01" * 100 + b"\x02" * 100 + b"s" * 50, 100),
+        (b"t" * 100, None),
+        (b"u" * 200, None),
+    ]
+    # no more than the kernel takes in one send
+    conn.sock.sent = []
+    conn.udp_pending = [bytes(10)] * (UDP_MAX_SEGMENTS + 1)
+    conn._flush_udp()
+    assert conn.sock.sent == [(bytes(10 * UDP_MAX_SEGMENTS), 10), (bytes(10), None)]
+    conn.sock = sock
+    conn.close()
+    ep.close()
+
+
+def test_udp_falls_back_without_gso():
+    ep = LocalEndpoint(mem_size=MEM_SIZE, udp=True)
+    conn = RSP(udp=ep.address)
+    sock, conn.sock = conn.sock, FakeUDP(gso=False)
+    conn.udp_pending = [bytes([i]) * 100 for i in range(3)]
+    conn._flush_udp()
+    assert not conn.udp_gso
+    assert conn.sock.sent == [(bytes([i]) * 100, None) for i in range(3)]
+    conn.sock = sock
+    conn.close()
+    ep.close()
+
+
+def test_udp_splits_gro_reads():
+    ep = LocalEndpoint(mem_size=MEM_SIZE, udp=True)
+    conn = RSP(udp=ep.address)
+    responses = [struct.pack("!BHIH", OPCODE["READ_RSP"], seq_num, 0, 4) + bytes([seq_num]) * 4 for seq_num in range(3)]
+    # the last segment of a GRO read can be shorter than the rest
+    ack = struct.pack("!BH", OPCODE["WRITE_ACK"], 3)
+    sock, conn.sock = conn.sock, FakeUDP(reads=[
+        (b"".join(responses) + ack, [(SOL_UDP, UDP_GRO, struct.pack("i", len(responses[0])))], 0, None),
+    ])
+    received = []
+    conn._on_response = lambda opcode, seq_num, payload, board, rx_time: received.append((opcode, seq_num, payload))
+    conn._receive_udp()
+    assert received == [(OPCODE["READ_RSP"], seq_num, bytes([seq_num]) * 4) for seq_num in range(3)] + \
+                       [(OPCODE["WRITE_ACK"], 3, b"")]
+    conn.sock = sock
+    conn.close()
+    ep.close()